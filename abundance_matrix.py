@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+# Merge per-sample MPA / Bracken outputs of all studies into one sparse samples x taxa store
+
+import argparse
+import os
+
+
+import common
+import matrix_store
+import project_index
+from kraken_utils import read_kreport
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+ROW_HEADER = ['sample', 'study', 'type']
+COL_HEADER = {
+    'mpa': ['taxon', 'rank', 'name'],
+    'bracken': ['taxid', 'rank', 'name', 'lineage'],
+}
+
+# Read clade counts of every taxon in an MPA file, keyed by the full lineage string
+def read_mpa(in_file):
+    values, meta = {}, {}
+    with open(in_file) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            lineage, count = line.rstrip('\n').split('\t')[:2]
+            leaf = lineage.split('|')[-1]
+            rank, _, name = leaf.partition('__')
+            values[lineage] = float(count)
+            meta[lineage] = [rank, name]
+    return values, meta
+
+# Read Bracken estimates keyed by taxid, with lineages from the re-estimated report
+def read_bracken(bracken_file, report_file):
+    lineages = {}
+    if os.path.exists(report_file):
+        nodes = read_kreport(report_file)
+        names = []
+        for node in nodes:
+            parent = node['parent']
+            names.append(node['name'] if parent is None else f"{names[parent]}|{node['name']}")
+            lineages[node['taxid']] = names[-1]
+
+    values, meta = {}, {}
+    with open(bracken_file) as f:
+        next(f)  # Skip the header row
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 7:
+                continue
+            name, taxid, rank, new_est_reads = fields[0], fields[1], fields[2], fields[5]
+            values[taxid] = float(new_est_reads)
+            meta[taxid] = [rank, name, lineages.get(taxid, "")]
+    return values, meta
+
+# Collect the per-sample rows of one study that are not yet in the store
+def collect_study(base, study, samples_in, source, known):
+    new_rows, col_meta = [], {}
+    kraken_out = f"{base}/{study}/kraken_out"
+    for sample in project_index.samples(index, base, study):
+        row_meta = [sample, study, os.path.basename(base)]
+        if tuple(row_meta) in known:
+            continue
+        if source == 'mpa':
+            in_file = f"{kraken_out}/{sample}/{sample}_mpa.txt"
+            if not os.path.exists(in_file):
+                continue
+            values, meta = read_mpa(in_file)
+        else:
+            in_file = f"{kraken_out}/{sample}/{sample}.bracken"
+            if not os.path.exists(in_file):
+                continue
+            values, meta = read_bracken(in_file, f"{kraken_out}/{sample}/{sample}_bracken_species.report")
+        new_rows.append((row_meta, values))
+        col_meta.update(meta)
+    return new_rows, col_meta
+
+# Slice a store by study and/or taxa, memory-mapped
+def slice_store(store, studies=None, taxa=None, field='name'):
+    if taxa:
+        store_obj = matrix_store.load_store(store, layout='csc')
+        cols = matrix_store.select_cols(store_obj, field, taxa)
+        matrix = store_obj['matrix'][:, cols].tocsr()
+        col_names = [store_obj['cols'][i] for i in cols]
+    else:
+        store_obj = matrix_store.load_store(store)
+        matrix = store_obj['matrix']
+        col_names = store_obj['cols']
+    rows = store_obj['rows']
+    if studies:
+        idx = matrix_store.select_rows(store_obj, 'study', studies)
+        matrix = matrix[idx]
+        rows = [rows[i] for i in idx]
+    return matrix, rows, col_names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a study-wide sparse taxon abundance matrix from MPA or Bracken outputs...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-i", "--source", choices=['mpa', 'bracken'], default='mpa', help="Per-sample input to merge (Default: mpa)")
+    parser.add_argument("-o", "--output", help="Matrix store directory. (Default: {base_dir}_taxa_matrix_{source} beside the base dir)", default=None)
+    args = parser.parse_args()
+
+    console.print(
+        panel(
+            f"{common.EMOJI_SPARKLE} Building taxon abundance matrix...",
+            title=f"Study: {common.study_name.upper()}",
+            title_align="left",
+            border_style='dim bold yellow'
+        ),
+        style='italic dim'
+    )
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    base_dirs = project_index.base_dirs(index)
+
+    store = args.output or f"{base_dir}_taxa_matrix_{args.source}"
+    known = {tuple(row) for row in matrix_store.read_table(os.path.join(store, "rows.tsv"))[1]}
+    logger.info(f"{common.EMOJI_SPARKLE} Store [i dim]{store}[/] already holds {len(known)} {p.plural('sample', len(known))}")
+
+    if base_dirs:
+        new_rows, col_meta = [], {}
+        for base in base_dirs:
+            for study in project_index.studies(index, base):
+                study_rows, study_meta = collect_study(base, study, args.samples, args.source, known)
+                new_rows.extend(study_rows)
+                col_meta.update(study_meta)
+        logger.info(f"{common.EMOJI_PROCESS} Found {len(new_rows)} new {p.plural('sample', len(new_rows))} to append")
+
+        matrix_store.append_rows(store, ROW_HEADER, COL_HEADER[args.source], new_rows, col_meta)
+
+        console.print(
+            panel.fit(
+                f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] building the taxon abundance matrix.",
+                title="Done",
+                border_style="green", title_align="right"
+            ),
+            style='italic'
+        )
+    else:
+        logger.error(f"{common.EMOJI_CROSS} Studies not found, is the provided {args.base_dir} directory correct?")
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# Merge the AMR++ gene count matrices of all studies into one sparse samples x genes store (see matrix_store.py)
+# Columns are MEGARes genes annotated with type, class, mechanism and group; the csc_* arrays give gene-major access
+
+import argparse
+import csv
+import glob
+import os
+
+
+import common
+import matrix_store
+import project_index
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+ROW_HEADER = ['sample', 'study', 'type']
+COL_HEADER = ['gene', 'gene_type', 'class', 'mechanism', 'group']
+
+# Count matrices written by AMR++, in order of preference
+AMR_MATRICES = ["AMR_analytic_matrix_with_SNP_confirmation.csv", "AMR_analytic_matrix.csv"]
+
+# Gene-level count matrix of a finished AMR++ run, or None
+def find_matrix(amr_out):
+    for name in AMR_MATRICES:
+        found = sorted(glob.glob(f"{amr_out}/Results/**/{name}", recursive=True))
+        if found:
+            return found[0]
+    return None
+
+# An AMR++ run is complete when its count matrix exists and parses, with a header naming at least one sample;
+# the other entries of Results vary with the pipeline version and options
+def results_ok(amr_out):
+    in_file = find_matrix(amr_out)
+    if in_file is None:
+        return False
+    try:
+        with open(in_file, newline='') as f:
+            header = next(csv.reader(f), [])
+    except (OSError, UnicodeDecodeError, csv.Error):
+        return False
+    return len(header) > 1 and all(column.strip() for column in header[1:])
+
+# Split a MEGARes header (MEG_ID|Type|Class|Mechanism|Group[|RequiresSNPConfirmation]) into key and annotations
+def parse_gene(header):
+    fields = header.split('|')
+    meta = (fields[1:5] + [""] * 4)[:4]
+    return fields[0], meta
+
+# Read a genes x samples AMR++ matrix into per-sample {gene: count} dicts and gene annotations
+def read_amr_matrix(in_file):
+    with open(in_file, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = header[1:]
+        values = {column: {} for column in columns}
+        meta = {}
+        for row in reader:
+            if not row:
+                continue
+            gene, gene_meta = parse_gene(row[0])
+            meta[gene] = gene_meta
+            for column, count in zip(columns, row[1:]):
+                if count and float(count) != 0:
+                    values[column][gene] = values[column].get(gene, 0) + float(count)
+    return values, meta
+
+# Map AMR++ column names (sample IDs, possibly with read suffixes) to the study's sample IDs
+def match_sample(column, samples):
+    if column in samples:
+        return column
+    matches = [sample for sample in samples if column.startswith(sample)]
+    return max(matches, key=len) if matches else column
+
+# Collect the rows of one study that are not yet in the store
+def collect_study(context, samples, known):
+    if not results_ok(context['amr_out']):
+        return [], {}
+
+    values, meta = read_amr_matrix(find_matrix(context['amr_out']))
+    new_rows = []
+    for column, counts in values.items():
+        row_meta = [match_sample(column, samples), context['study'], context['type']]
+        if tuple(row_meta) not in known:
+            new_rows.append((row_meta, counts))
+    return new_rows, meta
+
+# Append the finished studies among contexts to the store; returns the number of new rows
+def update_store(store, contexts):
+    known = {tuple(row) for row in matrix_store.read_table(os.path.join(store, "rows.tsv"))[1]}
+    new_rows, col_meta = [], {}
+    for context, samples in contexts:
+        study_rows, study_meta = collect_study(context, samples, known)
+        new_rows.extend(study_rows)
+        col_meta.update(study_meta)
+    return matrix_store.append_rows(store, ROW_HEADER, COL_HEADER, new_rows, col_meta)
+
+# Slice a store by study and/or annotation (e.g. class or mechanism), memory-mapped
+def slice_store(store, studies=None, values=None, field='class'):
+    if values:
+        store_obj = matrix_store.load_store(store, layout='csc')
+        cols = matrix_store.select_cols(store_obj, field, values)
+        matrix = store_obj['matrix'][:, cols].tocsr()
+        col_names = [store_obj['cols'][i] for i in cols]
+    else:
+        store_obj = matrix_store.load_store(store)
+        matrix = store_obj['matrix']
+        col_names = store_obj['cols']
+    rows = store_obj['rows']
+    if studies:
+        idx = matrix_store.select_rows(store_obj, 'study', studies)
+        matrix = matrix[idx]
+        rows = [rows[i] for i in idx]
+    return matrix, rows, col_names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a study-wide sparse AMR gene abundance matrix from AMR++ Results...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-o", "--output", help="Matrix store directory. (Default: {base_dir}_amr_matrix beside the base dir)", default=None)
+    args = parser.parse_args()
+
+    console.print(
+        panel(
+            f"{common.EMOJI_SPARKLE} Building AMR gene abundance matrix...",
+            title=f"Study: {common.study_name.upper()}",
+            title_align="left",
+            border_style='dim bold yellow'
+        ),
+        style='italic dim'
+    )
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    base_dirs = project_index.base_dirs(index)
+
+    store = args.output or f"{base_dir}_amr_matrix"
+    if base_dirs:
+        contexts = []
+        for base in base_dirs:
+            for study in project_index.studies(index, base):
+                contexts.append((common.study_context(base, study, amr_out="amr_out"), project_index.samples(index, base, study)))
+        n_added = update_store(store, contexts)
+        logger.info(f"{common.EMOJI_PROCESS} Appended {n_added} new {p.plural('sample', n_added)} from {len(contexts)} {p.plural('study', len(contexts))}")
+
+        console.print(
+            panel.fit(
+                f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] building the AMR gene abundance matrix.",
+                title="Done",
+                border_style="green", title_align="right"
+            ),
+            style='italic'
+        )
+    else:
+        logger.error(f"{common.EMOJI_CROSS} Studies not found, is the provided {args.base_dir} directory correct?")
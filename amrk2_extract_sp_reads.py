@@ -1,29 +1,30 @@
 #!/usr/bin/python
 
 import argparse
-import inflect
 import os
 
 from rich.console import Group
-from rich.live import Live
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
-from rich.traceback import install
+from rich.progress import SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
 import common
-from get_info import names_list, make_dict
+import project_index
+import extract_pool
+import kraken_out_bin
+from get_info import make_dict
+from kraken_utils import clade_counts, clade_taxids, read_kreport
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Rich traceback handler
-install(show_locals=True)
+common.install_traceback()
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 
-# Initiate Progress() object for n_studies
-progress = Progress(
+# Initiate the progress bar for n_studies (logged instead of drawn without the Rich backend)
+progress = common.new_progress(
     SpinnerColumn(spinner_name='dots12', style='blue'),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -35,14 +36,110 @@ progress = Progress(
 
 # extract_kraken_reads.py -k ansi_11_irl/kraken_out/IRL_R1/IRL_R1.out -r ansi_11_irl/kraken_out/IRL_R1/IRL_R1.report -1 ansi_11_irl/hostile_out/IRL_R1_R1.clean_1.fastq.gz -2 ansi_11_irl/hostile_out/IRL_R1_R1.clean_1.fastq.gz -o test_IRL_R1.fq -o2 test_IRL_R1_2.fq --fastq-output -t 239935 --include-children
 
+# Per-read Kraken2 output for a species: the text .out, or a filtered copy materialised from the .kbin store
+def kraken_out_file(sample, tax_id, sp_dir):
+    out_file = f"{kraken_out}/{sample}/{sample}.out"
+    kbin_dir = f"{kraken_out}/{sample}/{sample}.kbin"
+    if os.path.exists(out_file) or not os.path.isdir(kbin_dir):
+        return out_file
+
+    kbin = kraken_out_bin.open_kbin(kbin_dir)
+    taxids = clade_taxids(read_kreport(f"{kraken_out}/{sample}/{sample}.report"), tax_id)
+    out_file = f"{sp_dir}/{sample}.out"
+    kraken_out_bin.write_out(kbin, out_file, kraken_out_bin.reads_in_taxa(kbin, taxids))
+    return out_file
+
+# Modification time (ns) and size of a sample's Kraken2 report, as strings; None without a report
+def report_stamp(sample):
+    report = f"{kraken_out}/{sample}/{sample}.report"
+    if not os.path.exists(report):
+        return None
+    stat = os.stat(report)
+    return (str(stat.st_mtime_ns), str(stat.st_size))
+
+# Build the (species, sample) extraction plan, loading each sample's Kraken2 report once
+# Pairs below min_reads clade reads are recorded in skipped_file with their report's mtime and size, and are
+# re-evaluated on reruns only when the report has changed (re-classified or re-scored) since
+def plan_extraction(samples, min_reads, skipped_file):
+    skipped = {}
+    if os.path.exists(skipped_file):
+        with open(skipped_file) as f:
+            next(f)  # Skip the header row
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # Entries without a report stamp (older files) are re-evaluated once
+                stamp = tuple(fields[5:7]) if len(fields) >= 7 else None
+                skipped[tuple(fields[:3])] = {'line': line, 'clade_reads': int(fields[4]), 'stamp': stamp}
+
+    counts, stamps = {}, {}
+    plan = {species: [] for species in sp_IDs_dict}
+    stale, new_skips = set(), []
+    for species, tax_id in sp_IDs_dict.items():
+        for sample in samples:
+            if sample not in stamps:
+                stamps[sample] = report_stamp(sample)
+            # Still below the threshold, with the report it was evaluated on
+            entry = skipped.get((study, species, sample))
+            if entry and entry['stamp'] is not None and entry['stamp'] == stamps[sample] and entry['clade_reads'] < min_reads:
+                continue
+            if entry:
+                stale.add((study, species, sample))
+            if sample not in counts:
+                if stamps[sample] is not None:
+                    counts[sample] = clade_counts(f"{kraken_out}/{sample}/{sample}.report")
+                else:
+                    logger.warning(f"{common.EMOJI_WARNING} No Kraken2 report for [yellow]{sample}[/yellow]. Not scheduling its extractions...")
+                    counts[sample] = None
+            if counts[sample] is None:
+                continue
+            clade_reads = counts[sample].get(str(tax_id), 0)
+            if clade_reads >= min_reads:
+                plan[species].append(sample)
+            else:
+                new_skips.append(f"{study}\t{species}\t{sample}\t{tax_id}\t{clade_reads}\t{stamps[sample][0]}\t{stamps[sample][1]}\n")
+
+    # Rewritten without the re-evaluated entries, so skips of changed reports do not linger
+    if new_skips or stale:
+        tmp_file = common.tmp_path(skipped_file)
+        with open(tmp_file, 'w') as f:
+            f.write("study\tspecies\tsample\ttax_id\tclade_reads\treport_mtime_ns\treport_size\n")
+            f.writelines([entry['line'] for key, entry in skipped.items() if key not in stale] + new_skips)
+        os.replace(tmp_file, skipped_file)
+    n_planned = sum(len(planned) for planned in plan.values())
+    logger.info(f"{common.EMOJI_SPARKLE} Scheduled {n_planned} {p.plural('extraction', n_planned)}, skipped {len(new_skips)} new (species, sample) {p.plural('pair', len(new_skips))} below {min_reads} clade {p.plural('read', min_reads)}")
+    return plan
+
+# Jobs for the persistent extraction pool: one per sample, covering every species still to extract
+def pool_jobs(samples):
+    jobs = {}
+    for species, sp_samples in plan.items():
+        sp_dir = f"{amrk2_sp_reads}/{species}"
+        os.makedirs(sp_dir, exist_ok=True)
+        for sample in sp_samples:
+            if any(os.path.exists(f"{sp_dir}/{file}") for file in [f"{sample}_2.fq.gz", f"{sample}.fq.gz"]):
+                continue
+            if sample not in jobs:
+                jobs[sample] = {
+                    'study': study,
+                    'sample': sample,
+                    'report': f"{kraken_out}/{sample}/{sample}.report",
+                    'out_prefix': f"{kraken_out}/{sample}/{sample}",
+                    'read1': f"{hostile_out}/{sample}_R1.clean_1.fastq.gz",
+                    'read2': f"{hostile_out}/{sample}_R2.clean_2.fastq.gz",
+                    'species': [],
+                }
+            jobs[sample]['species'].append((species, sp_IDs_dict[species], sp_dir))
+    return [jobs[sample] for sample in samples if sample in jobs]
+
 # Extract reads function
 def extract_sp_reads(sub_list, status_sub):
-    for species in sub_list:
+    for i_species, species in enumerate(sub_list, 1):
         sp_dir = f"{amrk2_sp_reads}/{species}"
         os.makedirs(sp_dir, exist_ok=True)
         tax_id = sp_IDs_dict[species]
-        for sample in samples:
-            status_sub.update(f"[i][dim]Extracting reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] ({samples.index(sample)+1}/{len(samples)})[dim] for species[/dim] [green]{species}[/green][dim]: ({sub_list.index(species)+1}/{len(sub_list)}) [/dim][/i]", spinner='point', spinner_style='magenta')
+        sp_samples = plan[species]
+        for i_sample, sample in enumerate(sp_samples, 1):
+            status_sub.update(f"[i][dim]Extracting reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] ({i_sample}/{len(sp_samples)})[dim] for species[/dim] [green]{species}[/green][dim]: ({i_species}/{len(sub_list)}) [/dim][/i]", spinner='point', spinner_style='magenta')
 
             if any(file in os.listdir(sp_dir) for file in [f"{sample}_2.fq.gz", f"{sample}.fq.gz"]):
                 # logger.info(f"{common.EMOJI_CHECK} {species} reads already extracted for [green]{sample}[/green]. Skipping...")
@@ -50,7 +147,7 @@ def extract_sp_reads(sub_list, status_sub):
             elif any(file in os.listdir(sp_dir) for file in [f"{sample}_2.fq", f"{sample}.fq"]):
                 # logger.info(f"{common.EMOJI_CHECK} {species} reads already extracted for [green]{sample}[/green] but uncompressed...")
                 
-                status_sub.update(f"[i][dim]Compressing extracted reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] ({samples.index(sample)+1}/{len(samples)})[dim] for species[/dim] [green]{species}[/green][dim]: ({sub_list.index(species)+1}/{len(sub_list)}) [/dim][/i]", spinner='toggle10', spinner_style='sky_blue2')
+                status_sub.update(f"[i][dim]Compressing extracted reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] ({i_sample}/{len(sp_samples)})[dim] for species[/dim] [green]{species}[/green][dim]: ({i_species}/{len(sub_list)}) [/dim][/i]", spinner='toggle10', spinner_style='sky_blue2')
                 common.run_command(
                     f"pigz {sp_dir}/{sample}_*fq",
                     desc=f"Compressing {species} - {sample} reads"
@@ -58,14 +155,17 @@ def extract_sp_reads(sub_list, status_sub):
                 status_sub.update(f"[i][dim]Compressed the extracted reads. Waiting for other processes to finish [/dim][/i]", spinner='toggle9', spinner_style='blue')
             else:
                 logger.info(f"{common.EMOJI_PROCESS} Extracting reads of [green]{species}[/green] from [blue]{sample}[/blue]...")
+                out_file = kraken_out_file(sample, tax_id, sp_dir)
                 common.run_command(
-                    f"mamba run -n {utility_paths['krakentools']} extract_kraken_reads_mod.py -k {kraken_out}/{sample}/{sample}.out -r {kraken_out}/{sample}/{sample}.report -1 {hostile_out}/{sample}_R1.clean_1.fastq.gz -2 {hostile_out}/{sample}_R2.clean_2.fastq.gz -o {sp_dir}/{sample}_1.fq -o2 {sp_dir}/{sample}_2.fq --fastq-output -t {tax_id} --include-children",
+                    f"mamba run -n {utility_paths['krakentools']} extract_kraken_reads_mod.py -k {out_file} -r {kraken_out}/{sample}/{sample}.report -1 {hostile_out}/{sample}_R1.clean_1.fastq.gz -2 {hostile_out}/{sample}_R2.clean_2.fastq.gz -o {sp_dir}/{sample}_1.fq -o2 {sp_dir}/{sample}_2.fq --fastq-output -t {tax_id} --include-children",
                     desc=f"Extracting {species} reads from {sample}"
                 )
+                if out_file.startswith(sp_dir):
+                    os.remove(out_file)
                 
                 console.rule(f"[dim i]{common.EMOJI_CHECK} Extracted reads of [green]{species}[/green] from [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
                     
-                status_sub.update(f"[i][dim]Compressing extracted reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] ({samples.index(sample)+1}/{len(samples)})[dim] for species[/dim] [green]{species}[/green][dim]: ({sub_list.index(species)+1}/{len(sub_list)}) [/dim][/i]", spinner='toggle10', spinner_style='sky_blue2')
+                status_sub.update(f"[i][dim]Compressing extracted reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] ({i_sample}/{len(sp_samples)})[dim] for species[/dim] [green]{species}[/green][dim]: ({i_species}/{len(sub_list)}) [/dim][/i]", spinner='toggle10', spinner_style='sky_blue2')
                 common.run_command(
                     f"pigz {sp_dir}/{sample}_*fq",
                     desc=f"Compressing {species} - {sample} reads"
@@ -84,6 +184,8 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
     parser.add_argument("-u", "--utility_paths", help="Envs or Paths for tools and DBs as a CSV file. (Default: utility_paths.csv)", default="utility_paths.csv")
     parser.add_argument("-c", "--species", help="Species list file (Default: species_list.csv)", default="species_list.csv")
+    parser.add_argument("-m", "--min_reads", type=int, default=1, help="Minimum clade reads of a species in a sample's Kraken2 report to extract it (Default: 1)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Use a persistent pool of this many in-process extraction workers instead of extract_kraken_reads_mod.py threads; 0 picks the size from cores and disk throughput (Default: off)")
     parser.add_argument("-t", "--threads", type=int, default=1, help="Number of threads (Default: 1)")
     parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3,5,10,20,30,40,50,60,70,80,90,100], nargs="?", default=1, help="Number of sub_lists to make, and run concurrently (Default: no splitting, everything as one list).")
     args=parser.parse_args()
@@ -129,31 +231,28 @@ if __name__ == "__main__":
     else:
         base_dir = os.path.join(os.getcwd(), args.base_dir)
 
-    if args.projects in os.listdir(base_dir):
-        logger.info(f"{common.EMOJI_SPARKLE} Found project file [bold blue]{args.projects}[/] in [bold blue]{args.base_dir}[/]")
-        base_dirs = [base_dir]
-    else:
-        logger.info(f"{common.EMOJI_PROCESS} [bold blue]{args.projects}[/] not in [bold blue]{args.base_dir}[/], searching subdirectories.")
-        # It may work only for one sub-level
-        base_dirs = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if args.projects in os.listdir(os.path.join(base_dir, d))]
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    base_dirs = project_index.base_dirs(index)
 
     # Main status
     status = console.status(f"[i][dim]Initiating read extraction on[/dim] {len(base_dirs)} [dim] study {p.plural('type', len(base_dirs))}[/dim][/i]")
     
-    # Per-study statuses
-    status_subs = []
-    for i in range(split_size):
-        status_subs.append(console.status(f"[i][dim]Starting KrakenTools on thread {i+1}...[/dim][/i]"))
+    # Per-worker statuses, rendered together as one table
+    board = common.StatusBoard(split_size, "[i][dim]Starting KrakenTools...[/dim][/i]")
+    status_subs = board.slots
 
-    with Live(panel(Group(status, progress, *status_subs)), console=console, transient=True):
+    # Persistent extraction pool, started on first use
+    pool = None
+
+    with common.live(panel(Group(status, progress, board)), refresh_per_second=common.BOARD_REFRESH):
         if base_dirs:
-            for base in base_dirs:
-                status.update(f"[i][dim]Running KrakenTools on[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]datasets ({base_dirs.index(base)+1}/{len(base_dirs)})[/dim][/i]")
+            for i_base, base in enumerate(base_dirs, 1):
+                status.update(f"[i][dim]Running KrakenTools on[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]datasets ({i_base}/{len(base_dirs)})[/dim][/i]")
 
                 console.rule(f"Extracting reads from all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
 
-                studies_in = os.path.join(base, args.projects)
-                studies = names_list(studies_in)
+                studies = project_index.studies(index, base)
                 console.print(
                     panel.fit(
                         f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(studies)}[/] [dim]studies in[/] {os.path.basename(base)} [dim]dir[/]", 
@@ -176,18 +275,33 @@ if __name__ == "__main__":
                     os.makedirs(kraken_out, exist_ok=True)
                     os.makedirs(amrk2_sp_reads, exist_ok=True)
 
-                    samples = names_list(f"{base}/{study}/{samples_in}")
+                    samples = project_index.samples(index, base, study)
                     samples_count = len(samples)
                     logger.info(f"{common.EMOJI_SPARKLE} Project [bold blue]{study}[/] has {samples_count} {p.plural('sample', samples_count)}...")
 
-                    species_all = list(sp_IDs_dict.keys())
+                    # Only species present in at least one sample's report get a worker slot
+                    plan = plan_extraction(samples, args.min_reads, f"{amrk2_sp_reads}/skipped_pairs.tsv")
+                    species_all = [species for species in sp_IDs_dict if plan[species]]
                     console.print(f"Total species: {len(species_all)}", style='italic dim')
 
                     # sample_lists = common.get_split_size(split_size, samples)
                     species_lists = common.get_split_size(split_size, species_all)
 
                     # Extract species reads
-                    common.run_concurrently(extract_sp_reads, split_size, species_lists, status_subs=status_subs)
+                    if args.workers is None:
+                        common.run_concurrently(extract_sp_reads, split_size, species_lists, status_subs=status_subs)
+                    else:
+                        jobs = pool_jobs(samples)
+                        if jobs and pool is None:
+                            pool_size = args.workers or extract_pool.auto_pool_size(jobs[0]['read1'])
+                            pool = extract_pool.start_pool(pool_size)
+                            logger.info(f"{common.EMOJI_PROCESS} Started {pool_size} extraction {p.plural('worker', pool_size)}...")
+                        status.update(f"[i][dim]Extracting reads from[/dim] {len(jobs)} [dim]samples of[/dim] [blue]{study}[/blue] [dim]with the worker pool[/dim][/i]")
+                        for result in extract_pool.run_jobs(pool, jobs) if jobs else []:
+                            if result['error']:
+                                logger.error(f"{common.EMOJI_CROSS} Extraction failed for [red]{result['sample']}[/red]: {result['error']}")
+                            else:
+                                logger.info(f"{common.EMOJI_CHECK} Extracted {sum(result['counts'].values())} read pairs of {len(result['counts'])} species from [green]{result['sample']}[/green] in {result['seconds']/60:.2f} minutes")
 
                     # Status to deal with empty processes
                     for status_sub in status_subs:
@@ -200,6 +314,9 @@ if __name__ == "__main__":
                 status.update(f"[i green dim]Processed [cyan b]{os.path.basename(base)}[/cyan b] studies[/i green dim]")
                 
             
+            if pool is not None:
+                extract_pool.stop_pool(pool)
+
             console.print(
                 panel.fit(
                     f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] Read Extraction.", 
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# Per-tool threads and concurrency from recorded run metrics ({base_dir}/run_metrics.tsv, written by common.run_command)
+# Each tool's time per GB of input is fitted as serial + parallel / threads (Amdahl) from runs of similar input size,
+# and the threads x concurrency that maximises samples/hour on the node's cores is chosen, up to the runner's split_size.
+
+import argparse
+import csv
+import os
+import statistics
+
+from rich.table import Table
+
+import common
+from get_info import make_dict
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+METRICS_FILE = "run_metrics.tsv"
+
+# Samples/hour within this fraction of the best are considered equal, and the smaller footprint wins
+TOLERANCE = 0.02
+
+# Recorded runs of a tool: (threads, input GB, wall seconds)
+def read_metrics(metrics_file, tool):
+    if not os.path.exists(metrics_file):
+        return []
+    with open(metrics_file, newline='') as f:
+        return [(int(row['threads']), int(row['input_bytes']) / 1024**3, float(row['wall'])) for row in csv.DictReader(f, delimiter='\t') if row['tool'] == tool and int(row['input_bytes']) > 0]
+
+# Fit seconds per GB = serial + parallel / threads on the median of each thread count
+# Runs within 4x of input_gb are used when they cover at least two thread counts, otherwise all runs
+def fit_curve(runs, input_gb):
+    similar = [run for run in runs if input_gb / 4 <= run[1] <= input_gb * 4]
+    if len({run[0] for run in similar}) >= 2:
+        runs = similar
+    by_threads = {}
+    for n_threads, gb, wall in runs:
+        by_threads.setdefault(n_threads, []).append(wall / gb)
+    if not by_threads:
+        return None
+    points = [(1 / n_threads, statistics.median(values)) for n_threads, values in sorted(by_threads.items())]
+    if len(points) == 1:
+        return {'serial': points[0][1], 'parallel': 0.0, 'threads': list(by_threads), 'runs': len(runs)}
+
+    # Least squares on x = 1/threads
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    parallel = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x)
+    serial = max(0.0, mean_y - parallel * mean_x)
+    return {'serial': serial, 'parallel': parallel, 'threads': sorted(by_threads), 'runs': len(runs)}
+
+# Predicted seconds for one sample of input_gb at n_threads
+def sample_seconds(curve, n_threads, input_gb):
+    return input_gb * (curve['serial'] + curve['parallel'] / n_threads)
+
+# Best threads x concurrency for a tool on `cores` cores: only measured thread counts without a fitted curve,
+# and up to twice the largest measured one with it
+def choose(curve, input_gb, cores, max_split):
+    if len(curve['threads']) == 1:
+        candidates = [min(curve['threads'][0], cores)]
+    else:
+        candidates = range(1, min(cores, 2 * max(curve['threads'])) + 1)
+    options = []
+    for n_threads in candidates:
+        split_size = max(1, min(max_split, cores // n_threads))
+        seconds = sample_seconds(curve, n_threads, input_gb)
+        rate = split_size * 3600 / seconds if seconds > 0 else 0
+        options.append({'threads': n_threads, 'split_size': split_size, 'samples_per_hour': rate})
+    best = max(option['samples_per_hour'] for option in options)
+    # Among near-best options, use the fewest cores
+    near = [option for option in options if option['samples_per_hour'] >= best * (1 - TOLERANCE)]
+    return min(near, key=lambda option: (option['threads'] * option['split_size'], option['threads']))
+
+# Parse a per-tool override: "8" (threads) or "8x2" (threads x concurrency)
+def parse_override(value):
+    n_threads, _, split_size = value.lower().partition('x')
+    return int(n_threads), int(split_size) if split_size else None
+
+# Threads and concurrency per tool. Overrides (tool: "8" or "8x2") win, then fitted curves, then the defaults
+# defaults: {tool: threads}; sizes: {tool: typical input bytes per run}; concurrency never exceeds max_split
+def plan(metrics_file, defaults, sizes, cores, max_split, overrides=None):
+    overrides = overrides or {}
+    tuned = {}
+    for tool, default_threads in defaults.items():
+        input_gb = max(sizes.get(tool, 0), 1) / 1024**3
+        if tool in overrides:
+            n_threads, split_size = parse_override(overrides[tool])
+            split_size = min(split_size or max(1, min(max_split, cores // n_threads)), max_split)
+            tuned[tool] = {'threads': n_threads, 'split_size': split_size, 'samples_per_hour': None, 'source': 'override'}
+            continue
+        curve = fit_curve(read_metrics(metrics_file, tool), input_gb)
+        if curve is None:
+            tuned[tool] = {'threads': default_threads, 'split_size': max_split, 'samples_per_hour': None, 'source': 'default'}
+            continue
+        setting = choose(curve, input_gb, cores, max_split)
+        setting['source'] = f"fit on {curve['runs']} {p.plural('run', curve['runs'])}"
+        setting['seconds'] = sample_seconds(curve, setting['threads'], input_gb)
+        tuned[tool] = setting
+    return tuned
+
+# Concurrency of a queue running several tools per sample: an overridden one, else that of its slowest measured tool
+def queue_split(tuned, tools):
+    fixed = [tool for tool in tools if tuned[tool]['source'] == 'override']
+    if fixed:
+        return min(tuned[tool]['split_size'] for tool in fixed)
+    measured = [tool for tool in tools if tuned[tool].get('seconds')]
+    if not measured:
+        return min(tuned[tool]['split_size'] for tool in tools)
+    return tuned[max(measured, key=lambda tool: tuned[tool]['seconds'])]['split_size']
+
+# Log the tuned settings
+def show_plan(tuned):
+    table = Table(title="Tool threads", title_style='dim', border_style='dim cyan')
+    for column in ["Tool", "Threads", "Concurrency", "Samples/hour", "Source"]:
+        table.add_column(column)
+    for tool, setting in tuned.items():
+        rate = f"{setting['samples_per_hour']:.1f}" if setting['samples_per_hour'] else "-"
+        table.add_row(tool, str(setting['threads']), str(setting['split_size']), rate, setting['source'])
+    console.print(table)
+
+# Usable cores of this process
+def available_cores():
+    return len(os.sched_getaffinity(0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Suggest per-tool threads and concurrency from recorded run metrics...")
+    parser.add_argument("-m", "--metrics", help=f"Run metrics TSV. (Default: all_data/{METRICS_FILE})", default=f"all_data/{METRICS_FILE}")
+    parser.add_argument("-i", "--tools", nargs="+", default=['BBDuk', 'fastp', 'Hostile', 'Kraken2'], help="Tools to tune (Default: BBDuk fastp Hostile Kraken2)")
+    parser.add_argument("-g", "--input_gb", type=float, default=5, help="Typical input per sample in GB (Default: 5)")
+    parser.add_argument("-c", "--cores", type=int, default=available_cores(), help="Cores of the node (Default: all usable cores)")
+    parser.add_argument("-l", "--split_size", type=int, default=3, help="Maximum concurrency (Default: 3)")
+    parser.add_argument("-o", "--tool_threads", help="Per-tool overrides as a tool,threads CSV; threads may be '8x2' for 8 threads x 2 concurrent (Default: none)", default=None)
+    args = parser.parse_args()
+
+    overrides = make_dict(args.tool_threads) if args.tool_threads else {}
+    tuned = plan(args.metrics, {tool: max(1, args.cores // args.split_size) for tool in args.tools}, {tool: args.input_gb * 1024**3 for tool in args.tools}, args.cores, args.split_size, overrides)
+    show_plan(tuned)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+# Rewrite gzipped FASTQs as BGZF, with a sidecar read index ({file}.ridx.npy)
+# BGZF files are still valid gzip files, so existing consumers read them unchanged, but they are made
+# of independent <64 KB blocks: they can be decompressed in parallel and read from any block.
+# The index maps every `step`-th read number to a BGZF virtual offset (block start << 16 | offset in block).
+
+import argparse
+import concurrent.futures
+import gzip
+import os
+import struct
+import zlib
+import numpy as np
+
+import common
+
+# Using logger from common.py
+logger = common.logger
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+BLOCK_SIZE = 65280
+INDEX_STEP = 10000
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Compress one block of uncompressed data into a BGZF block
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+# Uncompressed blocks of a (possibly multi-member) gzip file
+def read_blocks(in_file, block_size=BLOCK_SIZE):
+    with gzip.open(in_file, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            yield data
+
+# Rewrite a gzipped FASTQ as BGZF, compressing blocks in parallel, and build its read index
+def rewrite_bgzf(in_file, out_file, threads=1, step=INDEX_STEP):
+    tmp_file = f"{out_file}.tmp"
+    index = []
+    # at_line_start: the previous block ended with a newline, so offset 0 of the next block starts a line
+    state = {'lines': 0, 'offset': 0, 'at_line_start': True}
+
+    def write_batch(out, executor, batch):
+        for data, block in zip(batch, executor.map(compress_block, batch)):
+            # Record starts are the lines whose number is a multiple of 4
+            # A block that continues the previous block's last line starts its first new line at line `lines` + 1
+            starts = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10) + 1
+            starts = starts[starts < len(data)]
+            first_line = state['lines']
+            if state['at_line_start']:
+                starts = np.r_[0, starts]
+            else:
+                first_line += 1
+            state['at_line_start'] = data.endswith(b'\n')
+            for start, line_number in zip(starts, first_line + np.arange(len(starts))):
+                if line_number % 4 == 0 and (line_number // 4) % step == 0:
+                    index.append((line_number // 4, (state['offset'] << 16) | int(start)))
+            state['lines'] += data.count(b'\n')
+            out.write(block)
+            state['offset'] += len(block)
+
+    with open(tmp_file, 'wb') as out, concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        batch = []
+        for data in read_blocks(in_file):
+            batch.append(data)
+            if len(batch) == threads * 16:
+                write_batch(out, executor, batch)
+                batch = []
+        write_batch(out, executor, batch)
+        out.write(BGZF_EOF)
+    n_lines, offset = state['lines'], state['offset']
+    os.replace(tmp_file, out_file)
+    index.append((n_lines // 4, offset << 16))
+    np.save(f"{out_file}.ridx.npy", np.asarray(index, dtype=np.int64))
+    return n_lines // 4
+
+# Offsets and sizes of all BGZF blocks, from the block headers only
+def block_offsets(in_file):
+    offsets = []
+    with open(in_file, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(18)
+            if len(header) < 18:
+                break
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            offsets.append((offset, block_size))
+            offset += block_size
+            f.seek(offset)
+    return offsets
+
+# Decompress one BGZF block
+def decompress_block(raw):
+    return zlib.decompress(raw[18:-8], -15)
+
+# Read n_reads FASTQ records starting at read number start_read, seeking through the index
+def read_range(in_file, start_read, n_reads):
+    index = np.load(f"{in_file}.ridx.npy")
+    entry = max(int(np.searchsorted(index[:, 0], start_read, side='right')) - 1, 0)
+    read_number, voffset = int(index[entry, 0]), int(index[entry, 1])
+    block_start, within = voffset >> 16, voffset & 0xffff
+
+    records = []
+    lines = []
+    buffer = b""
+    with open(in_file, 'rb') as f:
+        f.seek(block_start)
+        while len(records) < n_reads:
+            header = f.read(18)
+            if len(header) < 18:
+                break
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            data = decompress_block(header + f.read(block_size - 18))
+            if within:
+                data, within = data[within:], 0
+            buffer += data
+            *complete, buffer = buffer.split(b'\n')
+            lines.extend(complete)
+            while len(lines) >= 4 and len(records) < n_reads:
+                record, lines = lines[:4], lines[4:]
+                if read_number >= start_read:
+                    records.append(b'\n'.join(record) + b'\n')
+                read_number += 1
+    return records
+
+# Read every indexed record through the index and compare it with the same record read sequentially;
+# returns the read numbers that do not match
+def verify_index(in_file):
+    index = np.load(f"{in_file}.ridx.npy")
+    wanted = set(int(read_number) for read_number in index[:-1, 0])
+    expected = {}
+    with gzip.open(in_file, 'rb') as f:
+        read_number = 0
+        while len(expected) < len(wanted):
+            record = b''.join(f.readline() for _ in range(4))
+            if not record:
+                break
+            if read_number in wanted:
+                expected[read_number] = record
+            read_number += 1
+    return [read_number for read_number in sorted(wanted) if read_range(in_file, read_number, 1) != [expected.get(read_number)]]
+
+# Split a BGZF FASTQ into n read ranges of roughly equal size, for sharded readers
+def split_ranges(in_file, n):
+    index = np.load(f"{in_file}.ridx.npy")
+    total = int(index[-1, 0])
+    bounds = [total * i // n for i in range(n + 1)]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(n)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite gzipped FASTQs as BGZF with a random-access read index...")
+    parser.add_argument("-i", "--input", nargs="+", help="Gzipped FASTQ files to rewrite in place.", required=True)
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of compression processes (Default: 1)")
+    parser.add_argument("-n", "--step", type=int, default=INDEX_STEP, help=f"Index every n-th read (Default: {INDEX_STEP})")
+    args = parser.parse_args()
+
+    for in_file in args.input:
+        if os.path.exists(f"{in_file}.ridx.npy"):
+            logger.info(f"{common.EMOJI_CHECK} [green]{in_file}[/green] is already indexed. Skipping...")
+            continue
+        logger.info(f"{common.EMOJI_ZIP} Rewriting [blue]{in_file}[/blue] as BGZF...")
+        n_reads = rewrite_bgzf(in_file, in_file, args.threads, args.step)
+        mismatched = verify_index(in_file)
+        if mismatched:
+            os.remove(f"{in_file}.ridx.npy")
+            logger.error(f"{common.EMOJI_CROSS} Index of [red]{in_file}[/red] does not match {len(mismatched)} {common.inflector.plural('record', len(mismatched))} (first: read {mismatched[0]}), removed it")
+            continue
+        logger.info(f"{common.EMOJI_CHECK} Indexed {n_reads} reads of [green]{in_file}[/green]")
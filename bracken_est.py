@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+# In-process Bracken abundance re-estimation
+# Follows Bracken's est_abundance.py, but loads the kmer_distrib file once into NumPy arrays
+# and re-estimates any number of samples and levels against it
+
+import argparse
+import os
+import numpy as np
+
+
+import common
+import project_index
+from kraken_utils import MAIN_LVLS, read_kreport, resolve_rank_codes
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+# Level names used by bracken for the --out-report files
+LEVEL_NAMES = {'D': 'domains', 'P': 'phylums', 'C': 'classes', 'O': 'orders', 'F': 'families', 'G': 'genuses', 'S': 'species'}
+
+# Load a Bracken kmer_distrib file into flat arrays (mapped taxid, genome taxid, fraction of genome kmers)
+def load_kmer_distrib(db_path, read_len=100):
+    in_file = os.path.join(db_path, f"database{read_len}mers.kmer_distrib")
+    mapped, genomes, fractions = [], [], []
+    with open(in_file) as f:
+        next(f)  # Skip the header row
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                continue
+            entries = fields[1].split()
+            mapped.extend([int(fields[0])] * len(entries))
+            for entry in entries:
+                g_taxid, m_kmers, t_kmers = entry.split(':')
+                genomes.append(int(g_taxid))
+                fractions.append(float(m_kmers) / float(t_kmers))
+    logger.info(f"{common.EMOJI_SPARKLE} Loaded {len(fractions)} kmer distribution entries from [i dim]{in_file}[/]")
+    return {
+        'mapped': np.asarray(mapped, dtype=np.int64),
+        'genome': np.asarray(genomes, dtype=np.int64),
+        'fraction': np.asarray(fractions, dtype=np.float64),
+    }
+
+# Collect the level taxa, the taxa mapped onto them, and the nodes whose reads get redistributed
+def parse_level(nodes, level, thresh):
+    codes = resolve_rank_codes(nodes)
+    branch_lvl = MAIN_LVLS.index(level)
+    lvl_nodes = []      # node indices of level taxa passing the threshold
+    map2lvl = {}        # taxid -> position in lvl_nodes
+    distribute = {}     # taxid -> taxon-level reads of nodes above the level
+    under_lvl = [False] * len(nodes)
+    last_lvl = -1
+
+    for i, node in enumerate(nodes):
+        code = codes[i]
+        if code == 'U':
+            continue
+        parent = node['parent']
+        under_lvl[i] = code == level or (parent is not None and under_lvl[parent])
+        taxid = int(node['taxid'])
+        if code == level:
+            if node['clade'] < thresh:
+                last_lvl = -1
+            else:
+                last_lvl = len(lvl_nodes)
+                lvl_nodes.append(i)
+                map2lvl[taxid] = last_lvl
+        elif code[0] in MAIN_LVLS and MAIN_LVLS.index(code[0]) >= branch_lvl:
+            if last_lvl != -1:
+                map2lvl[taxid] = last_lvl
+        if not under_lvl[i]:
+            distribute[taxid] = node['taxon']
+    return lvl_nodes, map2lvl, distribute
+
+# Re-estimate abundances of one report at one level
+def estimate_level(nodes, kmer_distr, level='S', thresh=10):
+    lvl_nodes, map2lvl, distribute = parse_level(nodes, level, thresh)
+    n_lvl = len(lvl_nodes)
+    clade = np.array([nodes[i]['clade'] for i in lvl_nodes], dtype=np.float64)
+    added = np.zeros(n_lvl, dtype=np.float64)
+
+    if n_lvl and distribute:
+        # Map every genome of the kmer distribution onto a level taxon (or drop it)
+        lvl_keys = np.fromiter(map2lvl.keys(), dtype=np.int64, count=len(map2lvl))
+        lvl_vals = np.fromiter(map2lvl.values(), dtype=np.int64, count=len(map2lvl))
+        order = np.argsort(lvl_keys)
+        lvl_keys, lvl_vals = lvl_keys[order], lvl_vals[order]
+        pos = np.minimum(np.searchsorted(lvl_keys, kmer_distr['genome']), len(lvl_keys) - 1)
+        hit = lvl_keys[pos] == kmer_distr['genome']
+        mapped = kmer_distr['mapped'][hit]
+        lvl_idx = lvl_vals[pos[hit]]
+        fraction = kmer_distr['fraction'][hit]
+
+        # Average the fractions of genomes that collapse onto the same level taxon
+        pair_keys, pair_inv = np.unique(mapped * (n_lvl + 1) + lvl_idx, return_inverse=True)
+        fraction = np.bincount(pair_inv, weights=fraction) / np.bincount(pair_inv)
+        mapped, lvl_idx = pair_keys // (n_lvl + 1), pair_keys % (n_lvl + 1)
+
+        # Fraction of each level taxon's kmers that are unique to it
+        lvl_taxids = np.array([int(nodes[i]['taxid']) for i in lvl_nodes], dtype=np.int64)
+        self_hit = mapped == lvl_taxids[lvl_idx]
+        lvl_fraction = np.ones(n_lvl, dtype=np.float64)
+        lvl_fraction[lvl_idx[self_hit]] = fraction[self_hit]
+
+        # Only reads classified above the level get redistributed
+        dist_keys = np.fromiter(distribute.keys(), dtype=np.int64, count=len(distribute))
+        dist_reads = np.fromiter(distribute.values(), dtype=np.float64, count=len(distribute))
+        order = np.argsort(dist_keys)
+        dist_keys, dist_reads = dist_keys[order], dist_reads[order]
+        pos = np.minimum(np.searchsorted(dist_keys, mapped), len(dist_keys) - 1)
+        keep = dist_keys[pos] == mapped
+        mapped, lvl_idx, fraction, node_reads = mapped[keep], lvl_idx[keep], fraction[keep], dist_reads[pos[keep]]
+
+        # P(genome | read classified at node) ~ P(read at node | genome) * P(genome)
+        _, node_inv = np.unique(mapped, return_inverse=True)
+        est_reads = clade[lvl_idx] / lvl_fraction[lvl_idx]
+        all_genome_reads = np.bincount(node_inv, weights=est_reads)[node_inv]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prob = np.where(all_genome_reads > 0, fraction * est_reads / all_genome_reads, 0.0)
+            total_prob = np.bincount(node_inv, weights=prob)[node_inv]
+            add_reads = np.where(total_prob > 0, prob / total_prob * node_reads, 0.0)
+        added = np.bincount(lvl_idx, weights=add_reads, minlength=n_lvl)
+
+    new_reads = clade + added
+    return {
+        'level': level,
+        'nodes': [nodes[i] for i in lvl_nodes],
+        'node_idx': lvl_nodes,
+        'clade': clade,
+        'new_reads': new_reads,
+    }
+
+# Write the abundance table in bracken's -o format
+def write_bracken(out_file, est):
+    sum_all_reads = float(est['new_reads'].sum())
+    with open(out_file, 'w') as f:
+        f.write('name\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n')
+        for node, all_reads, new_all_reads in zip(est['nodes'], est['clade'], est['new_reads']):
+            fraction = new_all_reads / sum_all_reads if sum_all_reads else 0.0
+            f.write(f"{node['name']}\t{node['taxid']}\t{est['level']}\t{int(all_reads)}\t{int(new_all_reads) - int(all_reads)}\t{int(new_all_reads)}\t{fraction:0.5f}\n")
+
+# Write the re-estimated Kraken style report (bracken's --out-report), truncated at the level
+def write_bracken_report(out_file, nodes, est):
+    codes = resolve_rank_codes(nodes)
+    clade = [0] * len(nodes)
+    taxon = [0] * len(nodes)
+    for i, new_all_reads in zip(est['node_idx'], est['new_reads']):
+        reads = int(new_all_reads)
+        clade[i] = taxon[i] = reads
+        parent = nodes[i]['parent']
+        while parent is not None:
+            clade[parent] += reads
+            parent = nodes[parent]['parent']
+
+    children = {}
+    roots = []
+    for i, node in enumerate(nodes):
+        if clade[i] == 0 or (node['parent'] is not None and codes[node['parent']] == est['level']):
+            continue
+        if node['parent'] is None:
+            roots.append(i)
+        else:
+            children.setdefault(node['parent'], []).append(i)
+
+    sum_all_reads = sum(clade[i] for i in roots)
+    with open(out_file, 'w') as f:
+        stack = sorted(roots, key=lambda i: clade[i])
+        while stack:
+            i = stack.pop()
+            node = nodes[i]
+            pct = 100 * clade[i] / sum_all_reads if sum_all_reads else 0.0
+            f.write(f"{pct:0.2f}\t{clade[i]}\t{taxon[i]}\t{codes[i]}\t{node['taxid']}\t{'  ' * node['depth']}{node['name']}\n")
+            if codes[i] != est['level']:
+                stack.extend(sorted(children.get(i, []), key=lambda k: clade[k]))
+
+# Re-estimate one sample at several levels, writing the same files as run_kraken's Bracken step
+def estimate_sample(report, kmer_distr, levels=('S',), thresh=10, tag=""):
+    nodes = read_kreport(report)
+    prefix = report[:-len(".report")] if report.endswith(".report") else report
+    for level in levels:
+        est = estimate_level(nodes, kmer_distr, level, thresh)
+        lvl_tag = "" if level == 'S' else f"_{level}"
+        write_bracken(f"{prefix}{lvl_tag}{tag}.bracken", est)
+        write_bracken_report(f"{prefix}_bracken_{LEVEL_NAMES[level]}{tag}.report", nodes, est)
+    return len(levels)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-estimate abundances of Kraken2 reports with an in-process Bracken implementation...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-d", "--db", help="Kraken2 database directory with the Bracken kmer_distrib files.", required=True)
+    parser.add_argument("-r", "--read_len", type=int, default=100, help="Read length of the kmer_distrib file (Default: 100)")
+    parser.add_argument("-l", "--levels", nargs="+", choices=list(LEVEL_NAMES), default=['S'], help="Taxonomic levels to estimate (Default: S)")
+    parser.add_argument("-t", "--threshold", type=int, default=10, help="Minimum clade reads for a level taxon (Default: 10)")
+    parser.add_argument("-g", "--tag", default="", help="Suffix added to output file names, to keep alternative settings apart (Default: none)")
+    args = parser.parse_args()
+
+    console.print(
+        panel(
+            f"{common.EMOJI_SPARKLE} Re-estimating abundances with in-process Bracken...",
+            title=f"Study: {common.study_name.upper()}",
+            title_align="left",
+            border_style='dim bold yellow'
+        ),
+        style='italic dim'
+    )
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    base_dirs = project_index.base_dirs(index)
+
+    reports = []
+    for base in base_dirs:
+        for study in project_index.studies(index, base):
+            for sample in project_index.samples(index, base, study):
+                report = f"{base}/{study}/kraken_out/{sample}/{sample}.report"
+                if os.path.exists(report):
+                    reports.append(report)
+                else:
+                    logger.warning(f"{common.EMOJI_WARNING} No Kraken2 report for [yellow]{study}[/yellow] {common.EMOJI_PLAY} [yellow]{sample}[/yellow]. Skipping...")
+
+    if reports:
+        kmer_distr = load_kmer_distrib(args.db, args.read_len)
+        with common.progress:
+            task = common.progress.add_task(f"{common.EMOJI_PROCESS} Re-estimating {len(reports)} {p.plural('report', len(reports))} at {', '.join(args.levels)}", total=len(reports))
+            for report in reports:
+                estimate_sample(report, kmer_distr, args.levels, args.threshold, args.tag)
+                common.progress.update(task, advance=1)
+
+        console.print(
+            panel.fit(
+                f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] abundance re-estimation.",
+                title="Done",
+                border_style="green", title_align="right"
+            ),
+            style='italic'
+        )
+    else:
+        logger.error(f"{common.EMOJI_CROSS} No Kraken2 reports found, is the provided {args.base_dir} directory correct?")
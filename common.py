@@ -1,28 +1,200 @@
 #!/usr/bin/python
 
+import atexit
 import concurrent.futures
+import contextlib
+import functools
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import re
+import shlex
+import shutil
+import sqlite3
 import subprocess
+import sys
+import threading
 import time
+import traceback
+import types
 
 from datetime import datetime
 from rich.console import Console
+from rich.live import Live
+from rich.markup import escape
 from rich.panel import Panel
-from rich.pretty import Pretty
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn
-from rich.logging import RichHandler
+from rich.table import Table
+from rich.text import Text
 
-# Initiate Console() object
-console = Console()
+# Logging backend: 'rich' (default on a terminal), 'plain' or 'json' (JSON-lines; default 'plain' without a terminal)
+# Selected with MGA_LOG, and the level with MGA_LOG_LEVEL (Default: NOTSET for rich, INFO otherwise)
+LOG_BACKEND = os.environ.get('MGA_LOG') or ('rich' if sys.stderr.isatty() else 'plain')
+LOG_LEVEL = os.environ.get('MGA_LOG_LEVEL', 'NOTSET' if LOG_BACKEND == 'rich' else 'INFO').upper()
+
+# Rich markup tags and emoji codes, removed from plain and JSON records; escaped brackets (\[) are kept as text
+MARKUP = re.compile(r"(?<!\\)\[(?:/[\w .#=-]*|[a-z#][\w .#=-]*)\]|:[a-z_]+:")
+
+def strip_markup(text):
+    return MARKUP.sub('', text).replace('\\[', '[').strip()
+
+# Message of a record without markup; records logged with extra={'raw': True} (tool output) are kept as they are
+def record_message(record):
+    return record.getMessage() if getattr(record, 'raw', False) else strip_markup(record.getMessage())
+
+class PlainFormatter(logging.Formatter):
+    def format(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = record_message(record), None
+        return super().format(record)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            'level': record.levelname,
+            'message': record_message(record),
+            'module': record.module,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+# Seconds a buffered plain or JSON record waits at most before it is written
+LOG_FLUSH_SECONDS = 2
+
+# Buffered handler that is also flushed every interval seconds by a daemon thread, so records logged before a
+# long quiet stretch (a multi-hour tool run) reach the log file without waiting for the buffer to fill
+class TimedMemoryHandler(logging.handlers.MemoryHandler):
+    def __init__(self, capacity, interval, **kwargs):
+        super().__init__(capacity, **kwargs)
+        self.stopped = threading.Event()
+        threading.Thread(target=self.flush_every, args=(interval,), daemon=True).start()
+
+    def flush_every(self, interval):
+        while not self.stopped.wait(interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+
+# Log handler of the selected backend; plain and JSON records are buffered and flushed every 100 records,
+# every LOG_FLUSH_SECONDS, on warnings, and at exit
+def log_handler(backend):
+    if backend == 'rich':
+        from rich.logging import RichHandler
+        return RichHandler(show_time=False, rich_tracebacks=True, markup=True)
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if backend == 'json' else PlainFormatter("[%(asctime)s] %(levelname)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+    return TimedMemoryHandler(100, LOG_FLUSH_SECONDS, flushLevel=logging.WARNING, target=stream)
 
 # LOG format
-logging.basicConfig(level="NOTSET", format="[%(asctime)s]: %(message)s", datefmt="%Y-%m-%d %H:%M:%S", handlers=[RichHandler(show_time=False, rich_tracebacks=True, markup=True)])
+logging.basicConfig(level=LOG_LEVEL, format="[%(asctime)s]: %(message)s", datefmt="%Y-%m-%d %H:%M:%S", handlers=[log_handler(LOG_BACKEND)])
 logger = logging.getLogger('rich')
 
+# Text of a printed renderable: panels as "title: body", other rich renderables (tables) rendered without colour
+def plain_text(renderable):
+    if isinstance(renderable, str):
+        return renderable
+    if isinstance(renderable, Text):
+        return renderable.plain
+    if isinstance(renderable, Panel):
+        body = plain_text(renderable.renderable)
+        return f"{renderable.title}: {body}" if renderable.title else body
+    render = Console(width=120, color_system=None, highlight=False)
+    with render.capture() as capture:
+        render.print(renderable)
+    return capture.get().rstrip()
+
+# Worker status of the plain and JSON backends: only logged at debug level
+class LogStatus:
+    def update(self, status=None, **_):
+        if status:
+            logger.debug(strip_markup(str(status)))
+
+# Console of the plain and JSON backends: prints, rules and tracebacks go through the logger, so a batch log is one
+# stream in one format instead of log records interleaved with console output
+class LogConsole:
+    def print(self, *objects, **_):
+        text = ' '.join(plain_text(renderable) for renderable in objects)
+        if text.strip():
+            logger.info(text)
+
+    def rule(self, title="", **_):
+        if title:
+            logger.info(f"--- {title} ---")
+
+    def print_exception(self, **_):
+        logger.error(traceback.format_exc().rstrip(), extra={'raw': True})
+
+    def status(self, status="", **_):
+        return LogStatus()
+
+# Initiate Console() object; the plain and JSON backends log instead of printing
+console = Console() if LOG_BACKEND == 'rich' else LogConsole()
+
+# Progress bars of the plain and JSON backends: each update is logged as completed/total instead of drawn
+class LogProgress:
+    def __init__(self):
+        self.tasks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_task(self, description, total=None, **_):
+        task = len(self.tasks)
+        self.tasks[task] = {'description': description, 'total': total, 'completed': 0}
+        return task
+
+    def update(self, task, advance=None, completed=None, total=None, **_):
+        entry = self.tasks[task]
+        if total is not None:
+            entry['total'] = total
+        if completed is not None:
+            entry['completed'] = completed
+        if advance:
+            entry['completed'] += advance
+        if advance or completed is not None:
+            logger.info(f"{entry['description']}: {entry['completed']}/{entry['total'] if entry['total'] is not None else '?'}")
+
+# Progress bar of the selected backend (columns and options as for rich's Progress)
+def new_progress(*columns, **kwargs):
+    return Progress(*columns, **kwargs) if LOG_BACKEND == 'rich' else LogProgress()
+
+# Live display of a renderable for the Rich backend; nothing is built or refreshed for the plain and JSON backends
+def live(renderable, **kwargs):
+    if LOG_BACKEND == 'rich':
+        return Live(renderable, console=console, transient=True, **kwargs)
+    return contextlib.nullcontext()
+
+# Rich tracebacks (with locals) only for the Rich backend: importing them is slow
+def install_traceback():
+    if LOG_BACKEND == 'rich':
+        from rich.traceback import install
+        install(show_locals=True)
+
+# Plural of a noun in log messages (singular when count is 1), for the fixed set of words the scripts use;
+# scripts call it as p.plural(word, count) with p = common.inflector
+def plural(word, count=None):
+    if count == 1:
+        return word
+    if word.endswith(('s', 'x', 'z', 'ch', 'sh')):
+        return f"{word}es"
+    if word.endswith('y') and word[-2:-1] not in 'aeiou':
+        return f"{word[:-1]}ies"
+    return f"{word}s"
+
+inflector = types.SimpleNamespace(plural=plural)
+
 # Initiate Progress() object
-progress = Progress(
+progress = new_progress(
     SpinnerColumn(),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -50,7 +222,7 @@ EMOJI_ZIP = "[purple]:compression:[/purple]"
 # Run a command without Live console update
 def run_command_simple(command, desc=None, style="italic"):
     try:
-        cmd = f"[yellow dim]$ {command}[/yellow dim]"
+        cmd = f"[yellow dim]$ {escape(command)}[/yellow dim]"
         start_time = datetime.now()
         console.print(Panel(cmd, border_style="dim", title=desc, expand=False))
         subprocess.run(command, check=True, shell=True)
@@ -62,18 +234,27 @@ def run_command_simple(command, desc=None, style="italic"):
         console.print_exception(show_locals=True)
 
 # Modified run_command - subprocess with rich (AI suggestion)
-def run_command(command, desc=None, style="italic"):
+def run_command(command, desc=None, style="italic", cwd=None, tool=None, threads=None, input_bytes=0):
     """
-    Run a shell command with live Rich output
+    Run a shell command with live Rich output (optionally in cwd, without changing this process's directory)
+    With tool and threads given, its wall and CPU time are recorded for the autotuner (see autotune.py)
     """
 
-    cmd = f"[yellow dim]$ {command}[/yellow dim]"
+    cmd = f"[yellow dim]$ {escape(command)}[/yellow dim]"
     # if desc:
     #     console.rule(f"[dim]Staring: {desc}[/dim]", characters="-", style="dim")
     
     start_time = datetime.now()
     console.print(Panel(cmd, border_style="dim", title=desc, expand=False))
 
+    # Pin the command to the worker slot's cores (and prefer its NUMA node's memory) when placement is enabled
+    # Without numactl, taskset pins it: a preexec_fn is not safe to run in this multi-threaded process
+    slot = current_slot()
+    if slot and placement['numactl']:
+        command = f"{placement['numactl']} --physcpubind={format_cpulist(slot['cpus'])} --preferred={slot['node']} -- /bin/sh -c {shlex.quote(command)}"
+    elif slot and placement['taskset']:
+        command = f"{placement['taskset']} -c {format_cpulist(slot['cpus'])} /bin/sh -c {shlex.quote(command)}"
+
     process = subprocess.Popen(
         command,
         shell=True,
@@ -81,14 +262,17 @@ def run_command(command, desc=None, style="italic"):
         stderr=subprocess.STDOUT,
         text=True,
         bufsize=1,
-        universal_newlines=True
+        universal_newlines=True,
+        cwd=cwd
     )
 
     # Stream live output (line by line)
     # with Live(console=console, refresh_per_second=8, transient=True):
     for line in iter(process.stdout.readline, ""):
         line = line.strip()
-        if line:
+        if line and LOG_BACKEND != 'rich':
+            logger.info(line, extra={'raw': True})
+        elif line:
             if "error" in line.lower():
                 console.print(line, style="bold red")
             elif "warning" in line.lower():
@@ -96,9 +280,19 @@ def run_command(command, desc=None, style="italic"):
             else:
                 console.print(line, style="green dim")
     
-    process.wait()
+    record = tool is not None and metrics['file'] is not None
+    if slot or record:
+        # wait4 gives the CPU time of this command and its children, for the slot's utilisation and run metrics
+        _, wait_status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(wait_status)
+    else:
+        process.wait()
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
+    if slot:
+        record_slot_usage(slot, duration, rusage.ru_utime + rusage.ru_stime)
+    if record and process.returncode == 0:
+        record_metrics(tool, threads, input_bytes, duration, rusage.ru_utime + rusage.ru_stime)
 
     if process.returncode == 0:
         console.print(f"{EMOJI_CHECK} Command finished in {(duration/60):.2f} minutes", style='italic')
@@ -109,6 +303,23 @@ def run_command(command, desc=None, style="italic"):
     #     console.rule(f"[dim]{desc} - Done[/dim]", characters='-', style='dim')
     return process.returncode
 
+# Run metrics of tool commands (tool, threads, input size, wall and CPU time); disabled until configure_metrics() is called
+metrics = {'file': None, 'lock': threading.Lock()}
+METRICS_FIELDS = ['tool', 'threads', 'input_bytes', 'wall', 'cpu', 'host', 'date']
+
+def configure_metrics(metrics_file):
+    metrics['file'] = metrics_file
+
+# Append one successful command's metrics
+def record_metrics(tool, threads, input_bytes, wall, cpu):
+    row = [tool, threads, int(input_bytes), f"{wall:.2f}", f"{cpu:.2f}", os.uname().nodename, datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+    with metrics['lock']:
+        new_file = not os.path.exists(metrics['file'])
+        with open(metrics['file'], 'a') as f:
+            if new_file:
+                f.write('\t'.join(METRICS_FIELDS) + '\n')
+            f.write('\t'.join(str(value) for value in row) + '\n')
+
 # Get split size based lists
 def get_split_size(split_size, samples):
     if split_size == 1:
@@ -139,7 +350,7 @@ def run_concurrently(run_func, split_size, sample_lists, status_subs):
             # Adding delay between submissions
             futures = []
             for i, sub_list in enumerate(sample_lists):
-                futures.append(executor.submit(run_func, sub_list, status_subs[i])) 
+                futures.append(executor.submit(in_slot, slot_for(i), run_func, sub_list, status_subs[i])) 
                 time.sleep(1)  # Slight delay to stagger starts
             for future in concurrent.futures.as_completed(futures):
                 try:
@@ -147,6 +358,658 @@ def run_concurrently(run_func, split_size, sample_lists, status_subs):
                 except Exception as e:
                     logger.error(f"{EMOJI_CROSS} Error in concurrent execution: {e}")
                     console.print_exception(show_locals=True)
+        report_placement()
+
+# Worker status board: workers push (slot, text) events to a queue instead of updating their own console.status,
+# and the Live refresh thread drains them at a fixed rate into one compact table of at most max_rows rows.
+# Its slots keep the status_sub.update(text, ...) interface, so stage functions are unchanged.
+BOARD_REFRESH = 4
+
+class StatusBoard:
+    def __init__(self, n_slots, initial="", max_rows=12):
+        self.events = queue.SimpleQueue()
+        now = time.monotonic()
+        self.rows = [[initial, now] for _ in range(n_slots)]
+        self.max_rows = max_rows
+        # Without a Live display nothing drains the events, so the plain and JSON backends only log them
+        update = self.push if LOG_BACKEND == 'rich' else self.log
+        self.slots = [types.SimpleNamespace(update=functools.partial(update, i)) for i in range(n_slots)]
+
+    # Called by workers: O(1), no rendering or console lock
+    def push(self, slot, text, **_):
+        self.events.put((slot, text, time.monotonic()))
+
+    def log(self, slot, text, **_):
+        logger.debug(f"Worker {slot+1}: {strip_markup(text)}")
+
+    def __rich__(self):
+        while True:
+            try:
+                slot, text, stamp = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self.rows[slot] = [text, stamp]
+
+        now = time.monotonic()
+        table = Table.grid(padding=(0, 1))
+        table.add_column(style='dim', justify='right')
+        table.add_column(no_wrap=True, overflow='ellipsis')
+        table.add_column(style='dim', justify='right')
+        # Most recently updated slots first when they do not all fit
+        order = sorted(range(len(self.rows)), key=lambda i: -self.rows[i][1]) if len(self.rows) > self.max_rows else range(len(self.rows))
+        for i in list(order)[:self.max_rows]:
+            text, stamp = self.rows[i]
+            table.add_row(f"{i+1}", Text.from_markup(text.strip()), f"{now - stamp:.0f}s")
+        if len(self.rows) > self.max_rows:
+            table.add_row("", Text(f"... and {len(self.rows) - self.max_rows} more workers", style='dim italic'), "")
+        return table
+
+# Temporary name for an atomic write of path (write, then os.replace), unique per host, process and thread, so
+# workers sharing a filesystem never write into each other's tmp file
+def tmp_path(path):
+    return f"{path}.{os.uname().nodename}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+# Study context passed explicitly to per-sample stage functions: base, type, study and named stage dirs
+def study_context(base, study, **stage_dirs):
+    context = {'base': base, 'type': os.path.basename(base), 'study': study}
+    context.update({name: f"{base}/{study}/{stage_dir}" for name, stage_dir in stage_dirs.items()})
+    return context
+
+# Run run_func(context, sample, status_sub) over (context, sample) jobs from any number of studies and types.
+# All jobs go into one shared queue, so every worker keeps pulling work until the queue is empty.
+# prefetch(context, sample), if given, is called for every job in queue order before the workers start.
+# The queue runs on the configured executor (see configure_executor); resources ({'cpus', 'mem_gb', 'hours'})
+# are what one unit requests from a batch scheduler
+def run_queue(run_func, split_size, jobs, status_subs, on_done=None, prefetch=None, resources=None):
+    task = array_task()
+    if task:
+        return run_array_unit(task, run_func, jobs, status_subs)
+    return EXECUTORS[executor['backend']](run_func, split_size, jobs, status_subs, on_done, prefetch, resources)
+
+# Local backend: units run on split_size threads of this process
+def run_local_queue(run_func, split_size, jobs, status_subs, on_done=None, prefetch=None, resources=None):
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    if prefetch:
+        for context, sample in jobs:
+            prefetch(context, sample)
+
+    def worker(status_sub):
+        while True:
+            try:
+                context, sample = job_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                run_func(context, sample, status_sub)
+            except Exception as e:
+                logger.error(f"{EMOJI_CROSS} Error processing {context['study']} {EMOJI_PLAY} {sample}: {e}")
+                console.print_exception(show_locals=True)
+            finally:
+                # A prefetched copy the unit did not use (skipped or failed sample) gives its capacity back
+                if prefetch:
+                    drop_prefetch(stage_key(context, sample))
+            if on_done:
+                on_done(context, sample)
+
+    n_workers = max(1, min(split_size, len(jobs)))
+    logger.info(f"{EMOJI_PROCESS} Running {len(jobs)} samples on {n_workers} workers from a shared queue...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for i in range(n_workers):
+            futures.append(executor.submit(in_slot, slot_for(i), worker, status_subs[i]))
+            time.sleep(1)  # Slight delay to stagger starts
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    report_placement()
+
+# Executor of run_queue: 'local' (threads of this process) until configure_executor() selects another backend.
+# The 'shared' backend lets processes on several nodes cooperate on each queue (see run_shared_queue).
+# The 'slurm' backend submits each queue as one job array; every array task re-runs this script with the same
+# arguments and MGA_ARRAY_UNITS set, and its run_queue call runs only that task's unit, then exits. Outputs go
+# to the usual study dirs on the shared filesystem, and results are collected from {work_dir}/{queue}/{task}.json
+EXECUTOR_POLL = 15
+# squeue can briefly list nothing (controller restart, array still being expanded), so an array counts as finished
+# only when Slurm no longer knows it, or after this many consecutive empty listings; failed squeue calls back off
+ARRAY_EMPTY_POLLS = 3
+ARRAY_MAX_BACKOFF = 300
+ARRAY_FINAL_STATES = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+executor = {'backend': 'local', 'work_dir': None, 'sbatch': 'sbatch', 'squeue': 'squeue', 'options': "", 'limit': 0, 'resources': {}, 'worker': f"{os.uname().nodename}:{os.getpid()}", 'heartbeat': None}
+
+# Per-tool requests of one unit: memory in GB and time limit in hours (override with a tool,"mem_gb:hours" CSV)
+JOB_RESOURCES = {
+    'download': {'mem_gb': 8, 'hours': 12},
+    'BBDuk': {'mem_gb': 16, 'hours': 6},
+    'fastp': {'mem_gb': 8, 'hours': 4},
+    'Hostile': {'mem_gb': 16, 'hours': 8},
+    'Kraken2': {'mem_gb': 100, 'hours': 8},
+    'FastQC': {'mem_gb': 8, 'hours': 6},
+    'pigz': {'mem_gb': 4, 'hours': 4},
+}
+
+# Select the executor backend: 'local', 'shared', 'slurm', or 'slurm_local' (Slurm backend on the local stand-in,
+# slurm_standin.py). The shared queue database and job array files go to work_dir. Extra sbatch options, a limit of concurrently running tasks and resource overrides apply
+# to every array. MGA_SBATCH and MGA_SQUEUE replace the sbatch and squeue commands (e.g. site wrappers)
+def configure_executor(backend, work_dir, options="", limit=0, resources=None):
+    executor.update(backend='slurm' if backend.startswith('slurm') else backend, work_dir=os.path.abspath(work_dir), options=options or "", limit=limit)
+    executor['sbatch'] = os.environ.get('MGA_SBATCH', 'sbatch')
+    executor['squeue'] = os.environ.get('MGA_SQUEUE', 'squeue')
+    if backend == 'slurm_local':
+        standin = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "slurm_standin.py")]
+        executor['sbatch'], executor['squeue'] = shlex.join(standin + ['sbatch']), shlex.join(standin + ['squeue'])
+    for tool, value in (resources or {}).items():
+        mem_gb, _, hours = value.partition(':')
+        executor['resources'][tool] = {'mem_gb': int(mem_gb), 'hours': float(hours) if hours else JOB_RESOURCES.get(tool, {}).get('hours', 12)}
+    if backend != 'local':
+        os.makedirs(executor['work_dir'], exist_ok=True)
+    if backend == 'shared':
+        logger.info(f"{EMOJI_SPARKLE} Sharing queues with other workers through [i dim]{shared_db_file()}[/] (worker {executor['worker']})")
+    elif backend != 'local':
+        logger.info(f"{EMOJI_SPARKLE} Submitting queues as job arrays via [i dim]{executor['sbatch']}[/] (work dir: [i dim]{executor['work_dir']}[/])")
+
+# Request of one unit running the given tools one after another with n_threads: the largest memory, summed time
+def job_resources(tools, n_threads):
+    requests = [executor['resources'].get(tool) or JOB_RESOURCES.get(tool, {'mem_gb': 8, 'hours': 12}) for tool in tools]
+    return {'cpus': n_threads, 'mem_gb': max(request['mem_gb'] for request in requests), 'hours': sum(request['hours'] for request in requests)}
+
+# Whether this process is an array task of the 'slurm' executor
+def in_array_task():
+    return bool(os.environ.get('MGA_ARRAY_UNITS'))
+
+# This array task's queue (units file contents and its path) and unit index, or None outside array tasks
+def array_task():
+    if not in_array_task():
+        return None
+    with open(os.environ['MGA_ARRAY_UNITS']) as f:
+        units = json.load(f)
+    return units, os.environ['MGA_ARRAY_UNITS'], int(os.environ['SLURM_ARRAY_TASK_ID'])
+
+# Key of a unit in units files
+def unit_key(context, sample):
+    return [f"{context['base']}/{context['study']}", sample]
+
+# In an array task: run this task's unit if this is the submitted queue (same function, and the unit among its
+# jobs; earlier queues of the script were finished before the array was submitted, so they return at once),
+# write its result and exit
+def run_array_unit(task, run_func, jobs, status_subs):
+    units, units_file, task_id = task
+    study_dir, sample = units['units'][task_id]
+    context = next((context for context, job_sample in jobs if unit_key(context, job_sample) == [study_dir, sample]), None)
+    if units['func'] != run_func.__name__ or context is None:
+        return
+    result = {'unit': [study_dir, sample], 'status': 'ok', 'host': os.uname().nodename}
+    start_time = time.time()
+    try:
+        run_func(context, sample, status_subs[0])
+    except Exception as e:
+        logger.error(f"{EMOJI_CROSS} Error processing {os.path.basename(study_dir)} {EMOJI_PLAY} {sample}: {e}")
+        console.print_exception(show_locals=True)
+        result.update(status='error', error=str(e))
+    result['wall'] = time.time() - start_time
+    result_file = os.path.join(os.path.dirname(units_file), f"{task_id}.json")
+    with open(f"{result_file}.tmp", 'w') as f:
+        json.dump(result, f)
+    os.replace(f"{result_file}.tmp", result_file)
+    sys.exit(0 if result['status'] == 'ok' else 1)
+
+# States of an array's tasks still active in the queue, 'gone' once Slurm no longer knows the array ("Invalid job id"),
+# or None when squeue failed and the state is unknown
+def array_states(job_id):
+    command = shlex.split(executor['squeue']) + ['-h', '-r', '-j', job_id, '-o', '%T']
+    listing = subprocess.run(command, capture_output=True, text=True)
+    if listing.returncode == 0:
+        return [state for state in listing.stdout.split() if state not in ARRAY_FINAL_STATES]
+    if 'Invalid job id' in listing.stderr:
+        return 'gone'
+    logger.warning(f"{EMOJI_WARNING} squeue failed for job array {job_id}: {listing.stderr.strip() or f'exit code {listing.returncode}'}")
+    return None
+
+# Slurm backend: submit the jobs as one array, then poll squeue, reporting each unit as its result appears
+# Units that leave the queue without a result (killed, timed out, node failure) are reported as failed
+def run_array_queue(run_func, split_size, jobs, status_subs, on_done=None, prefetch=None, resources=None):
+    if not jobs:
+        return
+    resources = resources or {'cpus': 1, 'mem_gb': 8, 'hours': 12}
+    queue_dir = os.path.join(executor['work_dir'], f"{datetime.now():%Y%m%d_%H%M%S}_{run_func.__name__}")
+    os.makedirs(queue_dir, exist_ok=True)
+    units_file = f"{queue_dir}/units.json"
+    with open(units_file, 'w') as f:
+        json.dump({'func': run_func.__name__, 'units': [unit_key(context, sample) for context, sample in jobs]}, f)
+    with open(f"{queue_dir}/job.sh", 'w') as f:
+        f.write("#!/bin/bash\n")
+        f.write(f"cd {shlex.quote(os.getcwd())}\n")
+        f.write(f"export MGA_ARRAY_UNITS={shlex.quote(units_file)}\n")
+        f.write(f"exec {shlex.join([sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:])}\n")
+
+    hours = max(resources['hours'], 0.25)
+    array = f"0-{len(jobs)-1}" + (f"%{executor['limit']}" if executor['limit'] else "")
+    command = shlex.split(executor['sbatch']) + [
+        '--parsable', f"--job-name={study_name}_{run_func.__name__}", f"--array={array}", f"--output={queue_dir}/%a.log",
+        f"--cpus-per-task={resources['cpus']}", f"--mem={resources['mem_gb']}G", f"--time={int(hours)}:{int(hours % 1 * 60):02d}:00",
+    ] + shlex.split(executor['options']) + [f"{queue_dir}/job.sh"]
+    submission = subprocess.run(command, capture_output=True, text=True)
+    if submission.returncode != 0:
+        raise RuntimeError(f"sbatch failed: {submission.stderr.strip()}")
+    job_id = submission.stdout.strip().split(';')[0]
+    logger.info(f"{EMOJI_PROCESS} Submitted {len(jobs)} samples as job array {job_id} ({resources['cpus']} CPUs, {resources['mem_gb']} GB, {hours:g} h each)...")
+
+    reported, failed, empty_polls, errors = set(), 0, 0, 0
+    while True:
+        states = array_states(job_id)
+        if states is None:
+            errors += 1
+            time.sleep(min(EXECUTOR_POLL * 2 ** errors, ARRAY_MAX_BACKOFF))
+            continue
+        errors = 0
+        empty_polls = empty_polls + 1 if not states else 0
+        finished = states == 'gone' or empty_polls >= ARRAY_EMPTY_POLLS
+        states = states if isinstance(states, list) else []
+        for i, (context, sample) in enumerate(jobs):
+            result_file = f"{queue_dir}/{i}.json"
+            if i in reported or (not finished and not os.path.exists(result_file)):
+                continue
+            if os.path.exists(result_file):
+                with open(result_file) as f:
+                    result = json.load(f)
+            else:
+                result = {'status': 'error', 'error': f"no result, see {queue_dir}/{i}.log"}
+            if result['status'] != 'ok':
+                failed += 1
+                logger.error(f"{EMOJI_CROSS} Error processing {context['study']} {EMOJI_PLAY} {sample} (task {job_id}_{i}): {result['error']}")
+            reported.add(i)
+            if on_done:
+                on_done(context, sample)
+        status_subs[0].update(f"[i][dim]Job array[/dim] {job_id}: {states.count('PENDING')} [dim]pending,[/dim] {states.count('RUNNING')} [dim]running,[/dim] {len(reported)}/{len(jobs)} [dim]finished[/dim][/i]")
+        if finished or len(reported) == len(jobs):
+            break
+        time.sleep(EXECUTOR_POLL)
+    logger.info(f"{EMOJI_CHECK} Job array {job_id} finished: {len(jobs) - failed}/{len(jobs)} samples succeeded")
+
+# Shared-filesystem queue: processes started with the same arguments, on any number of nodes, cooperate on each
+# queue without a coordinator. Units live in an SQLite database in the work dir, and a worker claims one in an
+# immediate (write-locked) transaction, so no two workers hold the same unit. Workers refresh the heartbeat
+# of their claims every SHARED_HEARTBEAT seconds; a claim older than SHARED_LEASE belongs to a crashed or
+# stopped worker and is claimed again. Failed units are retried until they have had SHARED_ATTEMPTS attempts.
+# run_queue returns once every unit of the queue is finished, by any worker, so steps after it see all outputs.
+# The filesystem must support POSIX locks (Lustre, GPFS, NFSv4 with locking; SQLite's rollback journal is used).
+SHARED_DB = "shared_queue.sqlite"
+SHARED_HEARTBEAT = 30
+SHARED_LEASE = 300
+SHARED_POLL = 20
+SHARED_ATTEMPTS = 2
+
+def shared_db_file():
+    return os.path.join(executor['work_dir'], SHARED_DB)
+
+# Connection to the shared queue database, created on first use
+def shared_db():
+    db = sqlite3.connect(shared_db_file(), timeout=120, isolation_level=None)
+    db.execute("CREATE TABLE IF NOT EXISTS units (queue TEXT, key TEXT, state TEXT, owner TEXT, heartbeat REAL, attempts INTEGER, result TEXT, PRIMARY KEY (queue, key))")
+    db.execute("CREATE INDEX IF NOT EXISTS units_state ON units (queue, state)")
+    return db
+
+# Per-thread connection of claim_unit, with this process's keys of the current queue in a temp table, in queue order
+claim_local = threading.local()
+
+def claim_db(keys):
+    if getattr(claim_local, 'keys', None) is not keys:
+        if getattr(claim_local, 'db', None) is None:
+            claim_local.db = shared_db()
+        claim_local.db.execute("CREATE TEMP TABLE IF NOT EXISTS claim_keys (position INTEGER PRIMARY KEY, key TEXT UNIQUE)")
+        claim_local.db.execute("DELETE FROM claim_keys")
+        claim_local.db.executemany("INSERT INTO claim_keys VALUES (?, ?)", enumerate(keys))
+        claim_local.keys = keys
+    return claim_local.db
+
+# Key of a unit in the shared queue
+def shared_key(context, sample):
+    return '\t'.join(unit_key(context, sample))
+
+# Claim the first unit of keys that is unclaimed, failed with attempts left, or held by an expired claim.
+# The write lock is held for one indexed lookup of the first claimable row, not a scan of the whole queue
+def claim_unit(queue_name, keys):
+    db = claim_db(keys)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        now = time.time()
+        row = db.execute(
+            "SELECT units.key, units.state, units.owner, units.heartbeat FROM units JOIN claim_keys ON claim_keys.key = units.key"
+            " WHERE units.queue = ? AND (units.state = 'todo' OR (units.state = 'claimed' AND units.heartbeat < ?) OR (units.state = 'failed' AND units.attempts < ?))"
+            " ORDER BY claim_keys.position LIMIT 1",
+            (queue_name, now - SHARED_LEASE, SHARED_ATTEMPTS)
+        ).fetchone()
+        if row is not None:
+            db.execute("UPDATE units SET state = 'claimed', owner = ?, heartbeat = ?, attempts = attempts + 1 WHERE queue = ? AND key = ?", (executor['worker'], now, queue_name, row[0]))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    key, state, owner, heartbeat = row
+    if state == 'claimed':
+        logger.warning(f"{EMOJI_WARNING} Reclaimed {key.replace(chr(9), ' ')} from {owner} (no heartbeat for {now - heartbeat:.0f} s)")
+    return key
+
+# Record a claimed unit's result; False if the claim had expired and another worker took the unit over
+def finish_unit(queue_name, key, result):
+    db = shared_db()
+    try:
+        cursor = db.execute(
+            "UPDATE units SET state = ?, result = ?, heartbeat = ? WHERE queue = ? AND key = ? AND owner = ? AND state = 'claimed'",
+            ('done' if result['status'] == 'ok' else 'failed', json.dumps(result), time.time(), queue_name, key, executor['worker'])
+        )
+        return cursor.rowcount == 1
+    finally:
+        db.close()
+
+# Number of units of keys still to be done (claimed, or not yet run, or failed with attempts left)
+def unfinished_units(queue_name, keys):
+    db = shared_db()
+    try:
+        rows = db.execute("SELECT key, state, attempts FROM units WHERE queue = ?", (queue_name,)).fetchall()
+    finally:
+        db.close()
+    keys = set(keys)
+    return sum(1 for key, state, attempts in rows if key in keys and (state in ['todo', 'claimed'] or (state == 'failed' and attempts < SHARED_ATTEMPTS)))
+
+# Heartbeat thread of this process: refreshes all its claims, so they expire only if the process stops
+def start_heartbeat():
+    if executor['heartbeat'] is not None:
+        return
+    def beat():
+        while True:
+            time.sleep(SHARED_HEARTBEAT)
+            try:
+                db = shared_db()
+                db.execute("UPDATE units SET heartbeat = ? WHERE owner = ? AND state = 'claimed'", (time.time(), executor['worker']))
+                db.close()
+            except sqlite3.Error as e:
+                logger.warning(f"{EMOJI_WARNING} Heartbeat failed: {e}")
+    executor['heartbeat'] = threading.Thread(target=beat, daemon=True)
+    executor['heartbeat'].start()
+
+# Shared backend: add this process's jobs to the queue (units already there keep their state), then let
+# split_size workers claim and run units until none is left; units held by live workers elsewhere are waited for
+def run_shared_queue(run_func, split_size, jobs, status_subs, on_done=None, prefetch=None, resources=None):
+    queue_name = run_func.__name__
+    by_key = {shared_key(context, sample): (context, sample) for context, sample in jobs}
+    keys = list(by_key)
+    db = shared_db()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        # A queue with nothing left to run and no unit finished within the lease is from an earlier run: start it
+        # afresh (units with outputs skip quickly). One that peers have just finished is left as it is
+        active, last_finish = db.execute("SELECT SUM(state IN ('todo', 'claimed')), MAX(heartbeat) FROM units WHERE queue = ?", (queue_name,)).fetchone()
+        if not active and (last_finish or 0) < time.time() - SHARED_LEASE:
+            db.execute("UPDATE units SET state = 'todo', owner = NULL, attempts = 0, result = NULL WHERE queue = ?", (queue_name,))
+        db.executemany("INSERT OR IGNORE INTO units VALUES (?, ?, 'todo', NULL, 0, 0, NULL)", [(queue_name, key) for key in keys])
+        db.execute("COMMIT")
+    finally:
+        db.close()
+    start_heartbeat()
+    ran = []
+
+    def worker(status_sub):
+        while True:
+            key = claim_unit(queue_name, keys)
+            if key is None:
+                remaining = unfinished_units(queue_name, keys)
+                if not remaining:
+                    break
+                status_sub.update(f"[i][dim]Waiting for[/dim] {remaining} [dim]{plural('sample', remaining)} on other workers[/dim][/i]")
+                time.sleep(SHARED_POLL)
+                continue
+            context, sample = by_key[key]
+            result = {'status': 'ok', 'host': os.uname().nodename}
+            start_time = time.time()
+            try:
+                run_func(context, sample, status_sub)
+            except Exception as e:
+                logger.error(f"{EMOJI_CROSS} Error processing {context['study']} {EMOJI_PLAY} {sample}: {e}")
+                console.print_exception(show_locals=True)
+                result.update(status='error', error=str(e))
+            result['wall'] = time.time() - start_time
+            if not finish_unit(queue_name, key, result):
+                logger.warning(f"{EMOJI_WARNING} The claim on {context['study']} {EMOJI_PLAY} {sample} expired while it ran, and another worker took it over")
+            ran.append(key)
+            if on_done:
+                on_done(context, sample)
+
+    n_workers = max(1, min(split_size, len(jobs)))
+    logger.info(f"{EMOJI_PROCESS} Running {len(jobs)} samples from the shared queue [i dim]{queue_name}[/] on {n_workers} local workers...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(in_slot, slot_for(i), worker, status_subs[i]) for i in range(n_workers)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    report_placement()
+    db = shared_db()
+    try:
+        failed = [key for key, in db.execute("SELECT key FROM units WHERE queue = ? AND state = 'failed'", (queue_name,)) if key in by_key]
+    finally:
+        db.close()
+    logger.info(f"{EMOJI_CHECK} Shared queue [i dim]{queue_name}[/] finished: {len(jobs) - len(failed)}/{len(jobs)} samples succeeded, {len(ran)} ran in this worker")
+
+EXECUTORS = {'local': run_local_queue, 'shared': run_shared_queue, 'slurm': run_array_queue}
+
+# CPU/NUMA placement of concurrent worker slots; disabled until configure_placement() is called
+# Each slot gets a disjoint core set on one NUMA node, and commands run by its worker are pinned to it
+placement = {'slots': [], 'numactl': None, 'taskset': None, 'local': threading.local(), 'usage': {}, 'lock': threading.Lock()}
+
+# Parse a /sys cpulist ("0-3,8-11") into a list of CPU ids
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+# Format CPU ids as a cpulist for numactl/taskset
+def format_cpulist(cpus):
+    return ','.join(str(cpu) for cpu in sorted(cpus))
+
+# NUMA nodes and their CPUs available to this process, from /sys (one node with all CPUs if unavailable)
+def cpu_topology(sys_dir="/sys/devices/system/node"):
+    allowed = os.sched_getaffinity(0)
+    topology = {}
+    if os.path.isdir(sys_dir):
+        for name in sorted(os.listdir(sys_dir)):
+            if re.fullmatch(r"node\d+", name) and os.path.exists(f"{sys_dir}/{name}/cpulist"):
+                with open(f"{sys_dir}/{name}/cpulist") as f:
+                    cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+                if cpus:
+                    topology[int(name[4:])] = cpus
+    return topology or {0: sorted(allowed)}
+
+# Assign n_slots worker slots round-robin to NUMA nodes, each with up to `threads` disjoint cores of its node
+def configure_placement(n_slots, threads):
+    topology = cpu_topology()
+    nodes = sorted(topology)
+    per_node = {node: [i for i in range(n_slots) if nodes[i % len(nodes)] == node] for node in nodes}
+    slots = [None] * n_slots
+    for node, slot_ids in per_node.items():
+        if not slot_ids:
+            continue
+        cpus = topology[node]
+        width = max(1, min(threads, len(cpus) // len(slot_ids)))
+        for j, i in enumerate(slot_ids):
+            start = (j * width) % len(cpus)
+            slots[i] = {'id': i, 'node': node, 'cpus': cpus[start:start + width] or cpus[:width]}
+    placement['slots'] = slots
+    placement['numactl'] = shutil.which("numactl")
+    placement['taskset'] = shutil.which("taskset")
+    if not placement['numactl'] and not placement['taskset']:
+        logger.warning(f"{EMOJI_WARNING} Neither numactl nor taskset is installed: commands will not be pinned to their slot's cores")
+    for slot in slots:
+        logger.info(f"{EMOJI_LIST} Slot {slot['id']+1}: NUMA node {slot['node']}, cores {format_cpulist(slot['cpus'])}")
+    if len({cpu for slot in slots for cpu in slot['cpus']}) < n_slots * threads:
+        logger.warning(f"{EMOJI_WARNING} Fewer cores than {n_slots} x {threads} threads: slots get {', '.join(str(len(slot['cpus'])) for slot in slots)} cores")
+    return slots
+
+# Placement slot of worker i (None when placement is disabled)
+def slot_for(i):
+    return placement['slots'][i % len(placement['slots'])] if placement['slots'] else None
+
+# Placement slot of the calling thread
+def current_slot():
+    return getattr(placement['local'], 'slot', None)
+
+# Run func in a thread bound to a placement slot, so the commands it runs are pinned to the slot's cores
+def in_slot(slot, func, *args, **kwargs):
+    placement['local'].slot = slot
+    try:
+        return func(*args, **kwargs)
+    finally:
+        placement['local'].slot = None
+
+def record_slot_usage(slot, wall, cpu):
+    with placement['lock']:
+        usage = placement['usage'].setdefault(slot['id'], {'commands': 0, 'wall': 0.0, 'cpu': 0.0})
+        usage['commands'] += 1
+        usage['wall'] += wall
+        usage['cpu'] += cpu
+
+# Log per-slot utilisation (CPU time / (wall time x cores)) of the commands run since the last report
+def report_placement():
+    with placement['lock']:
+        usage, placement['usage'] = placement['usage'], {}
+    for slot_id in sorted(usage):
+        slot, stats = placement['slots'][slot_id], usage[slot_id]
+        utilisation = stats['cpu'] / (stats['wall'] * len(slot['cpus'])) if stats['wall'] else 0
+        logger.info(f"{EMOJI_PROCESS} Slot {slot_id+1} (node {slot['node']}, {len(slot['cpus'])} cores): {stats['commands']} commands, {stats['wall']/60:.1f} min busy, {stats['cpu']/60:.1f} CPU-min, {utilisation:.0%} utilisation")
+
+# Node-local staging (NVMe/tmpfs) for I/O-heavy stages; disabled until configure_staging() is called
+# Prefetches take a ticket when submitted, in queue order, and capacity is granted in ticket order, so a later
+# sample's prefetch never takes the room an earlier sample (which a worker may be waiting on) needs; copies
+# without a ticket (a worker staging an unprefetched sample) go ahead of waiting prefetches
+staging = {'root': None, 'cap': 0, 'used': 0, 'cond': threading.Condition(), 'pending': {}, 'executor': None, 'tickets': {}, 'next_ticket': 0, 'serving': 0, 'retired': set(), 'urgent': 0}
+
+# Enable staging under root, holding at most cap_gb of staged inputs and outputs at once
+def configure_staging(root, cap_gb, prefetch_threads=2):
+    staging['root'] = os.path.join(os.path.abspath(root), f"stage_{os.getpid()}")
+    staging['cap'] = int(cap_gb * 1024**3)
+    staging['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_threads)
+    os.makedirs(staging['root'], exist_ok=True)
+    atexit.register(shutil.rmtree, staging['root'], ignore_errors=True)
+    logger.info(f"{EMOJI_SPARKLE} Staging I/O-heavy stages in [i dim]{staging['root']}[/] (cap: {cap_gb} GB)")
+
+def staging_enabled():
+    return staging['root'] is not None
+
+# Staging key of a sample
+def stage_key(context, sample):
+    return f"{context['type']}/{context['study']}/{sample}"
+
+# Block until n_bytes of staging capacity are free (a single oversized item may use an empty area), and it is the
+# turn of key's ticket if it has one
+def reserve_staging(n_bytes, key=None):
+    with staging['cond']:
+        ticket = staging['tickets'].get(key)
+        if ticket is None:
+            staging['urgent'] += 1
+        while (staging['used'] > 0 and staging['used'] + n_bytes > staging['cap']) or (ticket is not None and (ticket != staging['serving'] or staging['urgent'])):
+            staging['cond'].wait()
+        staging['used'] += n_bytes
+        if ticket is None:
+            staging['urgent'] -= 1
+        else:
+            del staging['tickets'][key]
+            serve_next_ticket()
+        staging['cond'].notify_all()
+
+def release_staging(n_bytes):
+    with staging['cond']:
+        staging['used'] -= n_bytes
+        staging['cond'].notify_all()
+
+# Move on to the next ticket still waiting (called with the condition held)
+def serve_next_ticket():
+    staging['serving'] += 1
+    while staging['serving'] in staging['retired']:
+        staging['retired'].remove(staging['serving'])
+        staging['serving'] += 1
+
+# Give up key's ticket if it has not been served (its copy was cancelled or failed before reserving)
+def retire_ticket(key):
+    with staging['cond']:
+        ticket = staging['tickets'].pop(key, None)
+        if ticket is None:
+            return
+        if ticket == staging['serving']:
+            serve_next_ticket()
+        else:
+            staging['retired'].add(ticket)
+        staging['cond'].notify_all()
+
+# Copy inputs into {root}/{key}/in, reserving room for out_factor x their size of outputs in {root}/{key}/out
+def copy_in(key, files, out_factor=1.0):
+    n_bytes = int(sum(os.path.getsize(f) for f in files) * (1 + out_factor))
+    reserve_staging(n_bytes, key)
+    local_dir = os.path.join(staging['root'], key)
+    inputs = {}
+    # A failed copy (full disk, unreadable input) gives back its reservation and partial files
+    try:
+        os.makedirs(f"{local_dir}/in", exist_ok=True)
+        os.makedirs(f"{local_dir}/out", exist_ok=True)
+        for in_file in files:
+            local_file = f"{local_dir}/in/{os.path.basename(in_file)}"
+            shutil.copyfile(in_file, f"{local_file}.tmp")
+            os.replace(f"{local_file}.tmp", local_file)
+            inputs[in_file] = local_file
+    except BaseException:
+        shutil.rmtree(local_dir, ignore_errors=True)
+        release_staging(n_bytes)
+        raise
+    return {'key': key, 'dir': local_dir, 'out': f"{local_dir}/out", 'inputs': inputs, 'bytes': n_bytes}
+
+# Start copying a sample's inputs in the background, so it overlaps with the current sample's compute
+def prefetch_inputs(key, files, out_factor=1.0):
+    if staging_enabled() and key not in staging['pending']:
+        with staging['cond']:
+            staging['tickets'][key] = staging['next_ticket']
+            staging['next_ticket'] += 1
+        staging['pending'][key] = staging['executor'].submit(copy_in, key, files, out_factor)
+
+# Staged copy of a sample's inputs: waits for its prefetch, takes over one that has not started, or copies them now
+def stage_inputs(key, files, out_factor=1.0):
+    future = staging['pending'].pop(key, None)
+    if future is not None and not future.cancel():
+        return future.result()
+    return copy_in(key, files, out_factor)
+
+# Discard a sample's prefetch that no worker claimed: cancel it, or remove its copy once done, and free its ticket
+def drop_prefetch(key):
+    future = staging['pending'].pop(key, None)
+    if future is not None and not future.cancel():
+        try:
+            unstage(future.result())
+        except Exception:
+            pass  # A failed copy has already released its reservation
+    retire_ticket(key)
+
+# Move finished outputs back: copied next to their destination under a temp name, then renamed into place
+def stage_out(outputs):
+    for local_path, final_path in outputs.items():
+        if not os.path.exists(local_path):
+            continue
+        tmp_path = f"{final_path}.staging"
+        if os.path.isdir(local_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            shutil.copytree(local_path, tmp_path)
+            if os.path.isdir(final_path):
+                shutil.rmtree(final_path)
+        else:
+            shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, final_path)
+
+# Remove a sample's staging area and free its capacity
+def unstage(staged):
+    shutil.rmtree(staged['dir'], ignore_errors=True)
+    release_staging(staged['bytes'])
 
 # Get unique items from a list
 def get_unique_items(in_list, pattern=None):
@@ -192,6 +1055,7 @@ if __name__ == "__main__":
     logger.info(f'{EMOJI_PROCESS} Using get_split_size(split_size, samples) to split samples: {samples} into {split_size} parts')
     split_samples = get_split_size(split_size, samples)
     logger.info(f'{EMOJI_SPARKLE} Split lists of samples: ')
+    from rich.pretty import Pretty
     console.print(Panel.fit(Pretty(split_samples, expand_all=True), title='Split lists', border_style='yellow dim'))
     
     # Example usage of run_concurrently
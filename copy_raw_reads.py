@@ -2,29 +2,27 @@
 
 import argparse
 import glob
-import inflect
 import os
 
 from rich.console import Group
-from rich.live import Live
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
-from rich.traceback import install
+from rich.progress import SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
 import common
-from get_info import names_list, make_dict
+import project_index
+from get_info import make_dict
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Rich traceback handler
-install(show_locals=True)
+common.install_traceback()
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 
-# Initiate Progress() object for n_studies
-progress = Progress(
+# Initiate the progress bar for n_studies (logged instead of drawn without the Rich backend)
+progress = common.new_progress(
     SpinnerColumn(spinner_name='dots12', style='blue'),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -59,7 +57,7 @@ if __name__ == "__main__":
     st_aliases = make_dict(args.aliases)
     console.print(
         panel.fit(
-            f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(st_aliases)}[/] [dim]study {p.plural('aliases', len(st_aliases))} in[/] {args.aliases}", 
+            f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(st_aliases)}[/] [dim]study {p.plural('alias', len(st_aliases))} in[/] {args.aliases}", 
             title="Study aliases", 
             border_style='dim cyan'
         ),
@@ -71,21 +69,16 @@ if __name__ == "__main__":
     else:
         base_dir = os.path.join(os.getcwd(), args.base_dir)
 
-    if args.projects in os.listdir(base_dir):
-        logger.info(f"{common.EMOJI_SPARKLE} Found project file [bold blue]{args.projects}[/] in [bold blue]{args.base_dir}[/]")
-        base_dirs = [base_dir]
-    else:
-        logger.info(f"{common.EMOJI_PROCESS} [bold blue]{args.projects}[/] not in [bold blue]{args.base_dir}[/], searching subdirectories.")
-        # It may work only for one sub-level
-        base_dirs = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if args.projects in os.listdir(os.path.join(base_dir, d))]
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    base_dirs = project_index.base_dirs(index)
 
-    with Live(panel(progress), console=console, transient=True):
+    with common.live(panel(progress)):
         if base_dirs:
             for base in base_dirs:
                 console.rule(f"Copying files of [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
 
-                studies_in = os.path.join(base, args.projects)
-                studies = names_list(studies_in)
+                studies = project_index.studies(index, base)
                 console.print(
                     panel.fit(
                         f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(studies)}[/] [dim]studies in[/] {os.path.basename(base)} [dim]dir[/]", 
@@ -105,7 +98,7 @@ if __name__ == "__main__":
 
                     os.makedirs(raw_reads, exist_ok=True)
 
-                    samples = names_list(f"{base}/{study}/{samples_in}")
+                    samples = project_index.samples(index, base, study)
                     samples_count = len(samples)
                     logger.info(f"{common.EMOJI_SPARKLE} Project [bold blue]{study}[/] has {samples_count} {p.plural('sample', samples_count)}...")
 
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+# Persistent pool of read-extraction worker processes
+# Each worker is started once and is handed one job at a time on its own queue, so the pool always knows which job
+# every worker holds; a worker that dies is replaced and its job reported lost.
+# A job covers one sample and every species planned for it, so the sample's FASTQs are streamed once.
+
+import gzip
+import multiprocessing
+import os
+import queue
+import subprocess
+import time
+
+import common
+import kraken_out_bin
+from kraken_utils import clade_taxids, read_kreport
+
+# Using logger from common.py
+logger = common.logger
+
+# Seconds between liveness checks of the workers while waiting for results
+POLL_SECONDS = 30
+
+# Choose the pool size from core count and how many gzip readers the disk can feed
+def auto_pool_size(sample_file, probe_mb=64):
+    cores = os.cpu_count() or 1
+    probe = probe_mb * 1024**2
+    try:
+        start = time.perf_counter()
+        with open(sample_file, 'rb') as f:
+            raw = f.read(probe)
+        disk_rate = len(raw) / max(time.perf_counter() - start, 1e-6)
+
+        start = time.perf_counter()
+        with open(sample_file, 'rb') as f, gzip.GzipFile(fileobj=f) as decompressor:
+            while f.tell() < min(len(raw), 16 * 1024**2):
+                if not decompressor.read(1024**2):
+                    break
+            worker_rate = f.tell() / max(time.perf_counter() - start, 1e-6)
+    except (OSError, EOFError):
+        return cores
+
+    io_cap = max(1, int(disk_rate / max(worker_rate, 1)))
+    size = max(1, min(cores, io_cap))
+    logger.info(f"{common.EMOJI_SPARKLE} Extraction pool: {size} workers (cores: {cores}, disk: {disk_rate/1024**2:.0f} MB/s, per worker: {worker_rate/1024**2:.0f} MB/s)")
+    return size
+
+# Read IDs assigned to any taxid in each of the taxid sets, from the .kbin store or the text .out
+def assigned_reads(out_prefix, taxid_sets):
+    union = set().union(*taxid_sets)
+    wanted = {}
+    if os.path.isdir(f"{out_prefix}.kbin") and not os.path.exists(f"{out_prefix}.out"):
+        kbin = kraken_out_bin.open_kbin(f"{out_prefix}.kbin")
+        indices = kraken_out_bin.reads_in_taxa(kbin, union)
+        taxids = kbin['taxid'][indices]
+        for read_id, taxid in zip(kraken_out_bin.side_column(kbin, 'read_ids', indices), taxids):
+            wanted[read_id] = [i for i, taxid_set in enumerate(taxid_sets) if int(taxid) in taxid_set]
+    else:
+        with open(f"{out_prefix}.out") as f:
+            for line in f:
+                fields = line.split('\t', 4)
+                taxid = kraken_out_bin.parse_taxid(fields[2])
+                if taxid in union:
+                    wanted[fields[1]] = [i for i, taxid_set in enumerate(taxid_sets) if taxid in taxid_set]
+    return wanted
+
+# Read one FASTQ record (4 lines), or None at the end of the file
+def read_record(handle):
+    header = handle.readline()
+    if not header:
+        return None
+    return header, handle.readline(), handle.readline(), handle.readline()
+
+# Read ID as written by Kraken2: first word of the header, without a /1 or /2 mate suffix
+def record_id(header):
+    read_id = header[1:].split(None, 1)[0]
+    if read_id.endswith(('/1', '/2')):
+        read_id = read_id[:-2]
+    return read_id
+
+# Extract the reads of several species from one paired sample in a single pass over its FASTQs
+def extract_sample(job):
+    nodes = read_kreport(job['report'])
+    species_list = job['species']
+    taxid_sets = [clade_taxids(nodes, tax_id) for _, tax_id, _ in species_list]
+    wanted = assigned_reads(job['out_prefix'], taxid_sets)
+
+    outputs = [(open(f"{sp_dir}/{job['sample']}_1.fq", 'w'), open(f"{sp_dir}/{job['sample']}_2.fq", 'w')) for _, _, sp_dir in species_list]
+    counts = [0] * len(species_list)
+    try:
+        with gzip.open(job['read1'], 'rt') as r1, gzip.open(job['read2'], 'rt') as r2:
+            while wanted:
+                rec1, rec2 = read_record(r1), read_record(r2)
+                if rec1 is None or rec2 is None:
+                    break
+                hits = wanted.pop(record_id(rec1[0]), None)
+                if hits is None:
+                    continue
+                for i in hits:
+                    outputs[i][0].writelines(rec1)
+                    outputs[i][1].writelines(rec2)
+                    counts[i] += 1
+    finally:
+        for out1, out2 in outputs:
+            out1.close()
+            out2.close()
+
+    for _, _, sp_dir in species_list:
+        subprocess.run(f"pigz -f {sp_dir}/{job['sample']}_1.fq {sp_dir}/{job['sample']}_2.fq", shell=True, check=True)
+    return {species: count for (species, _, _), count in zip(species_list, counts)}
+
+# Worker loop: jobs come in on job_queue until a None sentinel; results (with the worker's pid) go back on result_queue
+def worker(job_queue, result_queue):
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        start = time.perf_counter()
+        try:
+            counts = extract_sample(job)
+            result_queue.put({'pid': os.getpid(), 'sample': job['sample'], 'study': job['study'], 'counts': counts, 'error': None, 'seconds': time.perf_counter() - start})
+        except Exception as e:
+            result_queue.put({'pid': os.getpid(), 'sample': job['sample'], 'study': job['study'], 'counts': {}, 'error': repr(e), 'seconds': time.perf_counter() - start})
+
+# Start one worker process with its own job queue, reporting on the pool's result queue
+def start_worker(pool):
+    job_queue = pool['context'].Queue()
+    process = pool['context'].Process(target=worker, args=(job_queue, pool['results']), daemon=True)
+    process.start()
+    return {'process': process, 'jobs': job_queue}
+
+# Start a fixed-size pool of long-lived workers
+def start_pool(size):
+    context = multiprocessing.get_context('fork')
+    pool = {'context': context, 'results': context.Queue(), 'workers': []}
+    pool['workers'] = [start_worker(pool) for _ in range(size)]
+    return pool
+
+# Run jobs on the pool and return all of their results. Each idle worker is handed the next job, and the pool
+# records it until that worker's result arrives. Workers are checked every POLL_SECONDS: a job whose worker
+# died (crash, OOM kill) comes back as a failed result, and the worker is replaced
+def run_jobs(pool, jobs):
+    pending, held, results = list(reversed(jobs)), {}, []
+
+    def hand_out():
+        for handle in pool['workers']:
+            if pending and handle['process'].pid not in held:
+                job = pending.pop()
+                held[handle['process'].pid] = job
+                handle['jobs'].put(job)
+
+    hand_out()
+    while held:
+        try:
+            result = pool['results'].get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            result = None
+        if result is not None:
+            # A result from a worker already reported lost is dropped, so each job has one result
+            if held.pop(result.pop('pid'), None) is not None:
+                results.append(result)
+        else:
+            for i, handle in enumerate(pool['workers']):
+                process = handle['process']
+                if process.is_alive():
+                    continue
+                job = held.pop(process.pid, None)
+                lost = f" while on [red]{job['sample']}[/red]" if job else ""
+                logger.warning(f"{common.EMOJI_WARNING} Extraction worker {process.pid} exited with code {process.exitcode}{lost}, starting a replacement")
+                if job:
+                    results.append({'sample': job['sample'], 'study': job['study'], 'counts': {}, 'error': f"worker lost (exit code {process.exitcode})", 'seconds': 0.0})
+                pool['workers'][i] = start_worker(pool)
+        hand_out()
+    return results
+
+# Stop all workers
+def stop_pool(pool):
+    for handle in pool['workers']:
+        handle['jobs'].put(None)
+    for handle in pool['workers']:
+        handle['process'].join()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# FASTQ manifest for each study: one scan of raw_reads, mates paired, sizes and cached read counts
+# Written to {study}/raw_reads_manifest.tsv and rebuilt when raw_reads changes
+
+import argparse
+import concurrent.futures
+import csv
+import gzip
+import os
+import re
+
+import common
+from get_info import names_list
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+MANIFEST = "raw_reads_manifest.tsv"
+FIELDS = ['sample', 'layout', 'read1', 'read2', 'size1', 'size2', 'mtime1', 'mtime2', 'reads']
+FASTQ_PATTERN = re.compile(r"^(?P<sample>[^_]+?)(?:_(?P<mate>[12]))?\.(?:fastq|fq)(?:\.gz)?$")
+
+# Count the reads of a (gzipped) FASTQ file
+def count_reads(fq_file):
+    opener = gzip.open if fq_file.endswith('.gz') else open
+    n_lines = 0
+    with opener(fq_file, 'rb') as f:
+        while True:
+            chunk = f.read(16 * 1024**2)
+            if not chunk:
+                break
+            n_lines += chunk.count(b'\n')
+    return n_lines // 4
+
+# Read a cached manifest into {sample: row}
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, newline='') as f:
+        return {row['sample']: row for row in csv.DictReader(f, delimiter='\t')}
+
+# Scan raw_reads once and pair mates; read counts are reused from the previous manifest when files are unchanged.
+# With write=False (dry runs) the manifest is only returned
+def build_manifest(study_dir, threads=1, with_counts=True, write=True):
+    raw_reads = os.path.join(study_dir, "raw_reads")
+    manifest_file = os.path.join(study_dir, MANIFEST)
+    previous = read_manifest(manifest_file)
+
+    files = {}
+    with os.scandir(raw_reads) as entries:
+        for entry in entries:
+            match = FASTQ_PATTERN.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            stat = entry.stat()
+            sample_files = files.setdefault(match.group('sample'), {})
+            sample_files[match.group('mate') or '0'] = (entry.path, stat.st_size, int(stat.st_mtime))
+
+    manifest = {}
+    to_count = {}
+    for sample in sorted(files):
+        mates = files[sample]
+        if '1' in mates and '2' in mates:
+            layout, read1, read2 = 'paired', mates['1'], mates['2']
+        elif '0' in mates:
+            layout, read1, read2 = 'single', mates['0'], ("", 0, 0)
+        else:
+            layout, read1, read2 = 'incomplete', mates.get('1', mates.get('2')), ("", 0, 0)
+        row = {
+            'sample': sample, 'layout': layout,
+            'read1': read1[0], 'read2': read2[0],
+            'size1': str(read1[1]), 'size2': str(read2[1]),
+            'mtime1': str(read1[2]), 'mtime2': str(read2[2]),
+            'reads': "",
+        }
+        old = previous.get(sample)
+        if old and all(old[k] == row[k] for k in ['read1', 'read2', 'size1', 'size2', 'mtime1', 'mtime2']):
+            row['reads'] = old['reads']
+        elif with_counts and layout != 'incomplete':
+            to_count[sample] = read1[0]
+        manifest[sample] = row
+
+    if to_count:
+        logger.info(f"{common.EMOJI_PROCESS} Counting reads of {len(to_count)} {p.plural('sample', len(to_count))} in [i dim]{raw_reads}[/]")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+            for sample, n_reads in zip(to_count, executor.map(count_reads, to_count.values())):
+                manifest[sample]['reads'] = str(n_reads)
+
+    if not write:
+        return manifest
+    tmp_file = common.tmp_path(manifest_file)
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(manifest.values())
+    os.replace(tmp_file, manifest_file)
+    return manifest
+
+# Load a study's manifest, rebuilding it if raw_reads changed since it was written
+def load_manifest(study_dir, threads=1, with_counts=False, write=True):
+    raw_reads = os.path.join(study_dir, "raw_reads")
+    manifest_file = os.path.join(study_dir, MANIFEST)
+    if not os.path.isdir(raw_reads):
+        return {}
+    if os.path.exists(manifest_file) and os.stat(manifest_file).st_mtime >= os.stat(raw_reads).st_mtime:
+        return read_manifest(manifest_file)
+    return build_manifest(study_dir, threads, with_counts, write)
+
+# Total input size of a sample's FASTQs in bytes (0 if it is not in the manifest)
+def input_size(manifest, sample):
+    entry = manifest.get(sample)
+    if entry is None:
+        return 0
+    return int(entry['size1'] or 0) + int(entry['size2'] or 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build FASTQ manifests (pairing, sizes, read counts) for each study...")
+    parser.add_argument("-i", "--input", help="Path to the studies list as a text file.", required=True)
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of processes counting reads (Default: 1)")
+    parser.add_argument("-n", "--no_counts", action="store_true", help="Skip read counting")
+    args = parser.parse_args()
+
+    console.print(
+        panel.fit(f"{common.EMOJI_SPARKLE} Building FASTQ manifests...", title=f"Study: {common.study_name.upper()}", title_align="left", border_style='dim bold yellow'),
+        style='italic dim'
+    )
+
+    studies_dir = os.path.dirname(os.path.abspath(args.input))
+    for study in names_list(args.input):
+        manifest = build_manifest(os.path.join(studies_dir, study), args.threads, not args.no_counts)
+        layouts = [row['layout'] for row in manifest.values()]
+        logger.info(f"{common.EMOJI_LIST} [bold]{study}[/]: {layouts.count('paired')} paired, {layouts.count('single')} single-end, {layouts.count('incomplete')} incomplete")
+
+    console.print(
+        panel.fit(f"{common.EMOJI_CHECK} FASTQ manifests created successfully.", title="Success", border_style="green", title_align="right"),
+        style="italic"
+    )
@@ -1,29 +1,32 @@
 #!/usr/bin/python
 
 import argparse
-import inflect
+import glob
 import os
+import sys
 import time
 from rich.console import Group
-from rich.live import Live
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
-from rich.traceback import install
+from rich.progress import SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
 import common
-from get_info import names_list, make_dict
+import fq_manifest
+import planner
+import project_index
+import retention
+from get_info import make_dict
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Rich traceback handler
-install(show_locals=True)
+common.install_traceback()
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 
-# Initiate Progress() object for n_studies
-progress = Progress(
+# Initiate the progress bar for n_studies (logged instead of drawn without the Rich backend)
+progress = common.new_progress(
     SpinnerColumn(spinner_name='dots12', style='blue'),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -33,28 +36,52 @@ progress = Progress(
     console=console,
 )
 
-def get_fq(sub_list, status_sub):
+def get_fq(context, sample, status_sub):
+    study, raw_reads, sra_files = context['study'], context['raw_reads'], context['sra_files']
     env_name = utility_paths["sra-tools"]
-    for sample in sub_list:
-        status_sub.update(f"[i][dim]Retrieving data for[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim]: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+    status_sub.update(f"[i][dim]Retrieving data for[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim] ({context['type']})[/dim][/i] \n", spinner='point', spinner_style='magenta')
 
-        if any(file in os.listdir(raw_reads) for file in [f"{sample}_2.fastq", f"{sample}_2.fastq.gz", f"{sample}.fastq.gz"]):
-            logger.info(f"{common.EMOJI_CHECK} [green]{sample}[/green] already downloaded. Skipping...")
-        else:
-            logger.info(f"{common.EMOJI_DOWNLOAD} Downloading [blue]{sample}.sra[/blue] from NCBI's SRA...")
-            common.run_command(f"mamba run -n {env_name} prefetch {sample} -O {sra_files} -X 150G", desc=f"Fetching {sample}")
-            # logger.debug(f"{common.EMOJI_DOWNLOAD} mamba run -n {env_name} prefetch {sample} -p -O {sra_files}")
-            # os.system(f"touch {sra_files}/{sample}.sra")  # Simulate download
-            # time.sleep(0.2)  # Simulate download time
-            logger.info(f"{common.EMOJI_PROCESS} Extracting FASTQ files from [blue]{sample}.sra[/blue]...")
-            common.run_command(f"mamba run -n {env_name} fasterq-dump {sra_files}/{sample} -3 -O {raw_reads} -e {threads}", desc=f"Extracting {sample}.fastq files")
-            # logger.debug(f"{common.EMOJI_PROCESS} mamba run -n {env_name} fasterq-dump {sra_files}/{sample} -3 -O {raw_reads} -e {threads} -p")
-            # os.system(f"echo 'R1' > {raw_reads}/{sample}_1.fastq")  # Simulate extraction
-            # os.system(f"echo 'R2' > {raw_reads}/{sample}_2.fastq")  # Simulate extraction
-            # os.system(f"echo 'R1' > {raw_reads}/{sample}.fastq")  # Simulate extraction
-            # time.sleep(0.2)  # Simulate extraction time
-        console.rule(f"[dim i]Obtained FASTQ files for [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
-        status_sub.update(f"[i][dim]Fastq files downloaded: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+    if context['manifest'].get(sample, {}).get('layout') in ['paired', 'single']:
+        logger.info(f"{common.EMOJI_CHECK} [green]{sample}[/green] already downloaded. Skipping...")
+    elif os.path.exists(f"{context['base']}/{study}/hostile_out/{sample}_R2.clean_2.fastq.gz"):
+        # Raw reads reclaimed by the retention policy once host removal finished
+        logger.info(f"{common.EMOJI_CHECK} [green]{sample}[/green] already host-filtered (raw reads reclaimed). Skipping...")
+    else:
+        logger.info(f"{common.EMOJI_DOWNLOAD} Downloading [blue]{sample}.sra[/blue] from NCBI's SRA...")
+        common.run_command(f"mamba run -n {env_name} prefetch {sample} -O {sra_files} -X 150G", desc=f"Fetching {sample}")
+        # logger.debug(f"{common.EMOJI_DOWNLOAD} mamba run -n {env_name} prefetch {sample} -p -O {sra_files}")
+        # os.system(f"touch {sra_files}/{sample}.sra")  # Simulate download
+        # time.sleep(0.2)  # Simulate download time
+        logger.info(f"{common.EMOJI_PROCESS} Extracting FASTQ files from [blue]{sample}.sra[/blue]...")
+        # fasterq-dump's scratch files go to the node-local staging area when enabled
+        temp = f" -t {common.staging['root']}/fasterq_tmp" if common.staging_enabled() else ""
+        common.run_command(f"mamba run -n {env_name} fasterq-dump {sra_files}/{sample} -3 -O {raw_reads} -e {threads}{temp}", desc=f"Extracting {sample}.fastq files")
+        # logger.debug(f"{common.EMOJI_PROCESS} mamba run -n {env_name} fasterq-dump {sra_files}/{sample} -3 -O {raw_reads} -e {threads} -p")
+        # os.system(f"echo 'R1' > {raw_reads}/{sample}_1.fastq")  # Simulate extraction
+        # os.system(f"echo 'R2' > {raw_reads}/{sample}_2.fastq")  # Simulate extraction
+        # os.system(f"echo 'R1' > {raw_reads}/{sample}.fastq")  # Simulate extraction
+        # time.sleep(0.2)  # Simulate extraction time
+    console.rule(f"[dim i]Obtained FASTQ files for [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
+    status_sub.update(f"[i][dim]Fastq files downloaded:[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='point', spinner_style='magenta')
+
+# Compress a study's FASTQ files, refresh its manifest and remove its SRA files, as a queue unit (stage is
+# 'raw_reads'), so that with a shared or batch executor each study is compressed once, by one worker
+def compress_study(context, stage, status_sub):
+    study, raw_reads, sra_files = context['study'], context[stage], context['sra_files']
+    status_sub.update(f"[dim]Compressing FASTQ files of [blue]{study}[/blue][/dim]")
+    logger.info(f"{common.EMOJI_ZIP} Compressing FASTQ files of [bold blue]{study}[/]...")
+    if glob.glob(f"{raw_reads}/*.fastq"):
+        common.run_command(f"pigz -v -p {threads} {raw_reads}/*.fastq", desc=f"Compressing fastq files of {study}")
+    # Refresh the manifest with the compressed files and cache their read counts
+    fq_manifest.build_manifest(f"{context['base']}/{study}", threads)
+    # time.sleep(0.5)  # Simulate compression time
+
+    status_sub.update(f"[dim]Removing SRA files of [blue]{study}[/blue][/dim]")
+    logger.info(f"{common.EMOJI_TRASH} Removing SRA files of [bold blue]{study}[/]...\n")
+    common.run_command(f"rm -rv {sra_files}", desc=f'Removing sra files from {study}')
+    # time.sleep(0.2)  # Simulate compression time
+
+    console.rule(f"[dim][i]Completed fetching Fastq files for[/dim] {study}[/i]", characters="-", style='dim')
 
 
 if __name__ == "__main__":
@@ -64,7 +91,14 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
     parser.add_argument("-u", "--utility_paths", help="Envs or Paths for tools and DBs as a CSV file. (Default: utility_paths.csv)", default="utility_paths.csv")
     parser.add_argument("-t", "--threads", type=int, default=1, help="Number of threads (Default: 1)")
-    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3,4,5], nargs="?", default=1, help="Number of sub_lists to make, and run concurrently (Default: no splitting, everything as one list).")
+    parser.add_argument("--stage_dir", help="Node-local directory (NVMe/tmpfs) for fasterq-dump temporary files (Default: off)", default=None)
+    parser.add_argument("--retention", help="Apply the intermediate-artifact retention policy (see retention.py) as samples finish, optionally from a stage,action CSV; 'default' for the built-in policy (Default: off)", default=None)
+    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3,4,5], nargs="?", default=1, help="Number of samples to run concurrently, fed from one queue across all studies (Default: 1)")
+    parser.add_argument("--executor", choices=['local', 'shared', 'slurm', 'slurm_local'], default='local', help="Run sample queues on local threads; 'shared' with other processes started the same way on any nodes, through a queue beside the base dir; or as Slurm job arrays ('slurm_local': on the local sbatch/squeue stand-in, slurm_standin.py) (Default: local)")
+    parser.add_argument("--sbatch_opts", help="Extra sbatch options for the job arrays, e.g. \"--partition=long --account=lab\" (Default: none)", default="")
+    parser.add_argument("--array_limit", type=int, default=0, help="Maximum running tasks per job array (Default: no limit)")
+    parser.add_argument("--job_resources", help="Per-tool memory and time of array tasks as a tool,mem_gb:hours CSV (Default: built-in)", default=None)
+    parser.add_argument("--plan", action="store_true", help="Only print the pending samples with estimated CPU-hours, disk use and makespan (see planner.py)")
     args=parser.parse_args()
 
     console.print(  
@@ -81,6 +115,14 @@ if __name__ == "__main__":
     threads = args.threads
     split_size = args.split_size
 
+    if args.stage_dir:
+        common.configure_staging(args.stage_dir, 0)
+
+    # Compress each sample's reads and drop its SRA files as soon as it is extracted
+    collector = None
+    if args.retention:
+        collector = retention.start_collector(retention.load_policy(args.retention), threads)
+
     utility_paths = make_dict(utility_paths_in)
     console.print(
         panel.fit(
@@ -96,33 +138,34 @@ if __name__ == "__main__":
     else:
         base_dir = os.path.join(os.getcwd(), args.base_dir)
 
-    if args.projects in os.listdir(base_dir):
-        logger.info(f"{common.EMOJI_SPARKLE} Found project file [bold blue]{args.projects}[/] in [bold blue]{args.base_dir}[/].")
-        base_dirs = [base_dir]
-    else:
-        logger.info(f"{common.EMOJI_PROCESS} [bold blue]{args.projects}[/] not in [bold blue]{args.base_dir}[/], searching subdirectories.")
-        # It may work only for one sub-level
-        base_dirs = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if args.projects in os.listdir(os.path.join(base_dir, d))]
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples, write=not args.plan)
+    base_dirs = project_index.base_dirs(index)
+
+    if args.plan:
+        planner.plan_runner(index, base_dir, ['download'], threads, split_size, bool(args.retention))
+        sys.exit(0)
+
+    # Sample queues are shared with other workers, or run as job arrays, when another executor is selected
+    if args.executor != 'local':
+        common.configure_executor(args.executor, f"{base_dir}_executor_work", args.sbatch_opts, args.array_limit, make_dict(args.job_resources) if args.job_resources else None)
 
     # Main status
     status = console.status(f"[i][dim]Initiating on[/dim] {len(base_dirs)} [dim]data types[/dim][/i]")
     # Per-type status (replaced with progress bar)
     # status_st = console.status(f"[i][dim]Initiating per-type retrievals[/dim][/i]")
     
-    # Per-study statuses
-    status_subs = []
-    for i in range(split_size):
-        status_subs.append(console.status(f"[i][dim]Running on[/dim] {i+1} [dim] thread...[/dim][/i]"))
+    # Per-worker statuses, rendered together as one table
+    board = common.StatusBoard(split_size, "[i][dim]Waiting for a sample...[/dim][/i]")
+    status_subs = board.slots
 
-    with Live(Group(status, progress, *status_subs), console=console, transient=True):
+    with common.live(Group(status, progress, board), refresh_per_second=common.BOARD_REFRESH):
         if base_dirs:
+            # Study contexts and one queue of samples across all studies and data types
+            contexts = []
+            jobs = []
             for base in base_dirs:
-                status.update(f"[i][dim]Retrieving data for[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]datasets ({base_dirs.index(base)+1}/{len(base_dirs)})[/dim][/i]")
-
-                console.rule(f"Obtaining FASTQ files for all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
-
-                studies_in = os.path.join(base, args.projects)
-                studies = names_list(studies_in)
+                studies = project_index.studies(index, base)
                 console.print(
                     panel.fit(
                         f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(studies)}[/] [dim]studies in[/] {os.path.basename(base)} [dim]dir[/]", 
@@ -131,48 +174,31 @@ if __name__ == "__main__":
                     ),
                     style='italic'
                 )
-                
-                task = progress.add_task(f"{common.EMOJI_PROCESS} [i][dim]Fetching Fastq files of[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]studies[/dim][/i]", total=len(studies))
                 for study in studies:
-                    # status_st.update(f"[i][dim]Retrieving data for[/dim] [cyan]{os.path.basename(base)}[/cyan] {common.EMOJI_PLAY} [blue]{study}[/blue][dim]:({studies.index(study)+1}/{len(studies)}) | ({base_dirs.index(base)+1}/{len(base_dirs)}) [/dim][/i] \n", spinner='simpleDots', spinner_style='blue')
-
-                    console.rule(f"[dim][i]Obtaining Fastq files for[/dim] {study}[/i]", characters="-", style='dim')
-                    
-                    sra_files = f"{base}/{study}/sra_files"
-                    raw_reads = f"{base}/{study}/raw_reads"
-
-                    os.makedirs(raw_reads, exist_ok=True)
-                    os.makedirs(sra_files, exist_ok=True)
+                    context = common.study_context(base, study, raw_reads="raw_reads", sra_files="sra_files")
+                    os.makedirs(context['raw_reads'], exist_ok=True)
+                    os.makedirs(context['sra_files'], exist_ok=True)
 
-                    samples = names_list(f"{base}/{study}/{samples_in}")
+                    samples = project_index.samples(index, base, study)
                     samples_count = len(samples)
                     logger.info(f"{common.EMOJI_SPARKLE} Project [bold blue]{study}[/] has {samples_count} {p.plural('sample', samples_count)}...")
 
-                    sample_lists = common.get_split_size(split_size, samples)
-
-                    common.run_concurrently(get_fq, split_size, sample_lists, status_subs=status_subs)
-
-                    for status_sub in status_subs:
-                        status_sub.update(f"[dim]Compressing FASTQ files of [blue]{study}[/blue][/dim]")
-                    logger.info(f"{common.EMOJI_ZIP} Compressing FASTQ files of [bold blue]{study}[/]...")
-                    common.run_command(f"pigz -v -p {threads} {raw_reads}/*.fastq", desc=f"Compressing fastq files of {study}")
-                    # time.sleep(0.5)  # Simulate compression time
-                    
-                    for status_sub in status_subs:
-                        status_sub.update(f"[dim]Removing SRA files of [blue]{study}[/blue][/dim]")
-                    logger.info(f"{common.EMOJI_TRASH} Removing SRA files of [bold blue]{study}[/]...\n")
-                    common.run_command(f"rm -rv {sra_files}", desc=f'Removing sra files from {study}')
-                    # time.sleep(0.2)  # Simulate compression time
-                    for status_sub in status_subs:
-                        status_sub.update(f"[dim]Removed SRA files from [blue]{study}[/blue]. Waiting for other processes to finish.[/dim]")
-
-                    console.rule(f"[dim][i]Completed fetching Fastq files for[/dim] {study}[/i]", characters="-", style='dim')
-                    progress.update(task, advance=1)
-
-                console.rule(f"Completed downloading FASTQ files for all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
-                console.print('\n')
-                status.update(f"[i green dim]Retrieved [cyan b]{os.path.basename(base)}[/cyan b] studies[/i green dim]")
-                
+                    context['manifest'] = fq_manifest.load_manifest(f"{base}/{study}")
+                    jobs.extend((context, sample) for sample in samples)
+                    contexts.append(context)
+
+            status.update(f"[i][dim]Retrieving[/dim] {len(jobs)} [dim]samples from[/dim] {len(contexts)} [dim]studies[/dim][/i]")
+            common.run_queue(get_fq, split_size, jobs, status_subs, on_done=(lambda context, sample: retention.submit(collector, context, sample)) if collector else None, resources=common.job_resources(['download'], threads))
+            if collector:
+                status.update("[i][dim]Waiting for the retention policy to finish[/dim][/i]")
+                retention.stop_collector(collector)
+
+            task = progress.add_task(f"{common.EMOJI_PROCESS} [i][dim]Compressing Fastq files of all studies[/dim][/i]", total=len(contexts))
+            common.run_queue(compress_study, 1, [(context, 'raw_reads') for context in contexts], status_subs, on_done=lambda context, stage: progress.update(task, advance=1), resources=common.job_resources(['pigz'], threads))
+
+            console.rule("Completed downloading FASTQ files for all studies", characters="=", style='dim')
+            console.print('\n')
+            status.update(f"[i green dim]Retrieved {len(contexts)} studies[/i green dim]")
             
             console.print(
                 panel.fit(
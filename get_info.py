@@ -2,13 +2,12 @@
 
 import argparse
 import csv
-import inflect
 
 import common
 
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Using rich elements from common.py
 console = common.console
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+# Compact, memory-mappable store for Kraken2 per-read classification output (.out)
+# Layout of a {sample}.kbin directory:
+#   meta.json                      - read count, chunk size, array dtypes
+#   status.bin, taxid.bin          - per-read classification flag (uint8) and taxid (uint32)
+#   len1.bin, len2.bin             - per-mate sequence lengths (uint32, len2 is 0 for single-end)
+#   read_ids.zst, lca.zst          - zstd-compressed side columns, one frame per chunk of reads
+#   read_ids.idx.bin, lca.idx.bin  - byte offset of every frame (uint64)
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import numpy as np
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+import common
+
+# Using logger from common.py
+logger = common.logger
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+CHUNK_SIZE = 65536
+ARRAYS = {'status': 'uint8', 'taxid': 'uint32', 'len1': 'uint32', 'len2': 'uint32'}
+TAXID_PATTERN = re.compile(r"\(taxid (\d+)\)\s*$")
+
+# Parse the taxid column, with or without --use-names
+def parse_taxid(field):
+    match = TAXID_PATTERN.search(field)
+    return int(match.group(1)) if match else int(field)
+
+# Convert one chunk of .out lines into arrays and side columns
+def parse_chunk(lines):
+    n = len(lines)
+    status = np.zeros(n, dtype=np.uint8)
+    taxid = np.zeros(n, dtype=np.uint32)
+    len1 = np.zeros(n, dtype=np.uint32)
+    len2 = np.zeros(n, dtype=np.uint32)
+    read_ids, lcas = [], []
+    for i, line in enumerate(lines):
+        fields = line.rstrip('\n').split('\t')
+        status[i] = fields[0] == 'C'
+        read_ids.append(fields[1])
+        taxid[i] = parse_taxid(fields[2])
+        lengths = fields[3].split('|')
+        len1[i] = int(lengths[0])
+        len2[i] = int(lengths[1]) if len(lengths) > 1 else 0
+        lcas.append(fields[4] if len(fields) > 4 else "")
+    return {'status': status, 'taxid': taxid, 'len1': len1, 'len2': len2}, read_ids, lcas
+
+# Convert a Kraken2 .out file (or '-' for stdin) into a .kbin directory
+def convert(in_file, out_dir, chunk_size=CHUNK_SIZE, level=3):
+    if zstd is None:
+        logger.error(f"{common.EMOJI_CROSS} The [b]zstandard[/b] module is required to write .kbin files. Install it in this environment first.")
+        return None
+
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    compressor = zstd.ZstdCompressor(level=level)
+    array_files = {name: open(os.path.join(tmp_dir, f"{name}.bin"), 'wb') for name in ARRAYS}
+    side_files = {name: open(os.path.join(tmp_dir, f"{name}.zst"), 'wb') for name in ['read_ids', 'lca']}
+    offsets = {name: [0] for name in side_files}
+    n_reads = 0
+
+    def flush(lines):
+        arrays, read_ids, lcas = parse_chunk(lines)
+        for name, array in arrays.items():
+            array_files[name].write(array.tobytes())
+        for name, column in [('read_ids', read_ids), ('lca', lcas)]:
+            frame = compressor.compress("\n".join(column).encode())
+            side_files[name].write(frame)
+            offsets[name].append(offsets[name][-1] + len(frame))
+        return len(lines)
+
+    f = sys.stdin if in_file == '-' else open(in_file)
+    try:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == chunk_size:
+                n_reads += flush(lines)
+                lines = []
+        if lines:
+            n_reads += flush(lines)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        for handle in list(array_files.values()) + list(side_files.values()):
+            handle.close()
+
+    for name, offset in offsets.items():
+        np.asarray(offset, dtype=np.uint64).tofile(os.path.join(tmp_dir, f"{name}.idx.bin"))
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as meta:
+        json.dump({'n_reads': n_reads, 'chunk_size': chunk_size, 'arrays': ARRAYS}, meta)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    logger.info(f"{common.EMOJI_CHECK} Stored {n_reads} classified reads in [i dim]{out_dir}[/]")
+    return n_reads
+
+# Open a .kbin directory; fixed-width columns are memory-mapped
+def open_kbin(kbin_dir):
+    with open(os.path.join(kbin_dir, "meta.json")) as meta:
+        kbin = json.load(meta)
+    kbin['path'] = kbin_dir
+    for name, dtype in kbin['arrays'].items():
+        if kbin['n_reads']:
+            kbin[name] = np.memmap(os.path.join(kbin_dir, f"{name}.bin"), dtype=dtype, mode='r', shape=(kbin['n_reads'],))
+        else:
+            kbin[name] = np.zeros(0, dtype=dtype)
+    for name in ['read_ids', 'lca']:
+        kbin[f"{name}_idx"] = np.fromfile(os.path.join(kbin_dir, f"{name}.idx.bin"), dtype=np.uint64)
+    return kbin
+
+# Indices of reads whose assigned taxid is in a set of taxids
+def reads_in_taxa(kbin, taxids):
+    return np.flatnonzero(np.isin(kbin['taxid'], np.asarray(list(taxids), dtype=np.uint32)))
+
+# Decompress a side column ('read_ids' or 'lca') for the given read indices
+def side_column(kbin, name, indices):
+    if zstd is None:
+        logger.error(f"{common.EMOJI_CROSS} The [b]zstandard[/b] module is required to read .kbin side columns.")
+        return []
+    decompressor = zstd.ZstdDecompressor()
+    indices = np.asarray(indices, dtype=np.int64)
+    chunks = indices // kbin['chunk_size']
+    values = [None] * len(indices)
+    with open(os.path.join(kbin['path'], f"{name}.zst"), 'rb') as f:
+        for chunk in np.unique(chunks):
+            start, end = int(kbin[f"{name}_idx"][chunk]), int(kbin[f"{name}_idx"][chunk + 1])
+            f.seek(start)
+            column = decompressor.decompress(f.read(end - start)).decode().split("\n")
+            for i in np.flatnonzero(chunks == chunk):
+                values[i] = column[indices[i] % kbin['chunk_size']]
+    return values
+
+# Write selected reads back as Kraken2 .out text (taxids without names)
+def write_out(kbin, out_file, indices=None):
+    if indices is None:
+        indices = np.arange(kbin['n_reads'])
+    read_ids = side_column(kbin, 'read_ids', indices)
+    lcas = side_column(kbin, 'lca', indices)
+    with open(out_file, 'w') as f:
+        for i, read_id, lca in zip(indices, read_ids, lcas):
+            length = f"{kbin['len1'][i]}|{kbin['len2'][i]}" if kbin['len2'][i] else f"{kbin['len1'][i]}"
+            f.write(f"{'C' if kbin['status'][i] else 'U'}\t{read_id}\t{kbin['taxid'][i]}\t{length}\t{lca}\n")
+    return len(indices)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Kraken2 per-read output (.out) to a compact memory-mappable .kbin store...")
+    parser.add_argument("-i", "--input", help="Kraken2 .out file, or - to read from stdin.", required=True)
+    parser.add_argument("-o", "--output", help="Output .kbin directory. (Default: input with .kbin suffix)", default=None)
+    parser.add_argument("-c", "--chunk_size", type=int, default=CHUNK_SIZE, help=f"Reads per compressed side-column frame (Default: {CHUNK_SIZE})")
+    parser.add_argument("-r", "--remove", action="store_true", help="Remove the text .out file after a successful conversion")
+    args = parser.parse_args()
+
+    if args.input == '-' and not args.output:
+        parser.error("--output is required when reading from stdin")
+    out_dir = args.output or f"{os.path.splitext(args.input)[0]}.kbin"
+
+    n_reads = convert(args.input, out_dir, args.chunk_size)
+    if n_reads is not None and args.remove and args.input != '-':
+        os.remove(args.input)
+        logger.info(f"{common.EMOJI_TRASH} Removed [i dim]{args.input}[/]")
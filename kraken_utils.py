@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Helpers for reading and writing Kraken2 style reports
+
+import argparse
+import os
+import numpy as np
+
+import common
+
+# Using logger from common.py
+logger = common.logger
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+# Main taxonomic levels, in the order used by Kraken2 and Bracken
+MAIN_LVLS = ['R', 'K', 'D', 'P', 'C', 'O', 'F', 'G', 'S']
+
+# NCBI rank names to Kraken2 report codes
+RANK_CODES = {'superkingdom': 'D', 'domain': 'D', 'kingdom': 'K', 'phylum': 'P', 'class': 'C', 'order': 'O', 'family': 'F', 'genus': 'G', 'species': 'S'}
+
+# Parse a single line of a Kraken2 report
+def parse_kreport_line(line):
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) < 6:
+        return None
+    # Standard report: pct, clade, taxon, rank, taxid, name
+    # Reports with minimizer data have two extra columns before rank
+    if len(fields) >= 8:
+        fields = fields[:3] + fields[5:]
+    name = fields[5]
+    depth = (len(name) - len(name.lstrip(' '))) // 2
+    return {
+        'pct': float(fields[0]),
+        'clade': int(fields[1]),
+        'taxon': int(fields[2]),
+        'rank': fields[3],
+        'taxid': fields[4].strip(),
+        'name': name.strip(),
+        'depth': depth,
+    }
+
+# Read a Kraken2 report into a list of nodes (report order), each with a parent index
+def read_kreport(in_file):
+    nodes = []
+    stack = []
+    with open(in_file) as f:
+        for line in f:
+            node = parse_kreport_line(line)
+            if node is None:
+                continue
+            if node['rank'] == 'U' or node['taxid'] == '0':
+                node['parent'] = None
+                nodes.append(node)
+                continue
+            while stack and nodes[stack[-1]]['depth'] >= node['depth']:
+                stack.pop()
+            node['parent'] = stack[-1] if stack else None
+            stack.append(len(nodes))
+            nodes.append(node)
+    return nodes
+
+# Map taxid to clade read counts from a Kraken2 report
+def clade_counts(in_file):
+    return {node['taxid']: node['clade'] for node in read_kreport(in_file)}
+
+# Taxids of a taxon and all of its descendants in a report
+def clade_taxids(nodes, taxid):
+    taxid = str(taxid)
+    in_clade = [False] * len(nodes)
+    for i, node in enumerate(nodes):
+        parent = node['parent']
+        in_clade[i] = node['taxid'] == taxid or (parent is not None and in_clade[parent])
+    return {int(node['taxid']) for i, node in enumerate(nodes) if in_clade[i]}
+
+# Load the taxonomy of a Kraken2 database, from taxonomy/nodes.dmp + names.dmp or ktaxonomy.tsv
+# Returns sorted external taxids, and parent index (-1 for root), rank code and name per taxon
+def load_taxonomy(db_path):
+    taxids, parents, ranks, names = [], [], [], {}
+    nodes_file = os.path.join(db_path, "taxonomy", "nodes.dmp")
+    if os.path.exists(nodes_file):
+        with open(nodes_file) as f:
+            for line in f:
+                fields = line.split('\t|\t')
+                taxids.append(int(fields[0]))
+                parents.append(int(fields[1]))
+                ranks.append(RANK_CODES.get(fields[2].strip(), '-'))
+        with open(os.path.join(db_path, "taxonomy", "names.dmp")) as f:
+            for line in f:
+                fields = line.split('\t|\t')
+                if 'scientific name' in fields[3]:
+                    names[int(fields[0])] = fields[1]
+    else:
+        with open(os.path.join(db_path, "ktaxonomy.tsv")) as f:
+            for line in f:
+                fields = [field.strip() for field in line.split('|')]
+                taxids.append(int(fields[0]))
+                parents.append(int(fields[1]))
+                ranks.append(fields[2] if fields[2] in MAIN_LVLS else '-')
+                names[int(fields[0])] = fields[4]
+
+    taxids = np.asarray(taxids, dtype=np.int64)
+    order = np.argsort(taxids)
+    taxids = taxids[order]
+    parent_taxids = np.asarray(parents, dtype=np.int64)[order]
+    pos = np.minimum(np.searchsorted(taxids, parent_taxids), len(taxids) - 1)
+    parent = np.where((taxids[pos] == parent_taxids) & (parent_taxids != taxids), pos, -1)
+    ranks = [ranks[i] for i in order]
+    for i in np.flatnonzero(parent == -1):
+        ranks[i] = 'R'
+    logger.info(f"{common.EMOJI_SPARKLE} Loaded {len(taxids)} taxa from [i dim]{db_path}[/]")
+    return {'taxids': taxids, 'parent': parent, 'rank': ranks, 'name': [names.get(int(t), str(t)) for t in taxids]}
+
+# Normalise rank codes so that unranked nodes carry the nearest main level with a depth suffix (e.g. G1, S2)
+def resolve_rank_codes(nodes):
+    codes = []
+    for node in nodes:
+        code = node['rank']
+        parent = node['parent']
+        if code == '-' or (len(code) > 1 and parent is not None):
+            parent_code = codes[parent] if parent is not None else 'R'
+            if parent_code in MAIN_LVLS:
+                code = parent_code + '1'
+            else:
+                code = parent_code[:-1] + str(int(parent_code[-1]) + 1)
+        codes.append(code)
+    return codes
+
+# Write nodes as a Kraken2 report, children ordered by clade reads, skipping empty clades
+def write_kreport(out_file, nodes, total_reads=None):
+    children = {}
+    roots = []
+    for i, node in enumerate(nodes):
+        if node['clade'] <= 0:
+            continue
+        if node['parent'] is None:
+            roots.append(i)
+        else:
+            children.setdefault(node['parent'], []).append(i)
+
+    if total_reads is None:
+        total_reads = sum(nodes[i]['clade'] for i in roots)
+
+    # Unclassified line first, followed by the tree in depth-first order
+    roots.sort(key=lambda i: (nodes[i]['rank'] != 'U', -nodes[i]['clade']))
+    with open(out_file, 'w') as f:
+        stack = list(reversed(roots))
+        while stack:
+            i = stack.pop()
+            node = nodes[i]
+            pct = 100 * node['clade'] / total_reads if total_reads else 0.0
+            f.write(f"{pct:0.2f}\t{node['clade']}\t{node['taxon']}\t{node['rank']}\t{node['taxid']}\t{'  ' * node['depth']}{node['name']}\n")
+            kids = sorted(children.get(i, []), key=lambda k: nodes[k]['clade'], reverse=True)
+            stack.extend(reversed(kids))
+
+# Merge reports of read-disjoint shards of one sample into a single report
+def merge_kreports(reports, out_file):
+    merged = []
+    index = {}
+    for report in reports:
+        nodes = read_kreport(report)
+        for node in nodes:
+            taxid = node['taxid']
+            if taxid in index:
+                merged[index[taxid]]['clade'] += node['clade']
+                merged[index[taxid]]['taxon'] += node['taxon']
+            else:
+                parent = node['parent']
+                index[taxid] = len(merged)
+                merged.append(dict(node, parent_taxid=nodes[parent]['taxid'] if parent is not None else None))
+
+    # Re-link parents by taxid within the merged list
+    for node in merged:
+        node['parent'] = index.get(node['parent_taxid']) if node['parent_taxid'] is not None else None
+    write_kreport(out_file, merged)
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise a Kraken2 report...")
+    parser.add_argument("-i", "--input", help="Kraken2 report file.", required=True)
+    args = parser.parse_args()
+
+    nodes = read_kreport(args.input)
+    total = sum(node['clade'] for node in nodes if node['parent'] is None)
+    console.print(
+        panel.fit(
+            f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(nodes)}[/] [dim]taxa and[/] [bold]{total}[/] [dim]reads in[/] {os.path.basename(args.input)}",
+            title="Kraken2 report",
+            border_style='dim cyan'
+        ),
+        style='italic'
+    )
@@ -1,46 +1,64 @@
 #!/usr/bin/python
 
 import argparse
-import inflect  
 import os
-import pandas as pd
 
 import common
+import project_index
 
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 progress = common.progress
 
-def list_to_text(file_path, items):
+# Data type directory for each study alias prefix
+TYPE_DIRS = {'a_': 'all_data/amp', 'w_': 'all_data/sg', 'm_': 'all_data/mix'}
+
+def list_to_text(file_path, items, mode='w'):
     try:
-        with open(file_path, 'w') as f:
+        with open(file_path, mode) as f:
             for item in items:
                 f.write(f"{item}\n")
-        logger.info(f"{common.EMOJI_LIST} Created text file at: [italic dim]{file_path}[/] with {len(items)} entries.")
+        if mode == 'w':
+            logger.info(f"{common.EMOJI_LIST} Created text file at: [italic dim]{file_path}[/] with {len(items)} entries.")
     except IOError as e:
         logger.error(f"{common.EMOJI_CROSS} Error writing to file: {e}")
         console.print_exception(show_locals=True)
 
-def make_dir_file(study, path_prefix):
+def make_dir_file(study, path_prefix, run_ids):
     study_dir = os.path.join(os.getcwd(), path_prefix, study)
     os.makedirs(study_dir, exist_ok=True)
     logger.info(f":file_cabinet: Created directory for study: [bold blue]{study}[/] at [italic dim]{study_dir}[/]")
     
-    study_df = df[df['Study_Alias'] == study]
-    run_ids = study_df['Run'].tolist()
     run_file_path = os.path.join(study_dir, "samples_list.txt")
     list_to_text(run_file_path, run_ids)
 
+# Read the CSV in chunks and append each chunk's runs to their study's samples list, in a single pass with bounded memory
+def stream_runs(in_file, chunk_size, task):
+    studies = {}
+    import pandas as pd
+    for chunk in pd.read_csv(in_file, usecols=['Study_Alias', 'Run'], dtype=str, chunksize=chunk_size):
+        for study, runs in chunk.groupby('Study_Alias', sort=False)['Run']:
+            if study not in studies:
+                studies[study] = TYPE_DIRS.get(study[:2])
+                if studies[study] is None:
+                    logger.warning(f"{common.EMOJI_WARNING} Study alias [bold]{study}[/] does not match expected prefixes. Skipping...")
+                else:
+                    make_dir_file(study, studies[study], [])
+            if studies[study] is not None:
+                list_to_text(os.path.join(os.getcwd(), studies[study], study, "samples_list.txt"), runs.tolist(), mode='a')
+        progress.update(task, advance=len(chunk))
+    return studies
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a dataframe from CSV file and create required files and directories...")
     parser.add_argument("-i", "--input", help="Path to the input CSV file.")
+    parser.add_argument("-c", "--chunk_size", type=int, help="Stream the CSV in chunks of this many rows instead of loading it whole (Default: off)")
     args = parser.parse_args()
 
     if args.input:
@@ -49,39 +67,44 @@ if __name__ == "__main__":
             style='italic dim'
         )
 
-        df = pd.read_csv(args.input)
-        # console.print(df.head(), style="dim")
+        with progress:
+            if args.chunk_size:
+                task = progress.add_task(f"{common.EMOJI_PROCESS} Streaming runs into files and directories...", total=None)
+                studies = stream_runs(args.input, args.chunk_size, task)
+                logger.info(f"{common.EMOJI_SPARKLE} Found {len(studies)} unique studies in the CSV file.")
+            else:
+                import pandas as pd
+                df = pd.read_csv(args.input)
+                # console.print(df.head(), style="dim")
 
-        # Create a list of unique Study_Aliases from the dataframe
-        studies = df['Study_Alias'].unique().tolist()
-        logger.info(f"{common.EMOJI_SPARKLE} Found {len(studies)} unique studies in the CSV file.")
+                # Group runs by Study_Alias once, in order of first appearance
+                study_runs = df.groupby('Study_Alias', sort=False)['Run']
+                logger.info(f"{common.EMOJI_SPARKLE} Found {study_runs.ngroups} unique studies in the CSV file.")
 
-        with progress:
-            task = progress.add_task(f"{common.EMOJI_PROCESS} Generating files and directories...", total=len(studies))
-                
-            for study in studies:
-                if study.startswith('a_'):
-                    path_prefix = 'all_data/amp'
-                    make_dir_file(study, path_prefix)
-                    # time.sleep(0.05) # For testing progress bar
-                elif study.startswith('w_'):
-                    path_prefix = 'all_data/sg'
-                    make_dir_file(study, path_prefix)
-                    # time.sleep(0.05) # For testing progress bar
-                elif study.startswith('m_'):
-                    path_prefix = 'all_data/mix'
-                    make_dir_file(study, path_prefix)
-                    # time.sleep(0.05) # For testing progress bar
-                else:
-                    logger.warning(f"{common.EMOJI_WARNING} Study alias [bold]{study}[/] does not match expected prefixes. Skipping...")
-                
-                progress.update(task, advance=1)
+                task = progress.add_task(f"{common.EMOJI_PROCESS} Generating files and directories...", total=study_runs.ngroups)
+                for study, runs in study_runs:
+                    path_prefix = TYPE_DIRS.get(study[:2])
+                    if path_prefix:
+                        make_dir_file(study, path_prefix, runs.tolist())
+                        # time.sleep(0.05) # For testing progress bar
+                    else:
+                        logger.warning(f"{common.EMOJI_WARNING} Study alias [bold]{study}[/] does not match expected prefixes. Skipping...")
+                    
+                    progress.update(task, advance=1)
 
-        for type_dir in os.listdir('all_data'):
-            type_list = os.listdir(os.path.join('all_data', type_dir))
-            type_path = os.path.join('all_data', type_dir, 'studies_list.txt')
+        # Studies lists go only into the data type dirs, not into the index, metrics or scratch files kept beside them
+        base_dir = os.path.join(os.getcwd(), 'all_data')
+        for type_dir in sorted(set(TYPE_DIRS.values())):
+            type_dir = os.path.join(os.getcwd(), type_dir)
+            if not os.path.isdir(type_dir):
+                continue
+            type_list = [d for d in os.listdir(type_dir) if os.path.isdir(os.path.join(type_dir, d))]
+            type_path = os.path.join(type_dir, 'studies_list.txt')
             list_to_text(type_path, type_list)
 
+        # Persist the tree so runners can skip the discovery walk; the runners key it by the absolute base dir
+        project_index.load_index(base_dir)
+
         console.print(
             panel.fit(f"{common.EMOJI_CHECK} Files and directories created successfully.", title="Success", border_style="green", title_align="right"),
             style="italic"
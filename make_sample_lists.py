@@ -3,14 +3,12 @@
 # Paths are relative in this file
 
 import argparse
-import inflect
-import os
 
-import common, get_info
+import common, fq_manifest, get_info
 
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Using rich elements from common.py
 console = common.console
@@ -31,7 +29,9 @@ if __name__ == "__main__":
         studies = get_info.names_list(args.input)
 
         for study in studies:
-            os.system(f"ls {study}/raw_reads/ | sed 's/_.*//g' | sort | uniq > {study}/samples_list.txt")
+            manifest = fq_manifest.load_manifest(study)
+            with open(f"{study}/samples_list.txt", 'w') as f:
+                f.writelines(f"{sample}\n" for sample in sorted(manifest))
 
             logger.warning(f"{common.EMOJI_LIST} List of samples generated for [bold]{study}[/].")
         
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+# Sparse rows x features matrix store, shared by the taxon and AMR gene matrices
+# Layout of a store directory:
+#   rows.tsv, cols.tsv                    - row (sample) and column (feature) annotations
+#   csr_{data,indices,indptr}.npy         - row-major copy, for slicing by sample/study
+#   csc_{data,indices,indptr}.npy         - column-major copy, for slicing by feature
+# The .npy files are plain arrays, so they can be opened with mmap_mode='r'
+
+import csv
+import os
+import numpy as np
+import scipy.sparse as sp
+
+import common
+
+# Using logger from common.py
+logger = common.logger
+
+# Read an annotation table into a header and a list of rows
+def read_table(in_file):
+    if not os.path.exists(in_file):
+        return [], []
+    with open(in_file, newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader, [])
+        return header, [row for row in reader]
+
+# Write an annotation table atomically
+def write_table(out_file, header, rows):
+    tmp_file = f"{out_file}.tmp"
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_file, out_file)
+
+# Save matrices as separate, memory-mappable arrays: all are written to temp files first, then renamed together
+# layouts: {prefix: matrix}
+def save_arrays(store, layouts):
+    written = []
+    for prefix, matrix in layouts.items():
+        for name in ['data', 'indices', 'indptr']:
+            tmp_file = os.path.join(store, f"{prefix}_{name}.tmp.npy")
+            np.save(tmp_file, getattr(matrix, name))
+            written.append((tmp_file, os.path.join(store, f"{prefix}_{name}.npy")))
+    for tmp_file, out_file in written:
+        os.replace(tmp_file, out_file)
+
+# Column-major arrays of an interrupted append, without the rows and columns that never made it into the tables
+def trim_csc(arrays, shape):
+    indptr = np.asarray(arrays[2][:shape[1] + 1])
+    end = int(indptr[-1])
+    data, indices = np.asarray(arrays[0][:end]), np.asarray(arrays[1][:end])
+    keep = indices < shape[0]
+    col_of = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    counts = np.bincount(col_of[keep], minlength=shape[1])
+    return [data[keep], indices[keep], np.r_[0, np.cumsum(counts)].astype(indptr.dtype)]
+
+# Load a store; arrays are memory-mapped unless mmap=False
+def load_store(store, mmap=True, layout='csr'):
+    row_header, rows = read_table(os.path.join(store, "rows.tsv"))
+    col_header, cols = read_table(os.path.join(store, "cols.tsv"))
+    shape = (len(rows), len(cols))
+    if not rows:
+        matrix = sp.csr_matrix(shape, dtype=np.float64)
+    else:
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(store, f"{layout}_{name}.npy"), mmap_mode=mode) for name in ['data', 'indices', 'indptr']]
+        if layout == 'csr' and len(arrays[2]) > shape[0] + 1:
+            # Interrupted append: ignore rows that never made it into rows.tsv
+            end = int(arrays[2][shape[0]])
+            arrays = [arrays[0][:end], arrays[1][:end], arrays[2][:shape[0] + 1]]
+        elif layout == 'csc':
+            committed = int(np.load(os.path.join(store, "csr_indptr.npy"), mmap_mode='r')[shape[0]])
+            if len(arrays[2]) != shape[1] + 1 or int(arrays[2][-1]) != committed:
+                arrays = trim_csc(arrays, shape)
+        matrix_cls = sp.csr_matrix if layout == 'csr' else sp.csc_matrix
+        matrix = matrix_cls(tuple(arrays), shape=shape, copy=False)
+    return {'matrix': matrix, 'row_header': row_header, 'rows': rows, 'col_header': col_header, 'cols': cols}
+
+# Append new rows, adding any unseen features as new columns
+# new_rows: list of (row annotation list, {feature key: value})
+# col_meta: {feature key: annotation list (without the key)}
+def append_rows(store, row_header, col_header, new_rows, col_meta):
+    os.makedirs(store, exist_ok=True)
+    current = load_store(store, mmap=False)
+    rows, cols = current['rows'], current['cols']
+    seen_rows = {tuple(row[:len(row_header)]) for row in rows}
+    col_index = {col[0]: i for i, col in enumerate(cols)}
+
+    data, indices, indptr = [], [], [0]
+    added = []
+    for row_meta, values in new_rows:
+        if tuple(row_meta) in seen_rows:
+            continue
+        seen_rows.add(tuple(row_meta))
+        for key, value in values.items():
+            if value == 0:
+                continue
+            if key not in col_index:
+                col_index[key] = len(cols)
+                cols.append([key] + list(col_meta.get(key, [""] * (len(col_header) - 1))))
+            indices.append(col_index[key])
+            data.append(value)
+        indptr.append(len(indices))
+        added.append(list(row_meta))
+
+    if not added:
+        logger.info(f"{common.EMOJI_CHECK} No new rows for [i dim]{store}[/]. Nothing to append...")
+        return 0
+
+    old = current['matrix']
+    old.resize((len(rows), len(cols)))
+    new = sp.csr_matrix(
+        (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(added), len(cols)),
+    )
+    matrix = sp.vstack([old, new], format='csr')
+    matrix.sort_indices()
+
+    # Arrays first, annotations last: rows.tsv defines the committed shape
+    save_arrays(store, {'csr': matrix, 'csc': matrix.tocsc()})
+    write_table(os.path.join(store, "cols.tsv"), col_header, cols)
+    write_table(os.path.join(store, "rows.tsv"), row_header, rows + added)
+    logger.info(f"{common.EMOJI_CHECK} Appended {len(added)} rows to [i dim]{store}[/] ({matrix.shape[0]} x {matrix.shape[1]}, {matrix.nnz} non-zero)")
+    return len(added)
+
+# Row indices whose annotation in column `field` is one of `values`
+def select_rows(store_obj, field, values):
+    i = store_obj['row_header'].index(field)
+    values = set(values)
+    return np.array([n for n, row in enumerate(store_obj['rows']) if row[i] in values], dtype=np.int64)
+
+# Column indices whose annotation in column `field` is one of `values`
+def select_cols(store_obj, field, values):
+    i = store_obj['col_header'].index(field)
+    values = set(values)
+    return np.array([n for n, col in enumerate(store_obj['cols']) if col[i] in values], dtype=np.int64)
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# Dry-run planner: pending (study, sample, stage) units, with CPU-hours, extra disk and makespan estimates
+# Times come from the tools' fitted throughput curves in run_metrics.tsv (see autotune.py), or from the rough
+# DEFAULT_SECONDS_PER_GB when a tool has no recorded runs. Runners run their stages one after another, each as
+# one queue over all samples (largest first), so the makespan is the sum of the stages' list-scheduled makespans.
+
+import argparse
+import glob
+import heapq
+import os
+import shutil
+import statistics
+
+from rich.table import Table
+
+import autotune
+import common
+import fq_manifest
+import project_index
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+# Seconds per GB of raw input at any thread count, used for tools without recorded runs
+DEFAULT_SECONDS_PER_GB = {'download': 120, 'BBDuk': 60, 'fastp': 40, 'FastQC': 30, 'Hostile': 240, 'Kraken2': 90, 'AMR++': 1800}
+
+# Input size when a sample is not downloaded yet and its study has no known sizes
+DEFAULT_SAMPLE_GB = 2
+
+# Pipeline stages in run order. Sizes are relative to the sample's raw input:
+# 'adds' is kept on disk when the unit finishes, 'peak' is held only while it runs, 'frees' is reclaimed by
+# the retention policy (retention.py) once the stage is done
+STAGES = {
+    'download': {'runner': 'get_fq_files', 'level': 'sample', 'tools': ['download'], 'done': ['raw_reads/{sample}[._]*fastq.gz'], 'adds': 1.0, 'peak': 5.0, 'frees': {}},
+    'qc': {'runner': 'run_qc_sg_host', 'level': 'sample', 'tools': ['BBDuk', 'fastp'], 'done': ['fp_out/{sample}_R2.fq.gz'], 'alt_done': ['hostile_out/{sample}_R2.clean_2.fastq.gz'], 'adds': 1.85, 'peak': 0.0, 'frees': {}, 'study_tools': {'FastQC': 3}},
+    'hostile': {'runner': 'run_qc_sg_host', 'level': 'sample', 'tools': ['Hostile'], 'done': ['hostile_out/{sample}_R2.clean_2.fastq.gz'], 'adds': 0.85, 'peak': 0.0, 'frees': {'bb_out': 0.95, 'fp_out': 0.9}},
+    'kraken': {'runner': 'run_kraken', 'level': 'sample', 'tools': ['Kraken2'], 'done': ['kraken_out/{sample}/{sample}_mpa.txt'], 'adds': 1.2, 'peak': 0.0, 'frees': {'kraken_out': 1.0}},
+    'amr': {'runner': 'run_amr', 'level': 'study', 'tools': ['AMR++'], 'done': ['amr_out/Results/*'], 'adds': 0.05, 'peak': 3.0, 'frees': {}},
+}
+
+# Whether all patterns (relative to the study dir) match an existing path
+def unit_done(study_dir, patterns, sample=None):
+    return bool(patterns) and all(glob.glob(f"{study_dir}/{pattern.format(sample=sample)}") for pattern in patterns)
+
+# Seconds for one run of a tool on input_gb at n_threads: fitted curve, else the default rate
+def tool_seconds(metrics_file, tool, input_gb, n_threads):
+    curve = autotune.fit_curve(autotune.read_metrics(metrics_file, tool), input_gb) if metrics_file else None
+    if curve is None:
+        return input_gb * DEFAULT_SECONDS_PER_GB.get(tool, 60), 'default'
+    return autotune.sample_seconds(curve, n_threads, input_gb), 'measured'
+
+# Raw input size in GB of every sample in the index; undownloaded samples get their study's median (or the default).
+# Manifests are read without rewriting them, so planning leaves the tree untouched
+def raw_sizes(index):
+    sizes = {}
+    for base in project_index.base_dirs(index):
+        for study in project_index.studies(index, base):
+            manifest = fq_manifest.load_manifest(f"{base}/{study}", write=False)
+            known = {sample: fq_manifest.input_size(manifest, sample) / 1024**3 for sample in project_index.samples(index, base, study) if fq_manifest.input_size(manifest, sample)}
+            fallback = statistics.median(known.values()) if known else DEFAULT_SAMPLE_GB
+            for sample in project_index.samples(index, base, study):
+                sizes[(base, study, sample)] = known.get(sample, fallback)
+    return sizes
+
+# List-schedule jobs (largest first) on n_workers; returns the makespan and the jobs of the last worker to finish
+def schedule(jobs, n_workers):
+    workers = [(0.0, i, []) for i in range(max(1, n_workers))]
+    heapq.heapify(workers)
+    for job in sorted(jobs, key=lambda job: -job['seconds']):
+        finish, i, assigned = heapq.heappop(workers)
+        heapq.heappush(workers, (finish + job['seconds'], i, assigned + [job]))
+    finish, _, assigned = max(workers)
+    return finish, assigned
+
+# Plan the given stages over the project index with the runners' threads and concurrency.
+# tool_threads ({tool: threads}) and splits ({stage: concurrent samples}) are what the runner will use after its
+# autotuning and overrides; other tools get threads (study-level ones threads * split_size), other stages split_size
+def plan_stages(index, stages, threads, split_size, metrics_file=None, retention=False, tool_threads=None, splits=None):
+    tool_threads, splits = tool_threads or {}, splits or {}
+    sizes = raw_sizes(index)
+    plan = {'stages': [], 'cpu_hours': 0.0, 'makespan': 0.0, 'peak_gb': 0.0, 'sources': set()}
+    disk_gb = 0.0
+    for name in stages:
+        stage = STAGES[name]
+        stage_split = splits.get(name, split_size)
+        jobs, study_seconds, study_cpu = [], 0.0, 0.0
+        for base in project_index.base_dirs(index):
+            for study in project_index.studies(index, base):
+                study_dir = f"{base}/{study}"
+                samples = project_index.samples(index, base, study)
+                if stage['level'] == 'study':
+                    if not unit_done(study_dir, stage['done']):
+                        jobs.append({'unit': f"{os.path.basename(base)}/{study}", 'gb': sum(sizes[(base, study, sample)] for sample in samples)})
+                    continue
+                pending = [sample for sample in samples if not (unit_done(study_dir, stage['done'], sample) or unit_done(study_dir, stage.get('alt_done', []), sample))]
+                jobs.extend({'unit': f"{os.path.basename(base)}/{study}/{sample}", 'gb': sizes[(base, study, sample)]} for sample in pending)
+                # Study-level tools (FastQC) run one study at a time, with the threads the runner gives them
+                for tool, n_runs in stage.get('study_tools', {}).items():
+                    if pending:
+                        n_threads = tool_threads.get(tool, threads * split_size)
+                        seconds, source = tool_seconds(metrics_file, tool, sum(sizes[(base, study, sample)] for sample in samples), n_threads)
+                        study_seconds += n_runs * seconds
+                        study_cpu += n_runs * seconds * n_threads
+                        plan['sources'].add(source)
+
+        cpu = study_cpu
+        for job in jobs:
+            job['seconds'] = 0.0
+            for tool in stage['tools']:
+                n_threads = tool_threads.get(tool, threads)
+                seconds, source = tool_seconds(metrics_file, tool, job['gb'], n_threads)
+                job['seconds'] += seconds
+                cpu += seconds * n_threads
+                plan['sources'].add(source)
+        makespan, critical = schedule(jobs, stage_split)
+        makespan += study_seconds
+
+        # Disk: outputs kept, plus what the largest concurrent units hold while running
+        pending_gb = sum(job['gb'] for job in jobs)
+        running_gb = sum(sorted((job['gb'] for job in jobs), reverse=True)[:stage_split]) * stage['peak']
+        plan['peak_gb'] = max(plan['peak_gb'], disk_gb + pending_gb * stage['adds'] + running_gb)
+        disk_gb += pending_gb * stage['adds']
+        if retention:
+            disk_gb -= pending_gb * sum(stage['frees'].values())
+
+        cpu_hours = cpu / 3600
+        plan['cpu_hours'] += cpu_hours
+        plan['makespan'] += makespan
+        plan['stages'].append({'stage': name, 'runner': stage['runner'], 'pending': len(jobs), 'gb': pending_gb, 'cpu_hours': cpu_hours, 'makespan': makespan, 'critical': critical, 'study_seconds': study_seconds})
+    plan['final_gb'] = disk_gb
+    return plan
+
+# Print the plan: per-stage table, totals and the critical path
+def show_plan(plan, base_dir):
+    table = Table(title="Execution plan", title_style='dim', border_style='dim cyan')
+    for column in ["Stage", "Runner", "Pending", "Input GB", "CPU-hours", "Makespan (h)"]:
+        table.add_column(column)
+    for stage in plan['stages']:
+        table.add_row(stage['stage'], stage['runner'], str(stage['pending']), f"{stage['gb']:.1f}", f"{stage['cpu_hours']:.1f}", f"{stage['makespan']/3600:.1f}")
+    console.print(table)
+
+    free_gb = shutil.disk_usage(base_dir).free / 1024**3
+    logger.info(f"{common.EMOJI_PROCESS} Total: {plan['cpu_hours']:.1f} CPU-hours, makespan {plan['makespan']/3600:.1f} h")
+    logger.info(f"{common.EMOJI_PROCESS} Extra disk: peak {plan['peak_gb']:.1f} GB, {plan['final_gb']:.1f} GB at the end ({free_gb:.1f} GB free)")
+    if plan['peak_gb'] > free_gb:
+        logger.warning(f"{common.EMOJI_WARNING} The estimated peak disk use exceeds the free space in [i dim]{base_dir}[/]")
+    if 'default' in plan['sources']:
+        logger.warning(f"{common.EMOJI_WARNING} Some tools have no recorded runs: their times use default rates and are rough")
+
+    # Critical path: in each stage, the jobs of the worker that finishes last
+    console.rule("Critical path", characters="-", style='dim')
+    for stage in plan['stages']:
+        if not stage['critical'] and not stage['study_seconds']:
+            continue
+        path = [f"{job['unit']} ({job['seconds']/3600:.1f} h)" for job in stage['critical']]
+        if stage['study_seconds']:
+            path.append(f"per-study FastQC ({stage['study_seconds']/3600:.1f} h)")
+        console.print(f"{common.EMOJI_LIST} [bold]{stage['stage']}[/] [dim]({stage['makespan']/3600:.1f} h):[/] {' -> '.join(path)}")
+
+# --plan mode of the runners: plan their stages with the base dir's recorded metrics
+def plan_runner(index, base_dir, stages, threads, split_size, retention=False, tool_threads=None, splits=None):
+    show_plan(plan_stages(index, stages, threads, split_size, os.path.join(base_dir, autotune.METRICS_FILE), retention, tool_threads, splits), base_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the CPU-hours, disk and makespan of the pending pipeline stages...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-g", "--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to plan, in run order (Default: all)")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Threads per tool run (Default: 1)")
+    parser.add_argument("-l", "--split_size", type=int, default=1, help="Concurrent samples per stage (Default: 1)")
+    parser.add_argument("-r", "--retention", action="store_true", help="Assume the default retention policy reclaims intermediates")
+    args = parser.parse_args()
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    index = project_index.load_index(base_dir, args.projects, args.samples, write=False)
+    plan_runner(index, base_dir, args.stages, args.threads, args.split_size, args.retention)
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+# Preview tree: a deterministic subset of read pairs from every raw sample, mirrored into a separate base dir
+# A pair is kept when the hash of its read name (shared by both mates) falls below the fraction, so the same
+# pairs are picked on every run and a larger fraction keeps a superset of a smaller one. Run the pipeline on it with -b.
+
+import argparse
+import concurrent.futures
+import gzip
+import json
+import os
+import shutil
+import zlib
+
+
+import common
+import fq_manifest
+import project_index
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+PARAMS_FILE = "preview_params.json"
+
+# FASTQ records (4 lines) of a (gzipped) file
+def read_records(fq_file):
+    opener = gzip.open if fq_file.endswith('.gz') else open
+    with opener(fq_file, 'rb') as f:
+        while True:
+            record = [f.readline() for _ in range(4)]
+            if not record[0]:
+                break
+            yield record
+
+# Read name without the mate suffix, identical for both mates of a pair
+def pair_name(header):
+    name = header[1:].split(None, 1)[0]
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+# Deterministic keep decision for a pair: hash of its name and the seed, against the fraction
+def keep_pair(name, fraction, seed):
+    return zlib.crc32(name, seed) < fraction * 2**32
+
+# Stream a sample's reads in mate lockstep and write the kept pairs; returns the number of pairs written
+def subsample(read1, read2, out1, out2, fraction=1.0, max_reads=None, seed=0):
+    inputs = [read_records(read1)] + ([read_records(read2)] if read2 else [])
+    outputs = [out1] + ([out2] if read2 else [])
+    handles = [gzip.open(f"{out}.tmp", 'wb', compresslevel=1) for out in outputs]
+    n_kept = 0
+    try:
+        for records in zip(*inputs):
+            names = [pair_name(record[0]) for record in records]
+            if len(set(names)) > 1:
+                raise ValueError(f"Mates out of sync in {read1}: {names[0].decode()} != {names[1].decode()}")
+            if not keep_pair(names[0], fraction, seed):
+                continue
+            for handle, record in zip(handles, records):
+                handle.writelines(record)
+            n_kept += 1
+            if max_reads and n_kept >= max_reads:
+                break
+    finally:
+        for handle in handles:
+            handle.close()
+    for out in outputs:
+        os.replace(f"{out}.tmp", out)
+    return n_kept
+
+# Fraction of pairs to keep for a sample: the fixed fraction, or enough to reach max_reads from its read count
+def sample_fraction(entry, fraction, max_reads):
+    if max_reads and entry['reads']:
+        return min(1.0, 1.1 * max_reads / max(int(entry['reads']), 1))
+    return fraction
+
+# Subsample one sample into the preview tree
+def preview_sample(entry, out_dir, fraction, max_reads, seed):
+    out1 = os.path.join(out_dir, os.path.basename(entry['read1']))
+    out2 = os.path.join(out_dir, os.path.basename(entry['read2'])) if entry['read2'] else ""
+    if os.path.exists(out1) and (not out2 or os.path.exists(out2)):
+        return entry['sample'], None
+    n_kept = subsample(entry['read1'], entry['read2'], out1, out2, sample_fraction(entry, fraction, max_reads), max_reads, seed)
+    return entry['sample'], n_kept
+
+# Mirror the studies of base_dir into preview_dir with subsampled raw reads; a change in parameters clears the tree
+def build_preview(base_dir, preview_dir, fraction=0.01, max_reads=None, seed=0, threads=1, projects="studies_list.txt", samples="samples_list.txt"):
+    if os.path.abspath(preview_dir) == os.path.abspath(base_dir):
+        raise ValueError("The preview tree must be separate from the base directory")
+    params = {'source': base_dir, 'fraction': fraction, 'max_reads': max_reads, 'seed': seed}
+    params_file = os.path.join(preview_dir, PARAMS_FILE)
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            if json.load(f) != params:
+                logger.warning(f"{common.EMOJI_TRASH} Preview parameters changed, clearing [i dim]{preview_dir}[/]")
+                shutil.rmtree(preview_dir)
+    os.makedirs(preview_dir, exist_ok=True)
+    with open(params_file, 'w') as f:
+        json.dump(params, f)
+
+    index = project_index.load_index(base_dir, projects, samples)
+    futures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        for base in project_index.base_dirs(index):
+            type_dir = os.path.normpath(os.path.join(preview_dir, os.path.relpath(base, base_dir)))
+            os.makedirs(type_dir, exist_ok=True)
+            shutil.copy(os.path.join(base, projects), os.path.join(type_dir, projects))
+            for study in project_index.studies(index, base):
+                out_dir = os.path.join(type_dir, study, "raw_reads")
+                os.makedirs(out_dir, exist_ok=True)
+                study_samples = project_index.samples(index, base, study)
+                with open(os.path.join(type_dir, study, samples), 'w') as f:
+                    f.writelines(f"{sample}\n" for sample in study_samples)
+                manifest = fq_manifest.load_manifest(f"{base}/{study}", threads)
+                for sample in study_samples:
+                    entry = manifest.get(sample)
+                    if entry is None or entry['layout'] == 'incomplete':
+                        logger.warning(f"{common.EMOJI_WARNING} No complete raw reads for [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta]. Skipping...")
+                        continue
+                    futures.append((study, executor.submit(preview_sample, entry, out_dir, fraction, max_reads, seed)))
+
+        for study, future in futures:
+            sample, n_kept = future.result()
+            if n_kept is not None:
+                logger.info(f"{common.EMOJI_LIST} [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta]: kept {n_kept} read {p.plural('pair', n_kept)}")
+
+    # Manifests with read counts, and a fresh index for the runners
+    preview_index = project_index.load_index(preview_dir, projects, samples)
+    for base in project_index.base_dirs(preview_index):
+        for study in project_index.studies(preview_index, base):
+            fq_manifest.build_manifest(f"{base}/{study}", threads)
+    return preview_index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a preview tree with a deterministic subset of read pairs from every sample...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-o", "--output", help="Base directory of the preview tree. (Default: preview_data)", default="preview_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-f", "--fraction", type=float, default=0.01, help="Fraction of read pairs to keep (Default: 0.01)")
+    parser.add_argument("-n", "--max_reads", type=int, default=None, help="Keep at most this many read pairs per sample; with cached read counts the fraction is set to reach it (Default: off)")
+    parser.add_argument("-x", "--seed", type=int, default=0, help="Seed of the read selection hash (Default: 0)")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of samples subsampled concurrently (Default: 1)")
+    args = parser.parse_args()
+
+    console.print(
+        panel(
+            f"{common.EMOJI_SPARKLE} Building preview tree...",
+            title=f"Study: {common.study_name.upper()}",
+            title_align="left",
+            border_style='dim bold yellow'
+        ),
+        style='italic dim'
+    )
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+    preview_dir = os.path.join(os.getcwd(), args.output)
+
+    if not 0 < args.fraction <= 1:
+        logger.error(f"{common.EMOJI_CROSS} --fraction must be in (0, 1], got {args.fraction}")
+    else:
+        index = build_preview(base_dir, preview_dir, args.fraction, args.max_reads, args.seed, args.threads, args.projects, args.samples)
+        n_studies = sum(len(project_index.studies(index, base)) for base in project_index.base_dirs(index))
+        console.print(
+            panel.fit(
+                f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] preview of {n_studies} {p.plural('study', n_studies)}. Run the pipeline on it with [b]-b {args.output}[/b].",
+                title="Done",
+                border_style="green", title_align="right"
+            ),
+            style='italic'
+        )
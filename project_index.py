@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# Cached project tree: data types -> studies -> samples -> stage directories
+# Stored as {base_dir}/project_index.json; each study is re-scanned only when its directory or
+# its samples list changed (mtime), so runners skip the startup walk of the whole tree.
+
+import argparse
+import json
+import os
+
+import common
+
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+INDEX_FILE = "project_index.json"
+
+# Modification time of a path in ns, or None if it does not exist
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+# Read a list of names, one per line
+def read_names(in_file):
+    with open(in_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+# Scan one study directory: samples list and stage directories
+def scan_study(study_dir, samples):
+    samples_file = os.path.join(study_dir, samples)
+    stages = []
+    if os.path.isdir(study_dir):
+        with os.scandir(study_dir) as entries:
+            stages = sorted(entry.name for entry in entries if entry.is_dir())
+    return {
+        'mtime': mtime(study_dir),
+        'samples_mtime': mtime(samples_file),
+        'samples': read_names(samples_file) if os.path.exists(samples_file) else [],
+        'stages': stages,
+    }
+
+# Data type directories holding a studies list: base_dir itself, or its direct subdirectories
+def find_types(base_dir, projects):
+    if os.path.exists(os.path.join(base_dir, projects)):
+        return [base_dir]
+    with os.scandir(base_dir) as entries:
+        return sorted(entry.path for entry in entries if entry.is_dir() and os.path.exists(os.path.join(entry.path, projects)))
+
+# Load the project index of base_dir, refreshing the types, studies and samples that changed since it was written;
+# with write=False (dry runs) the refreshed index is only returned, and the cached file is left as it is
+def load_index(base_dir, projects="studies_list.txt", samples="samples_list.txt", write=True):
+    index_file = os.path.join(base_dir, INDEX_FILE)
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get('projects') != projects or index.get('samples') != samples:
+            index = {}
+
+    old_types = index.get('types', {})
+    types = {}
+    changed = not index
+    for type_dir in find_types(base_dir, projects):
+        studies_file = os.path.join(type_dir, projects)
+        old = old_types.get(type_dir, {})
+        if old.get('mtime') != mtime(studies_file):
+            study_names = read_names(studies_file)
+            changed = True
+        else:
+            study_names = list(old['studies'])
+
+        old_studies = old.get('studies', {})
+        studies = {}
+        for study in study_names:
+            study_dir = os.path.join(type_dir, study)
+            entry = old_studies.get(study)
+            if entry is None or entry['mtime'] != mtime(study_dir) or entry['samples_mtime'] != mtime(os.path.join(study_dir, samples)):
+                entry = scan_study(study_dir, samples)
+                changed = True
+            studies[study] = entry
+        types[type_dir] = {'mtime': mtime(studies_file), 'studies': studies}
+    changed = changed or list(types) != list(old_types)
+
+    index = {'projects': projects, 'samples': samples, 'types': types}
+    if changed and not write:
+        logger.info(f"{common.EMOJI_SPARKLE} Refreshed project index [i dim]{index_file}[/] in memory (not written)")
+    elif changed:
+        tmp_file = common.tmp_path(index_file)
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, index_file)
+        logger.info(f"{common.EMOJI_SPARKLE} Updated project index [i dim]{index_file}[/]")
+    else:
+        logger.info(f"{common.EMOJI_SPARKLE} Loaded project index [i dim]{index_file}[/]")
+    return index
+
+# Data type directories, as the runners' base_dirs
+def base_dirs(index):
+    return list(index['types'])
+
+# Studies of a data type directory, in studies list order
+def studies(index, base):
+    return list(index['types'][base]['studies'])
+
+# Samples of a study, in samples list order
+def samples(index, base, study):
+    return list(index['types'][base]['studies'][study]['samples'])
+
+# Stage directories present in a study
+def stages(index, base, study):
+    return list(index['types'][base]['studies'][study]['stages'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the cached project index...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    args = parser.parse_args()
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    index = load_index(base_dir, args.projects, args.samples)
+    for base in base_dirs(index):
+        n_studies = len(studies(index, base))
+        n_samples = sum(len(samples(index, base, study)) for study in studies(index, base))
+        logger.info(f"{common.EMOJI_LIST} [cyan]{os.path.basename(base)}[/]: {n_studies} {p.plural('study', n_studies)}, {n_samples} {p.plural('sample', n_samples)}")
+
+    console.print(
+        panel.fit(f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] indexing {len(base_dirs(index))} data {p.plural('type', len(base_dirs(index)))}.", title="Done", border_style="green", title_align="right"),
+        style='italic'
+    )
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+
+# Re-score existing Kraken2 per-read output at new confidence thresholds, without re-classifying
+# Follows Kraken2's ResolveTree: the called taxon is the hit taxon with the highest root-to-leaf score
+# (ties resolved to their LCA), then it moves up the tree until its clade holds at least
+# ceil(confidence * total k-mers) of the read's k-mers
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import numpy as np
+
+
+import common
+import project_index
+import kraken_out_bin
+from kraken_utils import load_taxonomy, resolve_rank_codes, write_kreport
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+# Reads per chunk are sized so that a chunk's (hit taxon x depth) arrays stay within the per-worker memory budget:
+# about PAIRS_PER_READ distinct hit taxa per read and BYTES_PER_CELL bytes of int64 temporaries per path cell
+CHUNK_MB = 512
+PAIRS_PER_READ = 8
+BYTES_PER_CELL = 48
+MAX_CHUNK_READS = 100000
+
+# Reads per chunk for a taxonomy depth and a per-worker budget in MB
+def chunk_reads_for(max_depth, budget_mb=CHUNK_MB):
+    return int(max(1000, min(MAX_CHUNK_READS, budget_mb * 1024**2 // (max_depth * PAIRS_PER_READ * BYTES_PER_CELL))))
+
+# Taxonomy (and Bracken kmer distribution) shared with forked worker processes
+TAXONOMY = None
+KMER_DISTR = None
+
+# Depth of every taxon (root = 0)
+def taxon_depths(parent):
+    depth = np.zeros(len(parent), dtype=np.int32)
+    cur = parent.copy()
+    while (cur >= 0).any():
+        alive = cur >= 0
+        depth += alive
+        cur = np.where(alive, parent[np.maximum(cur, 0)], -1)
+    return depth
+
+# Paths from each taxon up to the root, padded with -1
+def ancestor_paths(idx, max_depth):
+    paths = np.full((len(idx), max_depth), -1, dtype=np.int64)
+    cur = np.asarray(idx, dtype=np.int64)
+    for d in range(max_depth):
+        paths[:, d] = cur
+        alive = cur >= 0
+        if not alive.any():
+            break
+        cur = np.where(alive, TAXONOMY['parent'][np.maximum(cur, 0)], -1)
+    return paths
+
+# Lowest common ancestors of taxon arrays a and b, element-wise
+def pairwise_lca(a, b):
+    depth = TAXONOMY['depth']
+    parent = TAXONOMY['parent']
+    a, b = a.copy(), b.copy()
+    while True:
+        deeper_a, deeper_b = depth[a] > depth[b], depth[b] > depth[a]
+        if not (deeper_a.any() or deeper_b.any()):
+            break
+        a[deeper_a] = parent[a[deeper_a]]
+        b[deeper_b] = parent[b[deeper_b]]
+    while True:
+        differ = a != b
+        if not differ.any():
+            return a
+        a[differ], b[differ] = parent[a[differ]], parent[b[differ]]
+
+# LCA of each group of taxa (groups are runs of equal ids in a sorted array); returns group ids and their LCAs.
+# Neighbours in a group are merged pairwise, halving every group each round
+def group_lcas(group_ids, taxa):
+    group_ids, taxa = group_ids.copy(), taxa.copy()
+    while len(group_ids) > 1:
+        same = group_ids[1:] == group_ids[:-1]
+        if not same.any():
+            break
+        starts = np.flatnonzero(np.r_[True, ~same])
+        rank = np.arange(len(group_ids)) - np.repeat(starts, np.diff(np.r_[starts, len(group_ids)]))
+        left = np.flatnonzero((rank[:-1] % 2 == 0) & same)
+        taxa[left] = pairwise_lca(taxa[left], taxa[left + 1])
+        keep = np.ones(len(group_ids), dtype=bool)
+        keep[left + 1] = False
+        group_ids, taxa = group_ids[keep], taxa[keep]
+    return group_ids, taxa
+
+# Parse LCA hit lists into (read, taxon, k-mers) triples, total k-mers and hit groups per read
+def parse_hits(lcas):
+    reads, taxa, counts = [], [], []
+    total = np.zeros(len(lcas), dtype=np.int64)
+    groups = np.zeros(len(lcas), dtype=np.int64)
+    for r, lca_str in enumerate(lcas):
+        for token in lca_str.split():
+            if token == '|:|':
+                continue
+            taxid, _, count = token.partition(':')
+            count = int(count)
+            total[r] += count
+            if taxid in ('0', 'A'):
+                continue
+            groups[r] += 1
+            reads.append(r)
+            taxa.append(int(taxid))
+            counts.append(count)
+
+    taxids = TAXONOMY['taxids']
+    taxa = np.asarray(taxa, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(taxids, taxa), len(taxids) - 1)
+    known = taxids[pos] == taxa
+    return np.asarray(reads, dtype=np.int64)[known], pos[known], np.asarray(counts, dtype=np.int64)[known], total, groups
+
+# Look up (read, taxon) keys in a sorted key/value table, 0 where missing
+def lookup(keys, values, query):
+    pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where((query >= 0) & (keys[pos] == query), values[pos], 0)
+
+# Re-score one chunk of reads at every confidence; returns taxon index per read (-1 = unclassified)
+def rescore_chunk(lcas, confidences, min_hit_groups):
+    n_taxa = len(TAXONOMY['taxids'])
+    max_depth = TAXONOMY['max_depth']
+    calls = np.full((len(confidences), len(lcas)), -1, dtype=np.int64)
+    reads, taxa, counts, total, groups = parse_hits(lcas)
+    if len(reads) == 0:
+        return calls
+
+    # Direct hit counts per (read, taxon)
+    keys, inv = np.unique(reads * n_taxa + taxa, return_inverse=True)
+    hits = np.bincount(inv, weights=counts).astype(np.int64)
+    pair_reads, pair_taxa = keys // n_taxa, keys % n_taxa
+
+    # Root-to-leaf score of every hit taxon
+    paths = ancestor_paths(pair_taxa, max_depth)
+    path_keys = np.where(paths >= 0, pair_reads[:, None] * n_taxa + paths, -1)
+    scores = lookup(keys, hits, path_keys).sum(axis=1)
+
+    # Called taxon: highest score, ties resolved to their LCA
+    starts = np.flatnonzero(np.r_[True, pair_reads[1:] != pair_reads[:-1]])
+    read_ids = pair_reads[starts]
+    best = np.maximum.reduceat(scores, starts)
+    is_best = scores == np.repeat(best, np.diff(np.r_[starts, len(scores)]))
+    n_best = np.bincount(pair_reads[is_best], minlength=len(lcas))
+    called = np.full(len(lcas), -1, dtype=np.int64)
+    single = is_best & (n_best[pair_reads] == 1)
+    called[pair_reads[single]] = pair_taxa[single]
+    tied = is_best & (n_best[pair_reads] > 1)
+    tied_reads, tied_lcas = group_lcas(pair_reads[tied], pair_taxa[tied])
+    called[tied_reads] = tied_lcas
+
+    # Clade score of every ancestor of every hit taxon
+    valid = paths >= 0
+    clade_keys, clade_inv = np.unique(path_keys[valid], return_inverse=True)
+    clade = np.bincount(clade_inv, weights=np.broadcast_to(hits[:, None], paths.shape)[valid]).astype(np.int64)
+
+    # Walk up from the called taxon until the clade score reaches the threshold
+    called_paths = ancestor_paths(called[read_ids], max_depth)
+    called_keys = np.where(called_paths >= 0, read_ids[:, None] * n_taxa + called_paths, -1)
+    called_clade = lookup(clade_keys, clade, called_keys)
+    enough_groups = groups[read_ids] >= min_hit_groups
+    for c, confidence in enumerate(confidences):
+        required = np.ceil(confidence * total[read_ids])
+        ok = (called_paths >= 0) & (called_clade >= required[:, None])
+        first = ok.argmax(axis=1)
+        taxon = np.where(ok.any(axis=1) & enough_groups, called_paths[np.arange(len(read_ids)), first], -1)
+        calls[c, read_ids] = taxon
+    return calls
+
+# Build Kraken2 report nodes from per-taxon read counts
+def report_nodes(taxon_reads, n_unclassified):
+    idx = np.flatnonzero(taxon_reads)
+    paths = ancestor_paths(idx, TAXONOMY['max_depth'])
+    valid = paths >= 0
+    clade = np.bincount(paths[valid], weights=np.broadcast_to(taxon_reads[idx][:, None], paths.shape)[valid], minlength=len(taxon_reads)).astype(np.int64)
+
+    involved = np.flatnonzero(clade)
+    involved = involved[np.argsort(TAXONOMY['depth'][involved], kind='stable')]
+    position = {int(t): i for i, t in enumerate(involved)}
+    nodes = []
+    for t in involved:
+        parent = int(TAXONOMY['parent'][t])
+        nodes.append({
+            'clade': int(clade[t]),
+            'taxon': int(taxon_reads[t]),
+            'rank': TAXONOMY['rank'][t],
+            'taxid': str(TAXONOMY['taxids'][t]),
+            'name': TAXONOMY['name'][t],
+            'depth': int(TAXONOMY['depth'][t]),
+            'parent': position.get(parent),
+        })
+    for node, code in zip(nodes, resolve_rank_codes(nodes)):
+        node['rank'] = code
+    nodes.append({'clade': n_unclassified, 'taxon': n_unclassified, 'rank': 'U', 'taxid': '0', 'name': 'unclassified', 'depth': 0, 'parent': None})
+    return nodes
+
+# Iterate over LCA hit lists of a sample, from the text .out or the .kbin store
+def iter_lcas(sample_prefix, chunk_reads=MAX_CHUNK_READS):
+    if os.path.exists(f"{sample_prefix}.out"):
+        with open(f"{sample_prefix}.out") as f:
+            lcas = []
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                lcas.append(fields[4] if len(fields) > 4 else "")
+                if len(lcas) == chunk_reads:
+                    yield lcas
+                    lcas = []
+            if lcas:
+                yield lcas
+    else:
+        kbin = kraken_out_bin.open_kbin(f"{sample_prefix}.kbin")
+        for start in range(0, kbin['n_reads'], chunk_reads):
+            yield kraken_out_bin.side_column(kbin, 'lca', np.arange(start, min(start + chunk_reads, kbin['n_reads'])))
+
+# Re-score one sample at every confidence, writing {sample}_conf{c}.report (and Bracken outputs)
+def rescore_sample(sample_prefix, confidences, min_hit_groups=0, chunk_mb=CHUNK_MB):
+    n_taxa = len(TAXONOMY['taxids'])
+    taxon_reads = np.zeros((len(confidences), n_taxa), dtype=np.int64)
+    n_reads = 0
+    for lcas in iter_lcas(sample_prefix, chunk_reads_for(TAXONOMY['max_depth'], chunk_mb)):
+        calls = rescore_chunk(lcas, confidences, min_hit_groups)
+        for c in range(len(confidences)):
+            classified = calls[c][calls[c] >= 0]
+            taxon_reads[c] += np.bincount(classified, minlength=n_taxa)
+        n_reads += len(lcas)
+
+    reports = []
+    for c, confidence in enumerate(confidences):
+        report = f"{sample_prefix}_conf{confidence:g}.report"
+        nodes = report_nodes(taxon_reads[c], n_reads - int(taxon_reads[c].sum()))
+        write_kreport(report, nodes)
+        if KMER_DISTR is not None:
+            import bracken_est
+            bracken_est.estimate_sample(report, KMER_DISTR)
+        reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score Kraken2 per-read output at new confidence thresholds, without re-classification...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-d", "--db", help="Kraken2 database directory (taxonomy/nodes.dmp or ktaxonomy.tsv).", required=True)
+    parser.add_argument("-c", "--confidence", type=float, nargs="+", required=True, help="One or more confidence thresholds to score at, e.g. 0.05 0.1 0.2")
+    parser.add_argument("-g", "--min_hit_groups", type=int, default=0, help="Minimum hit groups per read; approximated by runs of classified k-mers in the hit list (Default: 0, off)")
+    parser.add_argument("-e", "--bracken", action="store_true", help="Also re-estimate abundances of the new reports with the in-process Bracken")
+    parser.add_argument("-r", "--read_len", type=int, default=100, help="Read length of the Bracken kmer_distrib file (Default: 100)")
+    parser.add_argument("-t", "--threads", type=int, default=2, help="Number of samples scored in parallel, each in its own process (Default: 2)")
+    parser.add_argument("-m", "--chunk_mb", type=int, default=CHUNK_MB, help=f"Approximate memory per worker for a chunk of reads, in MB (Default: {CHUNK_MB})")
+    args = parser.parse_args()
+
+    console.print(
+        panel(
+            f"{common.EMOJI_SPARKLE} Re-scoring Kraken2 output at confidence {', '.join(f'{c:g}' for c in args.confidence)}...",
+            title=f"Study: {common.study_name.upper()}",
+            title_align="left",
+            border_style='dim bold yellow'
+        ),
+        style='italic dim'
+    )
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    base_dirs = project_index.base_dirs(index)
+
+    sample_prefixes = []
+    for base in base_dirs:
+        for study in project_index.studies(index, base):
+            for sample in project_index.samples(index, base, study):
+                prefix = f"{base}/{study}/kraken_out/{sample}/{sample}"
+                if os.path.exists(f"{prefix}.out") or os.path.isdir(f"{prefix}.kbin"):
+                    sample_prefixes.append(prefix)
+                else:
+                    logger.warning(f"{common.EMOJI_WARNING} No per-read output for [yellow]{study}[/yellow] {common.EMOJI_PLAY} [yellow]{sample}[/yellow]. Skipping...")
+
+    if sample_prefixes:
+        # Loaded once, then shared with the forked workers
+        TAXONOMY = load_taxonomy(args.db)
+        TAXONOMY['depth'] = taxon_depths(TAXONOMY['parent'])
+        TAXONOMY['max_depth'] = int(TAXONOMY['depth'].max()) + 1
+        if args.bracken:
+            import bracken_est
+            KMER_DISTR = bracken_est.load_kmer_distrib(args.db, args.read_len)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads, mp_context=multiprocessing.get_context('fork')) as executor:
+            # Forked workers start on the first submit, before the progress display starts its refresh thread
+            futures = {executor.submit(rescore_sample, prefix, args.confidence, args.min_hit_groups, args.chunk_mb): prefix for prefix in sample_prefixes}
+            with common.progress:
+                task = common.progress.add_task(f"{common.EMOJI_PROCESS} Re-scoring {len(sample_prefixes)} {p.plural('sample', len(sample_prefixes))}", total=len(sample_prefixes))
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        for report in future.result():
+                            logger.info(f"{common.EMOJI_CHECK} Wrote [i dim]{report}[/]")
+                    except Exception as e:
+                        logger.error(f"{common.EMOJI_CROSS} Error re-scoring {futures[future]}: {e}")
+                    common.progress.update(task, advance=1)
+
+        console.print(
+            panel.fit(
+                f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] confidence re-scoring.",
+                title="Done",
+                border_style="green", title_align="right"
+            ),
+            style='italic'
+        )
+    else:
+        logger.error(f"{common.EMOJI_CROSS} No Kraken2 per-read output found, is the provided {args.base_dir} directory correct?")
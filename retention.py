@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+# Retention policy for intermediate artifacts, applied per sample as soon as their consumers have finished
+# Each stage directory gets an action: keep, compress, or delete. Artifacts are only touched once every
+# 'after' pattern (outputs of downstream stages, relative to the study dir) matches an existing file.
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import shutil
+import threading
+
+
+import common
+import project_index
+from get_info import make_dict
+# Using logger from common.py
+logger = common.logger
+p = common.inflector
+
+# Rich traceback handler
+common.install_traceback()
+
+# Using rich elements from common.py
+console = common.console
+panel = common.Panel
+
+ACTIONS = ['keep', 'compress', 'delete']
+
+# Default action per stage directory (override with a stage,action CSV)
+DEFAULT_POLICY = {
+    'raw_fastq': 'compress',
+    'sra_files': 'delete',
+    'raw_reads': 'keep',
+    'bb_out': 'delete',
+    'fp_out': 'delete',
+    'hostile_out': 'keep',
+    'kraken_out': 'compress',
+}
+
+# Per-sample artifacts of each stage directory, and the downstream outputs that must exist before they go
+# Stages are applied in this order, so extracted reads are compressed before their SRA files are removed.
+# Reads wait for this sample's own FastQC reports: the study's MultiQC dir may hold reports of earlier samples
+ARTIFACTS = {
+    'raw_fastq': {'paths': ['raw_reads/{sample}_1.fastq', 'raw_reads/{sample}_2.fastq', 'raw_reads/{sample}.fastq'], 'after': []},
+    'sra_files': {'paths': ['sra_files/{sample}'], 'after': ['raw_reads/{sample}[._]*fastq.gz']},
+    'raw_reads': {'paths': ['raw_reads/{sample}_1.fastq.gz', 'raw_reads/{sample}_2.fastq.gz'], 'after': ['hostile_out/{sample}_R2.clean_2.fastq.gz', 'raw_qc/{sample}_1_fastqc.zip', 'raw_qc/{sample}_2_fastqc.zip']},
+    'bb_out': {'paths': ['bb_out/{sample}_R1.fq.gz', 'bb_out/{sample}_R2.fq.gz'], 'after': ['fp_out/{sample}_R2.fq.gz', 'bb_qc/{sample}_R1_fastqc.zip', 'bb_qc/{sample}_R2_fastqc.zip']},
+    'fp_out': {'paths': ['fp_out/{sample}_R1.fq.gz', 'fp_out/{sample}_R2.fq.gz'], 'after': ['hostile_out/{sample}_R2.clean_2.fastq.gz', 'fp_qc/{sample}_R1_fastqc.zip', 'fp_qc/{sample}_R2_fastqc.zip']},
+    'hostile_out': {'paths': ['hostile_out/{sample}_R1.clean_1.fastq.gz', 'hostile_out/{sample}_R2.clean_2.fastq.gz'], 'after': ['kraken_out/{sample}/{sample}.report', 'amr_out/Results/*']},
+    'kraken_out': {'paths': ['kraken_out/{sample}/{sample}.out'], 'after': ['kraken_out/{sample}/{sample}_mpa.txt']},
+}
+
+# Load the policy: defaults, overridden by a stage,action CSV ('default' or None keeps the defaults)
+def load_policy(policy_file=None):
+    policy = dict(DEFAULT_POLICY)
+    if policy_file and policy_file != 'default':
+        for stage, action in make_dict(policy_file).items():
+            if stage not in ARTIFACTS or action not in ACTIONS:
+                logger.warning(f"{common.EMOJI_WARNING} Ignoring retention rule [yellow]{stage}: {action}[/yellow]")
+                continue
+            policy[stage] = action
+    return policy
+
+# Size of a file or directory tree in bytes
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+# Compress one artifact: Kraken2 per-read output becomes a .kbin store, plain files are gzipped
+def compress(path, threads=1):
+    if path.endswith('.out'):
+        import kraken_out_bin
+        if not os.path.isdir(f"{path[:-4]}.kbin") and kraken_out_bin.convert(path, f"{path[:-4]}.kbin") is None:
+            return False
+        os.remove(path)
+        return True
+    if path.endswith('.gz') or os.path.isdir(path):
+        return False
+    return common.run_command(f"pigz -p {threads} {path}", desc=f"Compressing {os.path.basename(path)}") == 0
+
+# Apply the policy to one sample's artifacts; returns the bytes reclaimed
+def collect_sample(context, sample, policy, threads=1):
+    study_dir = f"{context['base']}/{context['study']}"
+    freed = 0
+    for stage, action in policy.items():
+        if action == 'keep':
+            continue
+        artifact = ARTIFACTS[stage]
+        paths = [f"{study_dir}/{pattern.format(sample=sample)}" for pattern in artifact['paths']]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            continue
+        if not all(glob.glob(f"{study_dir}/{pattern.format(sample=sample)}") for pattern in artifact['after']):
+            continue
+        for path in paths:
+            size = path_size(path)
+            if action == 'delete':
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                freed += size
+                logger.info(f"{common.EMOJI_TRASH} Removed [i dim]{path}[/]")
+            elif compress(path, threads):
+                compressed = [f"{path[:-4]}.kbin", f"{path}.gz"]
+                freed += size - sum(path_size(c) for c in compressed if os.path.exists(c))
+                logger.info(f"{common.EMOJI_ZIP} Compressed [i dim]{path}[/]")
+    return freed
+
+# Background collector: samples are submitted as their stages finish and processed on one thread
+def start_collector(policy, threads=1):
+    return {'policy': policy, 'threads': threads, 'freed': 0, 'lock': threading.Lock(), 'executor': concurrent.futures.ThreadPoolExecutor(max_workers=1)}
+
+def submit(collector, context, sample):
+    def run():
+        try:
+            freed = collect_sample(context, sample, collector['policy'], collector['threads'])
+        except Exception as e:
+            logger.error(f"{common.EMOJI_CROSS} Retention failed for {context['study']} {common.EMOJI_PLAY} {sample}: {e}")
+            return
+        with collector['lock']:
+            collector['freed'] += freed
+    collector['executor'].submit(run)
+
+# Wait for pending collections and report the space reclaimed
+def stop_collector(collector):
+    collector['executor'].shutdown(wait=True)
+    logger.info(f"{common.EMOJI_TRASH} Retention policy reclaimed {collector['freed']/1024**3:.2f} GB")
+    return collector['freed']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the intermediate-artifact retention policy to all studies...")
+    parser.add_argument("-b", "--base_dir", help="Base directory with all data. (Default: all_data)", default="all_data")
+    parser.add_argument("-s", "--samples", help="List of sample IDs as text file. (Default: samples_list.txt)", default="samples_list.txt")
+    parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
+    parser.add_argument("-r", "--retention", help="Retention policy as a stage,action CSV (Default: built-in policy)", default=None)
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of threads for compression (Default: 1)")
+    args = parser.parse_args()
+
+    if args.base_dir in [".", "./"]:
+        base_dir = os.getcwd()
+    else:
+        base_dir = os.path.join(os.getcwd(), args.base_dir)
+
+    policy = load_policy(args.retention)
+    for stage, action in policy.items():
+        console.print(f"{common.EMOJI_LIST} [dim]{stage}:[/]\t[blue]{action}[/]", style='bold')
+
+    index = project_index.load_index(base_dir, args.projects, args.samples)
+    freed = 0
+    for base in project_index.base_dirs(index):
+        for study in project_index.studies(index, base):
+            context = common.study_context(base, study)
+            for sample in project_index.samples(index, base, study):
+                freed += collect_sample(context, sample, policy, args.threads)
+
+    console.print(
+        panel.fit(f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] applying retention policy, reclaimed {freed/1024**3:.2f} GB.", title="Done", border_style="green", title_align="right"),
+        style='italic'
+    )
@@ -1,30 +1,33 @@
 #!/usr/bin/python
 
 import argparse
-import inflect
+import concurrent.futures
 import os
-import subprocess
+import shutil
+import sys
+import threading
 
 from rich.console import Group
-from rich.live import Live
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
-from rich.traceback import install
+from rich.progress import SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
+import amr_matrix
 import common
-from get_info import names_list, make_dict
+import planner
+import project_index
+from get_info import make_dict
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Rich traceback handler
-install(show_locals=True)
+common.install_traceback()
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 
-# Initiate Progress() object for n_studies
-progress = Progress(
+# Initiate the progress bar for n_studies (logged instead of drawn without the Rich backend)
+progress = common.new_progress(
     SpinnerColumn(spinner_name='dots12', style='blue'),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -34,7 +37,42 @@ progress = Progress(
     transient=False,
 )
 
-# run_command
+# Run AMR++ on one study, launched from its own directory with its own Nextflow work dir under scratch
+def run_amr(context, study, status_sub):
+    hq_reads, amr_out = context['hostile_out'], context['amr_out']
+    launch_dir = f"{scratch}/{context['type']}/{study}"
+    work_dir = f"{launch_dir}/work"
+    status_sub.update(f"[i][dim]Running AMR++ on [/dim] [blue]{study}[/blue] [dim]({context['type']})[/dim][/i]", spinner='point', spinner_style='magenta')
+
+    os.makedirs(amr_out, exist_ok=True)
+    if amr_matrix.results_ok(amr_out):
+        logger.info(f"{common.EMOJI_CHECK} AMR++ already run for [blue]{study}[/blue]. Skipping...")
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+        # common.run_command(
+        #     f'conda run -n {utility_paths['AMR++']} nextflow run main_AMR++.nf --pipeline resistome --reads "{hq_reads}/*_R{{1,2}}.clean_{{1,2}}.fastq.gz" --output "{amr_out}" --snp Y --deduped Y --threads {threads} -resume',
+        #     desc=f"Running AMR++ on {study}"
+        # )
+
+        # With manual activation of conda env
+        common.run_command(
+            f'nextflow run {utility_paths["AMR++_path"]}/main_AMR++.nf --pipeline resistome --reads "{hq_reads}/*_R{{1,2}}.clean_{{1,2}}.fastq.gz" --output "{amr_out}" --snp Y --deduped Y --threads {threads} -work-dir {work_dir} -resume',
+            desc=f"Running AMR++ on {study}",
+            cwd=launch_dir
+        )
+
+    # Keep the work dir (and the -resume cache) until the study's Results are complete
+    if amr_matrix.results_ok(amr_out):
+        if os.path.exists(launch_dir):
+            logger.info(f"{common.EMOJI_TRASH} Clearing the work directory of [blue]{study}[/blue] in the background...")
+            cleaner.submit(shutil.rmtree, launch_dir, ignore_errors=True)
+        # Add the study's gene counts to the cross-study matrix as soon as it finishes
+        with matrix_lock:
+            amr_matrix.update_store(gene_matrix, [(context, context['samples'])])
+        console.rule(f"[dim][i]Generated AMR gene abundance tables for[/dim] [blue]{study}[/blue][/i]", characters="-", style='dim')
+    else:
+        logger.warning(f"{common.EMOJI_WARNING} AMR++ Results incomplete for [yellow]{study}[/yellow]. Keeping [i dim]{work_dir}[/] for -resume")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Classify reads using kraken2 and bracken, followed by conversion to MPA format...")
@@ -43,7 +81,10 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
     parser.add_argument("-u", "--utility_paths", help="Envs or Paths for tools and DBs as a CSV file. (Default: utility_paths.csv)", default="utility_paths.csv")
     parser.add_argument("-t", "--threads", type=int, default=1, help="Number of threads (Default: 1)")
-    parser.add_argument("-l", "--split_size", type=int, choices=[1], nargs="?", default=1, help="Number of sub_lists to make, and run concurrently (Default: no splitting, everything as one list).")
+    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3], nargs="?", default=1, help="Number of studies to run AMR++ on concurrently (Default: 1)")
+    parser.add_argument("-g", "--gene_matrix", help="AMR gene matrix store updated as studies finish. (Default: {base_dir}_amr_matrix beside the base dir)", default=None)
+    parser.add_argument("-w", "--scratch", help="Scratch area for per-study Nextflow launch and work dirs. (Default: $SCRATCH/amr_work, or {base_dir}_amr_work beside the base dir)")
+    parser.add_argument("--plan", action="store_true", help="Only print the pending studies with estimated CPU-hours, disk use and makespan (see planner.py)")
     args=parser.parse_args()
 
     console.print(  
@@ -75,31 +116,41 @@ if __name__ == "__main__":
     else:
         base_dir = os.path.join(os.getcwd(), args.base_dir)
 
-    if args.projects in os.listdir(base_dir):
-        logger.info(f"{common.EMOJI_SPARKLE} Found project file [bold blue]{args.projects}[/] in [bold blue]{args.base_dir}[/]")
-        base_dirs = [base_dir]
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples, write=not args.plan)
+    base_dirs = project_index.base_dirs(index)
+
+    if args.plan:
+        planner.plan_runner(index, base_dir, ['amr'], threads, split_size, False)
+        sys.exit(0)
+
+    if args.scratch:
+        scratch = os.path.abspath(args.scratch)
+    elif os.environ.get('SCRATCH'):
+        scratch = os.path.join(os.environ['SCRATCH'], "amr_work")
     else:
-        logger.info(f"{common.EMOJI_PROCESS} [bold blue]{args.projects}[/] not in [bold blue]{args.base_dir}[/], searching subdirectories.")
-        # It may work only for one sub-level
-        base_dirs = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if args.projects in os.listdir(os.path.join(base_dir, d))]
+        # Beside the base dir, so it is never taken for a data type dir
+        scratch = f"{base_dir}_amr_work"
+
+    gene_matrix = args.gene_matrix or f"{base_dir}_amr_matrix"
+    matrix_lock = threading.Lock()
 
     # Main status
     status = console.status(f"[i][dim]Initiating AMR identification on[/dim] {len(base_dirs)} [dim] study {p.plural('type', len(base_dirs))}[/dim][/i]")
 
-    with Live(panel(Group(status, progress)), console=console, transient=True):
-        if base_dirs:
-            # Change to AMRplusplus directory
-            os.chdir(utility_paths['AMR++_path'])
-            cwd = os.getcwd()
-            print("Current working directory:", cwd)
-            
-            for base in base_dirs:
-                status.update(f"[i][dim]Running AMR++ on[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]datasets ({base_dirs.index(base)+1}/{len(base_dirs)})[/dim][/i]")
+    # Per-worker statuses, rendered together as one table
+    board = common.StatusBoard(split_size, "[i][dim]Waiting for a study...[/dim][/i]")
+    status_subs = board.slots
 
-                console.rule(f"Running AMR++ on all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
+    # Work dir cleanup runs in the background, off the critical path
+    cleaner = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-                studies_in = os.path.join(base, args.projects)
-                studies = names_list(studies_in)
+    with common.live(panel(Group(status, progress, board)), refresh_per_second=common.BOARD_REFRESH):
+        if base_dirs:
+            # One queue of studies across all data types
+            jobs = []
+            for base in base_dirs:
+                studies = project_index.studies(index, base)
                 console.print(
                     panel.fit(
                         f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(studies)}[/] [dim]studies in[/] {os.path.basename(base)} [dim]dir[/]", 
@@ -108,40 +159,18 @@ if __name__ == "__main__":
                     ),
                     style='italic'
                 )
+                for study in studies:
+                    context = common.study_context(base, study, hostile_out="hostile_out", amr_out="amr_out")
+                    context['samples'] = project_index.samples(index, base, study)
+                    jobs.append((context, study))
 
-                task = progress.add_task(f"[blue]:gear:[/blue] [i][dim]Running AMR++ on[/dim] [cyan]{len(studies)}[/cyan] [dim]studies[/dim][/i]", total=len(studies))
+            status.update(f"[i][dim]Running AMR++ on[/dim] {len(jobs)} [dim]studies[/dim][/i]")
+            task = progress.add_task(f"[blue]:gear:[/blue] [i][dim]Running AMR++ on[/dim] [cyan]{len(jobs)}[/cyan] [dim]studies[/dim][/i]", total=len(jobs))
+            common.run_queue(run_amr, split_size, jobs, status_subs, on_done=lambda context, study: progress.update(task, advance=1))
+
+            status.update("[i][dim]Waiting for work directory cleanup[/dim][/i]", spinner='toggle9', spinner_style='gold1')
+            cleaner.shutdown(wait=True)
 
-                for study in studies:
-                    status.update(f"[i][dim]Running AMR++ on [/dim] [blue]{study}[/blue][dim]: ({studies.index(study)+1}/{len(studies)}) [/dim][/i]", spinner='point', spinner_style='magenta')
-
-                    hq_reads = f"{base_dir}/{study}/hostile_out"
-                    amr_out = f"{base_dir}/{study}/amr_out"
-
-                    os.makedirs(amr_out, exist_ok=True)
-
-                    if os.path.exists(f'{amr_out}/Results') and len(os.listdir(f"{amr_out}/Results")) == 4:
-                        logger.info(f"{common.EMOJI_CHECK} AMR++ already run for [blue]{study}[/blue]. Skipping...")
-                    else:
-                        # common.run_command(
-                        #     f'conda run -n {utility_paths['AMR++']} nextflow run main_AMR++.nf --pipeline resistome --reads "{hq_reads}/*_R{{1,2}}.clean_{{1,2}}.fastq.gz" --output "{amr_out}" --snp Y --deduped Y --threads {threads} -resume',
-                        #     desc=f"Running AMR++ on {study}"
-                        # )
-
-                        # With manual activation of conda env
-                        common.run_command(
-                            f'nextflow run main_AMR++.nf --pipeline resistome --reads "{hq_reads}/*_R{{1,2}}.clean_{{1,2}}.fastq.gz" --output "{amr_out}" --snp Y --deduped Y --threads {threads} -resume',
-                            desc=f"Running AMR++ on {study}"
-                        )
-                        
-                        status.update(f"[i][dim]Clearing the [b]work[/b] directory[/dim][/i]", spinner='toggle9', spinner_style='gold1')
-                        logger.info(f"{common.EMOJI_TRASH} Clearing the work directory...")
-                        common.run_command("rm -rv work/*", desc="Removing temporary files from work dir")
-
-                    progress.update(task, advance=1)
-                    console.rule(f"[dim][i]Generated AMR gene abundance tables for[/dim] [blue]{study}[/blue][/i]", characters="-", style='dim')
-            
-            # Change to amr_hg directory
-            # os.system(f'cd {base_dir}')
             console.print(
                 panel.fit(
                     f"{common.EMOJI_CHECK} [bold green]Finished[/bold green] AMR++.", 
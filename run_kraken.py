@@ -1,30 +1,36 @@
 #!/usr/bin/python
 
 import argparse
+import concurrent.futures
 import glob
-import inflect
 import os
+import shutil
+import statistics
+import sys
 
 from rich.console import Group
-from rich.live import Live
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
-from rich.traceback import install
+from rich.progress import SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
+import autotune
 import common
-from get_info import names_list, make_dict
+import planner
+import project_index
+import retention
+from get_info import make_dict
+from kraken_utils import merge_kreports
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Rich traceback handler
-install(show_locals=True)
+common.install_traceback()
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 
-# Initiate Progress() object for n_studies
-progress = Progress(
+# Initiate the progress bar for n_studies (logged instead of drawn without the Rich backend)
+progress = common.new_progress(
     SpinnerColumn(spinner_name='dots12', style='blue'),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -34,47 +40,176 @@ progress = Progress(
     transient=True,
 )
 
-# Kraken2 function
-def run_kraken(sub_list, status_sub):
-    for sample in sub_list:
-        status_sub.update(f"[i][dim]Classifying reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim]: ({sub_list.index(sample)+1}/{len(sub_list)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+# Run k2 classify (with memory mapping) on one pair of FASTQs
+def classify(read1, read2, out_prefix, n_threads, desc=None):
+    return common.run_command(
+        f"mamba run -n {utility_paths['Kraken2']} k2 classify --db {utility_paths['kraken_DB']} --memory-mapping --threads {n_threads} --paired --output {out_prefix}.out --report {out_prefix}.report --use-names {read1} {read2}",
+        desc=desc,
+        tool='Kraken2', threads=n_threads, input_bytes=os.path.getsize(read1) + os.path.getsize(read2)
+    )
+
+# Split a large sample into read-aligned shards, classify them concurrently, and merge the outputs
+def classify_sharded(context, sample, read1, read2, status_sub):
+    study, kraken_out = context['study'], context['kraken_out']
+    shard_dir = f"{kraken_out}/{sample}/shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    status_sub.update(f"[i][dim]Sharding reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] [dim]into {shards} parts[/dim][/i] \n", spinner='toggle10', spinner_style='sky_blue2')
+    returncode = common.run_command(
+        f"mamba run -n {utility_paths['seqkit']} seqkit split2 -1 {read1} -2 {read2} -p {shards} -O {shard_dir} -j {threads} -f",
+        desc=f"Splitting {sample} into {shards} shards"
+    )
+    if returncode != 0:
+        return returncode
+
+    parts = sorted(f for f in os.listdir(shard_dir) if f.startswith(f"{sample}_R1.clean_1.part_"))
+    out_prefixes = [f"{shard_dir}/{sample}.part_{part.split('.part_')[1].split('.')[0]}" for part in parts]
+    shard_threads = max(1, tool_threads['Kraken2'] // len(parts))
+    status_sub.update(f"[i][dim]Classifying {len(parts)} shards of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='point', spinner_style='magenta')
+    # Shards share the worker's placement slot
+    slot = common.current_slot()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts)) as executor:
+        futures = []
+        for i, (part, prefix) in enumerate(zip(parts, out_prefixes)):
+            futures.append(executor.submit(
+                common.in_slot,
+                slot,
+                classify,
+                f"{shard_dir}/{part}",
+                f"{shard_dir}/{part.replace('_R1.clean_1.', '_R2.clean_2.')}",
+                prefix,
+                shard_threads,
+                f"Running Kraken2 on {sample} shard {i+1}/{len(parts)}"
+            ))
+        returncodes = [future.result() for future in futures]
+    if any(returncodes):
+        return max(returncodes)
+
+    # Shards are read-disjoint: concatenate per-read output, sum the reports
+    with open(f"{kraken_out}/{sample}/{sample}.out.tmp", 'wb') as out:
+        for prefix in out_prefixes:
+            with open(f"{prefix}.out", 'rb') as part_out:
+                shutil.copyfileobj(part_out, out)
+    os.replace(f"{kraken_out}/{sample}/{sample}.out.tmp", f"{kraken_out}/{sample}/{sample}.out")
+    merge_kreports([f"{prefix}.report" for prefix in out_prefixes], f"{kraken_out}/{sample}/{sample}.report")
+    shutil.rmtree(shard_dir)
+    logger.info(f"{common.EMOJI_CHECK} Merged {len(parts)} shards of [green]{sample}[/green]")
+    return 0
+
+# Classify one sample on node-local copies of its reads, then move the outputs back (report last, as it marks the sample done)
+def classify_staged(context, sample, read1, read2, status_sub):
+    kraken_out = context['kraken_out']
+    staged = common.stage_inputs(common.stage_key(context, sample), [read1, read2], out_factor=2)
+    try:
+        out_prefix = f"{staged['out']}/{sample}"
+        returncode = classify(staged['inputs'][read1], staged['inputs'][read2], out_prefix, tool_threads['Kraken2'], desc=f"Running Kraken2 on {sample} (staged)")
+        if returncode != 0:
+            return returncode
+        outputs = {}
+        if out_format == 'kbin' and os.path.exists(f"{out_prefix}.out"):
+            status_sub.update(f"[i][dim]Packing per-read output of[/dim] [blue]{context['study']}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='toggle10', spinner_style='sky_blue2')
+            if kraken_out_bin.convert(f"{out_prefix}.out", f"{out_prefix}.kbin") is not None:
+                outputs[f"{out_prefix}.kbin"] = f"{kraken_out}/{sample}/{sample}.kbin"
+        if not outputs:
+            outputs[f"{out_prefix}.out"] = f"{kraken_out}/{sample}/{sample}.out"
+        outputs[f"{out_prefix}.report"] = f"{kraken_out}/{sample}/{sample}.report"
+        common.stage_out(outputs)
+        return 0
+    finally:
+        common.unstage(staged)
+
+# Size of a sample's cleaned reads in bytes (0 if they are missing)
+def clean_size(context, sample):
+    reads = [f"{context['hostile_out']}/{sample}_R1.clean_1.fastq.gz", f"{context['hostile_out']}/{sample}_R2.clean_2.fastq.gz"]
+    return sum(os.path.getsize(read) for read in reads if os.path.exists(read))
+
+# Whether a sample is classified with sharding (large inputs)
+def use_shards(context, sample):
+    return shards > 1 and clean_size(context, sample) / 1024**3 >= shard_min_gb
+
+# Prefetch a sample's cleaned reads into the staging area
+def prefetch_kraken(context, sample):
+    read1 = f"{context['hostile_out']}/{sample}_R1.clean_1.fastq.gz"
+    read2 = f"{context['hostile_out']}/{sample}_R2.clean_2.fastq.gz"
+    if os.path.exists(f"{context['kraken_out']}/{sample}/{sample}.report") or not os.path.exists(read1) or use_shards(context, sample):
+        return
+    common.prefetch_inputs(common.stage_key(context, sample), [read1, read2], out_factor=2)
 
-        os.makedirs(f"{kraken_out}/{sample}", exist_ok=True)
-        if f"{sample}.report" in os.listdir(f"{kraken_out}/{sample}"):
-            logger.info(f"{common.EMOJI_CHECK} Already classified the reads of [green]{sample}[/green]. Skipping...")
+# Kraken2 function, chained with Bracken and MPA conversion per sample
+def run_kraken(context, sample, status_sub):
+    study, hostile_out, kraken_out = context['study'], context['hostile_out'], context['kraken_out']
+    status_sub.update(f"[i][dim]Classifying reads of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] [dim]({context['type']})[/dim][/i] \n", spinner='point', spinner_style='magenta')
+
+    os.makedirs(f"{kraken_out}/{sample}", exist_ok=True)
+    if f"{sample}.report" in os.listdir(f"{kraken_out}/{sample}"):
+        logger.info(f"{common.EMOJI_CHECK} Already classified the reads of [green]{sample}[/green]. Skipping...")
+    else:
+        logger.info(f"{common.EMOJI_PROCESS} Running Kraken2 on [blue]{sample}[/blue]...")
+        # common.run_command(
+        #     f"mamba run -n {utility_paths['Kraken2']} k2 classify --db {utility_paths['kraken_DB']} --threads {threads} --paired --output {kraken_out}/{sample}/{sample}.out --report {kraken_out}/{sample}/{sample}.report --use-names {hostile_out}/{sample}_R1.clean_1.fastq.gz {hostile_out}/{sample}_R2.clean_2.fastq.gz",
+        #     desc=f"Running Kraken2 on {sample}"
+        # )
+
+        read1 = f"{hostile_out}/{sample}_R1.clean_1.fastq.gz"
+        read2 = f"{hostile_out}/{sample}_R2.clean_2.fastq.gz"
+        # Staged samples are packed on the node before their outputs move back
+        sharded = use_shards(context, sample)
+        staged = not sharded and common.staging_enabled()
+        if sharded:
+            returncode = classify_sharded(context, sample, read1, read2, status_sub)
+        elif staged:
+            returncode = classify_staged(context, sample, read1, read2, status_sub)
         else:
-            logger.info(f"{common.EMOJI_PROCESS} Running Kraken2 on [blue]{sample}[/blue]...")
-            # common.run_command(
-            #     f"mamba run -n {utility_paths['Kraken2']} k2 classify --db {utility_paths['kraken_DB']} --threads {threads} --paired --output {kraken_out}/{sample}/{sample}.out --report {kraken_out}/{sample}/{sample}.report --use-names {hostile_out}/{sample}_R1.clean_1.fastq.gz {hostile_out}/{sample}_R2.clean_2.fastq.gz",
-            #     desc=f"Running Kraken2 on {sample}"
-            # )
-
-            # With memory mapping
-            common.run_command(
-                f"mamba run -n {utility_paths['Kraken2']} k2 classify --db {utility_paths['kraken_DB']} --memory-mapping --threads {threads} --paired --output {kraken_out}/{sample}/{sample}.out --report {kraken_out}/{sample}/{sample}.report --use-names {hostile_out}/{sample}_R1.clean_1.fastq.gz {hostile_out}/{sample}_R2.clean_2.fastq.gz",
-                desc=f"Running Kraken2 on {sample}"
-            )
-        console.rule(f"[dim i]{common.EMOJI_CHECK} Classified the reads of [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
-        status_sub.update(f"[i][dim]Classified reads of [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim] with Kraken2, Waiting for other processes [/dim][/i] \n")
+            returncode = classify(read1, read2, f"{kraken_out}/{sample}/{sample}", tool_threads['Kraken2'], desc=f"Running Kraken2 on {sample}")
+        if returncode != 0:
+            logger.error(f"{common.EMOJI_CROSS} Kraken2 failed for [red]{sample}[/red]. Skipping Bracken and MPA conversion...")
+            return
+        if out_format == 'kbin' and not staged:
+            status_sub.update(f"[i][dim]Packing per-read output of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='toggle10', spinner_style='sky_blue2')
+            if kraken_out_bin.convert(f"{kraken_out}/{sample}/{sample}.out", f"{kraken_out}/{sample}/{sample}.kbin") is not None:
+                os.remove(f"{kraken_out}/{sample}/{sample}.out")
+    console.rule(f"[dim i]{common.EMOJI_CHECK} Classified the reads of [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
+
+    # Bracken and MPA conversion right behind classification, on the same worker
+    if run_bracken(context, sample, status_sub) == 0:
+        run_mpa(context, sample, status_sub)
+    status_sub.update(f"[i][dim]Generated abundance tables for [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim], Waiting for other processes [/dim][/i] \n")
 
 # Bracken function
-def run_bracken(sub_list, status_sub):
-    for sample in sub_list:
-        status_sub.update(f"[i][dim]Running Bracken on[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] [dim]: ({sub_list.index(sample)+1}/{len(sub_list)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
-        if f"{sample}.bracken" in os.listdir(f"{kraken_out}/{sample}"):
-            logger.info(f"{common.EMOJI_CHECK} Already estimated the abundance of [green]{sample}[/green]. Skipping...")
-        else:
-            logger.info(f"{common.EMOJI_PROCESS} Running Bracken on [blue]{sample}[/blue]...")
-            common.run_command(
-                f"mamba run -n {utility_paths['Bracken']} bracken -d {utility_paths['kraken_DB']} -i {kraken_out}/{sample}/{sample}.report -o {kraken_out}/{sample}/{sample}.bracken",
-                desc=f"Calculating abundances with Bracken"
-            )
-        
+def run_bracken(context, sample, status_sub):
+    study, kraken_out = context['study'], context['kraken_out']
+    status_sub.update(f"[i][dim]Running Bracken on[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='point', spinner_style='magenta')
+    if f"{sample}.bracken" in os.listdir(f"{kraken_out}/{sample}"):
+        logger.info(f"{common.EMOJI_CHECK} Already estimated the abundance of [green]{sample}[/green]. Skipping...")
+        return 0
+
+    if kmer_distr is not None:
+        logger.info(f"{common.EMOJI_PROCESS} Running in-process Bracken on [blue]{sample}[/blue]...")
+        bracken_est.estimate_sample(f"{kraken_out}/{sample}/{sample}.report", kmer_distr, thresh=bracken_thresh)
         console.rule(f"[dim i]{common.EMOJI_CHECK} Generated abundance table for [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
-        status_sub.update(f"[i][dim]Generated abundance table for [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim] with Bracken, Waiting for other processes [/dim][/i] \n")
+        return 0
 
+    logger.info(f"{common.EMOJI_PROCESS} Running Bracken on [blue]{sample}[/blue]...")
+    returncode = common.run_command(
+        f"mamba run -n {utility_paths['Bracken']} bracken -d {utility_paths['kraken_DB']} -r {read_len} -t {bracken_thresh} -i {kraken_out}/{sample}/{sample}.report -o {kraken_out}/{sample}/{sample}.bracken",
+        desc=f"Calculating abundances with Bracken"
+    )
+    if returncode == 0:
+        console.rule(f"[dim i]{common.EMOJI_CHECK} Generated abundance table for [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
+    return returncode
 
+# Convert Bracken report to MPA format
+def run_mpa(context, sample, status_sub):
+    study, kraken_out = context['study'], context['kraken_out']
+    status_sub.update(f"[i][dim]Converting Bracken report of[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] [dim]to MPA format[/dim][/i] \n", spinner='point', spinner_style='magenta')
+    if f"{sample}_mpa.txt" in os.listdir(f"{kraken_out}/{sample}"):
+        logger.info(f"{common.EMOJI_CHECK} MPA file already exists for [green]{sample}[/green]. Skipping...")
+        return 0
 
+    logger.info(f"{common.EMOJI_PROCESS} Converting [blue]{sample}[/blue]'s Bracken report to MPA format...")
+    return common.run_command(
+        f"mamba run -n {utility_paths['krakentools']} kreport2mpa.py -r {kraken_out}/{sample}/{sample}_bracken_species.report -o  {kraken_out}/{sample}/{sample}_mpa.txt",
+        desc=f"Converting {sample} to MPA format"
+    )
 
 
 if __name__ == "__main__":
@@ -84,7 +219,24 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
     parser.add_argument("-u", "--utility_paths", help="Envs or Paths for tools and DBs as a CSV file. (Default: utility_paths.csv)", default="utility_paths.csv")
     parser.add_argument("-t", "--threads", type=int, default=1, help="Number of threads (Default: 1)")
-    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3], nargs="?", default=1, help="Number of sub_lists to make, and run concurrently (Default: no splitting, everything as one list).")
+    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3], nargs="?", default=1, help="Number of samples to run concurrently, fed from one queue across all studies (Default: 1)")
+    parser.add_argument("-e", "--inproc_bracken", action="store_true", help="Estimate abundances with the in-process Bracken (bracken_est.py) instead of the bracken CLI")
+    parser.add_argument("-r", "--read_len", type=int, default=100, help="Read length of the Bracken kmer_distrib file (Default: 100)")
+    parser.add_argument("-n", "--shards", type=int, default=1, help="Split large samples into this many read-aligned shards, classified concurrently (Default: 1, no sharding)")
+    parser.add_argument("-m", "--shard_min_gb", type=float, default=20, help="Only shard samples whose cleaned FASTQs add up to at least this many GB (Default: 20)")
+    parser.add_argument("-f", "--out_format", choices=['text', 'kbin'], default='text', help="Keep per-read output as Kraken2 text (.out) or the compact .kbin store (Default: text)")
+    parser.add_argument("--stage_dir", help="Node-local directory (NVMe/tmpfs) to classify unsharded samples in (Default: off)", default=None)
+    parser.add_argument("--stage_gb", type=float, default=100, help="Maximum GB of staged reads and outputs at once (Default: 100)")
+    parser.add_argument("--autotune", action="store_true", help="Choose Kraken2 threads and concurrency from recorded run metrics (see autotune.py); split_size becomes the maximum")
+    parser.add_argument("--tool_threads", help="Per-tool overrides as a tool,threads CSV; threads may be '8x2' for 8 threads x 2 concurrent (Default: none)", default=None)
+    parser.add_argument("--pin", action="store_true", help="Pin each concurrent worker to its own cores and NUMA node, and report per-slot utilisation")
+    parser.add_argument("--retention", help="Apply the intermediate-artifact retention policy (see retention.py) as samples finish, optionally from a stage,action CSV; 'default' for the built-in policy (Default: off)", default=None)
+    parser.add_argument("--bracken_thresh", type=int, default=10, help="Minimum clade reads for Bracken re-estimation (Default: 10)")
+    parser.add_argument("--executor", choices=['local', 'shared', 'slurm', 'slurm_local'], default='local', help="Run sample queues on local threads; 'shared' with other processes started the same way on any nodes, through a queue beside the base dir; or as Slurm job arrays ('slurm_local': on the local sbatch/squeue stand-in, slurm_standin.py) (Default: local)")
+    parser.add_argument("--sbatch_opts", help="Extra sbatch options for the job arrays, e.g. \"--partition=long --account=lab\" (Default: none)", default="")
+    parser.add_argument("--array_limit", type=int, default=0, help="Maximum running tasks per job array (Default: no limit)")
+    parser.add_argument("--job_resources", help="Per-tool memory and time of array tasks as a tool,mem_gb:hours CSV (Default: built-in)", default=None)
+    parser.add_argument("--plan", action="store_true", help="Only print the pending samples with estimated CPU-hours, disk use and makespan (see planner.py)")
     args=parser.parse_args()
 
     console.print(  
@@ -100,6 +252,21 @@ if __name__ == "__main__":
     utility_paths_in = args.utility_paths
     threads = args.threads
     split_size = args.split_size
+    read_len = args.read_len
+    bracken_thresh = args.bracken_thresh
+    out_format = args.out_format
+    shards = args.shards
+    shard_min_gb = args.shard_min_gb
+    tool_threads = {'Kraken2': threads}
+
+    if args.stage_dir:
+        common.configure_staging(args.stage_dir, args.stage_gb)
+
+
+    # Reclaim space in the background as each sample's consumers finish
+    collector = None
+    if args.retention:
+        collector = retention.start_collector(retention.load_policy(args.retention), threads)
 
     utility_paths = make_dict(utility_paths_in)
     console.print(
@@ -111,36 +278,49 @@ if __name__ == "__main__":
         style='italic'
     )
 
+    # Load the kmer distribution once, shared by all workers
+    kmer_distr = None
+    if args.inproc_bracken:
+        import bracken_est
+        kmer_distr = bracken_est.load_kmer_distrib(utility_paths['kraken_DB'], args.read_len)
+
+    if out_format == 'kbin':
+        import kraken_out_bin
+
     if args.base_dir in [".", "./"]:
         base_dir = os.getcwd()
     else:
         base_dir = os.path.join(os.getcwd(), args.base_dir)
 
-    if args.projects in os.listdir(base_dir):
-        logger.info(f"{common.EMOJI_SPARKLE} Found project file [bold blue]{args.projects}[/] in [bold blue]{args.base_dir}[/]")
-        base_dirs = [base_dir]
-    else:
-        logger.info(f"{common.EMOJI_PROCESS} [bold blue]{args.projects}[/] not in [bold blue]{args.base_dir}[/], searching subdirectories.")
-        # It may work only for one sub-level
-        base_dirs = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if args.projects in os.listdir(os.path.join(base_dir, d))]
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples, write=not args.plan)
+    base_dirs = project_index.base_dirs(index)
+
+    if args.plan:
+        planner.plan_runner(index, base_dir, ['kraken'], threads, split_size, bool(args.retention))
+        sys.exit(0)
+
+    # Sample queues are shared with other workers, or run as job arrays, when another executor is selected
+    if args.executor != 'local':
+        common.configure_executor(args.executor, f"{base_dir}_executor_work", args.sbatch_opts, args.array_limit, make_dict(args.job_resources) if args.job_resources else None)
+
+    # Tool runs are recorded for the autotuner
+    metrics_file = os.path.join(base_dir, autotune.METRICS_FILE)
+    common.configure_metrics(metrics_file)
 
     # Main status
     status = console.status(f"[i][dim]Initiating read classification on[/dim] {len(base_dirs)} [dim] study {p.plural('type', len(base_dirs))}[/dim][/i]")
     
-    # Per-study statuses
-    status_subs = []
-    for i in range(split_size):
-        status_subs.append(console.status(f"[i][dim]Running Kraken2 on thread {i+1}...[/dim][/i]"))
+    # Per-worker statuses, rendered together as one table
+    board = common.StatusBoard(split_size, "[i][dim]Waiting for a sample...[/dim][/i]")
+    status_subs = board.slots
 
-    with Live(Group(status, progress, *status_subs), console=console, transient=True):
+    with common.live(Group(status, progress, board), refresh_per_second=common.BOARD_REFRESH):
         if base_dirs:
+            # One queue of samples across all studies and data types
+            jobs = []
             for base in base_dirs:
-                status.update(f"[i][dim]Running Kraken2 on[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]datasets ({base_dirs.index(base)+1}/{len(base_dirs)})[/dim][/i]")
-
-                console.rule(f"Performing QC on all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
-
-                studies_in = os.path.join(base, args.projects)
-                studies = names_list(studies_in)
+                studies = project_index.studies(index, base)
                 console.print(
                     panel.fit(
                         f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(studies)}[/] [dim]studies in[/] {os.path.basename(base)} [dim]dir[/]", 
@@ -149,54 +329,42 @@ if __name__ == "__main__":
                     ),
                     style='italic'
                 )
-                
-                task = progress.add_task(f"{common.EMOJI_PROCESS} [i][dim]Classifying reads from[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]studies[/dim][/i]", total=len(studies))
                 for study in studies:
-                    
-                    console.rule(f"[dim][i]Running Kraken2 on[/dim] {study}[/i] \n", characters="-", style='dim')
-                    
-                    hostile_out = f"{base}/{study}/hostile_out"
-                    kraken_out = f"{base}/{study}/kraken_out"
-
-                    os.makedirs(kraken_out, exist_ok=True)
+                    context = common.study_context(base, study, hostile_out="hostile_out", kraken_out="kraken_out")
+                    os.makedirs(context['kraken_out'], exist_ok=True)
 
-                    samples = names_list(f"{base}/{study}/{samples_in}")
+                    samples = project_index.samples(index, base, study)
                     samples_count = len(samples)
                     logger.info(f"{common.EMOJI_SPARKLE} Project [bold blue]{study}[/] has {samples_count} {p.plural('sample', samples_count)}...")
+                    jobs.extend((context, sample) for sample in samples)
+
+            status.update(f"[i][dim]Running Kraken2 on[/dim] {len(jobs)} [dim]samples from[/dim] {len(base_dirs)} [dim]study {p.plural('type', len(base_dirs))}[/dim][/i]")
+            task = progress.add_task(f"{common.EMOJI_PROCESS} [i][dim]Classifying reads of all samples[/dim][/i]", total=len(jobs))
+
+            # Kraken2 threads and concurrency for this node and these input sizes
+            if args.autotune or args.tool_threads:
+                overrides = make_dict(args.tool_threads) if args.tool_threads else {}
+                sample_size = statistics.median(clean_size(context, sample) for context, sample in jobs) if jobs else 0
+                tuned = autotune.plan(metrics_file, dict(tool_threads), {'Kraken2': sample_size}, autotune.available_cores(), split_size, overrides)
+                autotune.show_plan(tuned)
+                tool_threads['Kraken2'], split_size = tuned['Kraken2']['threads'], tuned['Kraken2']['split_size']
+            if args.pin:
+                common.configure_placement(split_size, tool_threads['Kraken2'])
+
+            def sample_done(context, sample):
+                progress.update(task, advance=1)
+                if collector:
+                    retention.submit(collector, context, sample)
+
+            # Run Kraken2, with Bracken and MPA conversion chained per sample
+            common.run_queue(run_kraken, split_size, jobs, status_subs, on_done=sample_done, prefetch=prefetch_kraken if common.staging_enabled() else None, resources=common.job_resources(['Kraken2'], tool_threads['Kraken2']))
+            if collector:
+                status.update("[i][dim]Waiting for the retention policy to finish[/dim][/i]", spinner='toggle9', spinner_style='gold1')
+                retention.stop_collector(collector)
 
-                    sample_lists = common.get_split_size(split_size, samples)
-
-                    # Run Kraken2
-                    common.run_concurrently(run_kraken, split_size, sample_lists, status_subs=status_subs)
-
-                    # Run Bracken
-                    for status_sub in status_subs:
-                        status_sub.update("[dim]Running Bracken...[/dim]", spinner='toggle9', spinner_style='magenta')
-                    
-                    run_bracken(samples, status_sub=status_subs[0])
-
-                    # Convert Bracken reports to MPA format
-                    for status_sub in status_subs:
-                        status_sub.update("[dim]Converting bracken reports to mpa format...[/dim] \n", spinner='toggle9', spinner_style='magenta')
-                    
-                    for sample in samples:
-                        if f"{sample}_mpa.txt" in os.listdir(f"{kraken_out}/{sample}"):
-                            logger.info(f"{common.EMOJI_CHECK} MPA file already exists for [green]{sample}[/green]. Skipping...")
-                        else:
-                            logger.info(f"{common.EMOJI_PROCESS} Converting [blue]{sample}[/blue]'s Bracken report to MPA format...")
-                            common.run_command(
-                                f"mamba run -n {utility_paths['krakentools']} kreport2mpa.py -r {kraken_out}/{sample}/{sample}_bracken_species.report -o  {kraken_out}/{sample}/{sample}_mpa.txt"
-                            )
-                        
-                    console.rule(f"[dim i]{common.EMOJI_CHECK} Converted [blue]{study}[/blue]'s Bracken reports to MPA format[/dim i]", characters="-", style='dim')
-
-                    console.rule(f"[dim][i]Completed read classification for[/dim] {study}[/i]", characters="-", style='dim')
-                    progress.update(task, advance=1)
-
-                console.rule(f"Completed read classification for all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
-                console.print('\n')
-                status.update(f"[i green dim]Processed [cyan b]{os.path.basename(base)}[/cyan b] studies[/i green dim]")
-                
+            console.rule("Completed read classification for all studies", characters="=", style='dim')
+            console.print('\n')
+            status.update(f"[i green dim]Processed {len(jobs)} samples[/i green dim]")
             
             console.print(
                 panel.fit(
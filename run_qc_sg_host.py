@@ -2,29 +2,34 @@
 
 import argparse
 import glob
-import inflect
 import os
+import statistics
+import sys
 
 from rich.console import Group
-from rich.live import Live
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
-from rich.traceback import install
+from rich.progress import SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
+import autotune
+import bgzf_index
 import common
-from get_info import names_list, make_dict
+import fq_manifest
+import planner
+import project_index
+import retention
+from get_info import make_dict
 # Using logger from common.py
 logger = common.logger
-p = inflect.engine()
+p = common.inflector
 
 # Rich traceback handler
-install(show_locals=True)
+common.install_traceback()
 
 # Using rich elements from common.py
 console = common.console
 panel = common.Panel
 
-# Initiate Progress() object for n_studies
-progress = Progress(
+# Initiate the progress bar for n_studies (logged instead of drawn without the Rich backend)
+progress = common.new_progress(
     SpinnerColumn(spinner_name='dots12', style='blue'),
     TextColumn("[progress.description]{task.description}"),
     BarColumn(),
@@ -34,19 +39,21 @@ progress = Progress(
 )
 
 # Run fastqc and multiqc
-def generate_qc_reports(in_dir, qc_out, mqc_out, status_sub):
-    status_sub.update(f"[i][dim]Generating QC reports for[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{os.path.basename(in_dir)}[/magenta] [dim]: ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+def generate_qc_reports(context, in_dir, qc_out, mqc_out, status_sub):
+    study = context['study']
+    status_sub.update(f"[i][dim]Generating QC reports for[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{os.path.basename(in_dir)}[/magenta] [dim]({context['type']})[/dim][/i] \n", spinner='point', spinner_style='magenta')
 
     logger.info(f"{common.EMOJI_SPARKLE} Running FastQC on [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{in_dir}[/magenta]...")
 
-    if len(os.listdir(qc_out)) == len(os.listdir(raw_reads))*2:
+    if len(os.listdir(qc_out)) == len(os.listdir(context['raw_reads']))*2:
         logger.info(f"{common.EMOJI_CHECK} FastQC reports already generated for [green]{study}[/green]. Skipping...")
     else:
         logger.info(f"{common.EMOJI_PROCESS} Generating QC reports for [blue]{study}[/blue]...")
         # Doesn't work with subprocess because of wildcard
         common.run_command(
-            f"mamba run -n {utility_paths['FastQC']} fastqc {in_dir}/*.gz -o {qc_out} -t {threads*split_size}",
-            desc=f"Generating FastQC reports for {study}"
+            f"mamba run -n {utility_paths['FastQC']} fastqc {in_dir}/*.gz -o {qc_out} -t {tool_threads['FastQC']}",
+            desc=f"Generating FastQC reports for {study}",
+            tool='FastQC', threads=tool_threads['FastQC'], input_bytes=sum(os.path.getsize(f) for f in glob.glob(f"{in_dir}/*.gz"))
         )
 
     logger.info(f"{common.EMOJI_SPARKLE} Running MultiQC on [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{qc_out}[/magenta] reports...")
@@ -61,61 +68,128 @@ def generate_qc_reports(in_dir, qc_out, mqc_out, status_sub):
 
     console.rule(f"[dim i]{common.EMOJI_CHECK} Generated QC reports for [blue]{study}[/blue][/dim i]", characters="-", style='dim')
 
+# QC reports of one study's stage dir (raw_reads, bb_out or fp_out) as a queue unit, so that with a shared or
+# batch executor each study's reports are generated once, by one worker
+def run_qc_reports(context, stage, status_sub):
+    qc_out, mqc_out = {'raw_reads': ('raw_qc', 'raw_mqc'), 'bb_out': ('bb_qc', 'bb_mqc'), 'fp_out': ('fp_qc', 'fp_mqc')}[stage]
+    generate_qc_reports(context, context[stage], context[qc_out], context[mqc_out], status_sub)
+
+
+# Whether BBDuk and fastp outputs of a sample already exist (or were consumed by Hostile and reclaimed)
+def qc_done(context, sample):
+    if f"{sample}_R2.clean_2.fastq.gz" in os.listdir(context['hostile_out']):
+        return True, True
+    bb_done = any(file in os.listdir(context['bb_out']) for file in [f"{sample}_R2.fq.gz", f"{sample}.fq.gz"])
+    fp_done = f"{sample}_R2.fq.gz" in os.listdir(context['fp_out'])
+    return bb_done, fp_done
 
 # Run BBDuk and fastp - This is only for Paired ends. Add logic for Single-ends
-def run_qc(sub_list, status_sub):
-    for sample in sub_list:
-        status_sub.update(f"[i][dim]Filtering reads of [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim]: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+# With staging enabled, both run on node-local copies and their outputs are moved back when done
+def run_qc(context, sample, status_sub):
+    study, bb_out, fp_out = context['study'], context['bb_out'], context['fp_out']
+    status_sub.update(f"[i][dim]Filtering reads of [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim] ({context['type']})[/dim][/i] \n", spinner='point', spinner_style='magenta')
+    read1, read2 = context['manifest'][sample]['read1'], context['manifest'][sample]['read2']
+    bb_done, fp_done = qc_done(context, sample)
+
+    staged = None
+    bb_dir, fp_dir = bb_out, fp_out
+    if common.staging_enabled() and not (bb_done and fp_done):
+        staged = common.stage_inputs(common.stage_key(context, sample), [read1, read2], out_factor=2)
+        read1, read2 = staged['inputs'][read1], staged['inputs'][read2]
+        bb_dir, fp_dir = f"{staged['out']}/bb", f"{staged['out']}/fp"
+        os.makedirs(bb_dir, exist_ok=True)
+        os.makedirs(fp_dir, exist_ok=True)
+
+    try:
         # BBDuk
-        if any(file in os.listdir(bb_out) for file in [f"{sample}_R2.fq.gz", f"{sample}.fq.gz"]):
+        if bb_done:
             logger.info(f"{common.EMOJI_CHECK} BBDuk already processed [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta]. Skipping...")
+            bb_dir = bb_out
         else:
             logger.info(f"{common.EMOJI_PROCESS} Processing [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] with BBDuk...")
-            reads = glob.glob(f"{raw_reads}/{sample}*")
-            for read in reads:
-                if "_1." in read:
-                    read1 = read
-                    # Output: {ds}/raw_reads/{sample}*R1*
-                else:
-                    read2 = read
             common.run_command(
-                f"mamba run -n {utility_paths['BBDuk']} bbduk.sh in1={read1} in2={read2} out1={bb_out}/{sample}_R1.fq.gz out2={bb_out}/{sample}_R2.fq.gz ref={utility_paths['bb_adapters']} k=19 mink=7 ktrim=r trimq=20 qtrim=r hdist=1 tpe tbo threads={threads} 2> {bb_out}/{sample}.log",
-                desc=f"Trimming {sample} reads"
+                f"mamba run -n {utility_paths['BBDuk']} bbduk.sh in1={read1} in2={read2} out1={bb_dir}/{sample}_R1.fq.gz out2={bb_dir}/{sample}_R2.fq.gz ref={utility_paths['bb_adapters']} k=19 mink=7 ktrim=r trimq=20 qtrim=r hdist=1 tpe tbo threads={tool_threads['BBDuk']} 2> {bb_dir}/{sample}.log",
+                desc=f"Trimming {sample} reads",
+                tool='BBDuk', threads=tool_threads['BBDuk'], input_bytes=fq_manifest.input_size(context['manifest'], sample)
             )
-        
-        os.system(f"grep Result {bb_out}/{sample}.log >> {base}/{study}/bb_out_count.txt")
-        
+    
         # fastp
-        status_sub.update(f"[i][dim]Deduplicating reads of [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim]: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
-        if f"{sample}_R2.fq.gz" in os.listdir(fp_out):
+        status_sub.update(f"[i][dim]Deduplicating reads of [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim] ({context['type']})[/dim][/i] \n", spinner='point', spinner_style='magenta')
+        if fp_done:
             logger.info(f"{common.EMOJI_CHECK} fastp already processed [blue]{study}[/blue] {common.EMOJI_PLAY} [green]{sample}[/green]. Skipping...")
         else:
             logger.info(f"{common.EMOJI_PROCESS} Processing [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] with fastp...")
             common.run_command(
-                f"mamba run -n {utility_paths['fastp']} fastp -i {bb_out}/{sample}_R1.fq.gz -o {fp_out}/{sample}_R1.fq.gz -I {bb_out}/{sample}_R2.fq.gz -O {fp_out}/{sample}_R2.fq.gz -D -A -h {fp_out}/{sample}.html -j {fp_out}/{sample}.json -w {threads}",
-                desc=f"Performing deduplication of {sample} reads"
+                f"mamba run -n {utility_paths['fastp']} fastp -i {bb_dir}/{sample}_R1.fq.gz -o {fp_dir}/{sample}_R1.fq.gz -I {bb_dir}/{sample}_R2.fq.gz -O {fp_dir}/{sample}_R2.fq.gz -D -A -h {fp_dir}/{sample}.html -j {fp_dir}/{sample}.json -w {tool_threads['fastp']}",
+                desc=f"Performing deduplication of {sample} reads",
+                tool='fastp', threads=tool_threads['fastp'], input_bytes=fq_manifest.input_size(context['manifest'], sample)
             )
 
-        console.rule(f"[dim i]{common.EMOJI_CHECK} Generated HQ reads for [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
-        status_sub.update(f"[i][dim]Filtering completed: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+        if staged:
+            # Logs and reports first, reads last: the R2 files mark a stage as done
+            status_sub.update(f"[i][dim]Moving filtered reads back:[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='toggle10', spinner_style='sky_blue2')
+            outputs = {}
+            for local_dir, final_dir, names in [
+                (f"{staged['out']}/bb", bb_out, [f"{sample}.log", f"{sample}_R1.fq.gz", f"{sample}_R2.fq.gz"]),
+                (f"{staged['out']}/fp", fp_out, [f"{sample}.html", f"{sample}.json", f"{sample}_R1.fq.gz", f"{sample}_R2.fq.gz"]),
+            ]:
+                outputs.update({f"{local_dir}/{name}": f"{final_dir}/{name}" for name in names})
+            common.stage_out(outputs)
+    finally:
+        if staged:
+            common.unstage(staged)
+
+    os.system(f"grep Result {bb_out}/{sample}.log >> {context['base']}/{study}/bb_out_count.txt")
+
+    console.rule(f"[dim i]{common.EMOJI_CHECK} Generated HQ reads for [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
+    status_sub.update(f"[i][dim]Filtering completed:[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='point', spinner_style='magenta')
+
+# Prefetch a sample's raw reads into the staging area
+def prefetch_qc(context, sample):
+    if all(qc_done(context, sample)):
+        return
+    entry = context['manifest'][sample]
+    common.prefetch_inputs(common.stage_key(context, sample), [entry['read1'], entry['read2']], out_factor=2)
 
 # Run hostile
-def remove_host(sub_list, status_sub):
-    for sample in sub_list:
-        status_sub.update(f"[i][dim]Removing host reads from [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim]: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
-        # hostile
-        if f"{sample}_R2.clean_2.fastq.gz" in os.listdir(hostile_out):
-            logger.info(f"{common.EMOJI_CHECK} Host reads already removed from [blue]{study}[/blue] {common.EMOJI_PLAY} [green]{sample}[/green]. Skipping...")
-        else:
-            logger.info(f"{common.EMOJI_PROCESS} Processing [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] with Hostile...")
-            # Doesn't run with subprocess because of redirection
-            common.run_command(
-                f"mamba run -n {utility_paths['Hostile']} hostile clean --fastq1 {fp_out}/{sample}_R1.fq.gz --fastq2 {fp_out}/{sample}_R2.fq.gz --output {hostile_out} --index {utility_paths['Hostile_DB']} --threads {threads} > {hostile_out}/{sample}.log",
-                desc=f"Removing host reads from {sample}"
-            )
-        
-        console.rule(f"[dim i]{common.EMOJI_CHECK} Removed host reads from [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
-        status_sub.update(f"[i][dim]Removing host reads completed: ({sub_list.index(sample)+1}/{len(sub_list)}) | ({studies.index(study)+1}/{len(studies)}) [/dim][/i] \n", spinner='point', spinner_style='magenta')
+def remove_host(context, sample, status_sub):
+    study, fp_out, hostile_out = context['study'], context['fp_out'], context['hostile_out']
+    status_sub.update(f"[i][dim]Removing host reads from [/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][dim] ({context['type']})[/dim][/i] \n", spinner='point', spinner_style='magenta')
+    # hostile
+    if f"{sample}_R2.clean_2.fastq.gz" in os.listdir(hostile_out):
+        logger.info(f"{common.EMOJI_CHECK} Host reads already removed from [blue]{study}[/blue] {common.EMOJI_PLAY} [green]{sample}[/green]. Skipping...")
+    else:
+        logger.info(f"{common.EMOJI_PROCESS} Processing [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] with Hostile...")
+        # Doesn't run with subprocess because of redirection
+        common.run_command(
+            f"mamba run -n {utility_paths['Hostile']} hostile clean --fastq1 {fp_out}/{sample}_R1.fq.gz --fastq2 {fp_out}/{sample}_R2.fq.gz --output {hostile_out} --index {utility_paths['Hostile_DB']} --threads {tool_threads['Hostile']} > {hostile_out}/{sample}.log",
+            desc=f"Removing host reads from {sample}",
+            tool='Hostile', threads=tool_threads['Hostile'], input_bytes=fq_manifest.input_size(context['manifest'], sample)
+        )
+    
+    # Rewrite cleaned reads as BGZF with a read index, for parallel and random-access readers
+    if bgzf:
+        for clean_reads in [f"{hostile_out}/{sample}_R1.clean_1.fastq.gz", f"{hostile_out}/{sample}_R2.clean_2.fastq.gz"]:
+            if not os.path.exists(clean_reads) or os.path.exists(f"{clean_reads}.ridx.npy"):
+                continue
+            status_sub.update(f"[i][dim]Rewriting as BGZF:[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{os.path.basename(clean_reads)}[/magenta][/i] \n", spinner='toggle10', spinner_style='sky_blue2')
+            n_reads = bgzf_index.rewrite_bgzf(clean_reads, clean_reads, threads)
+            logger.info(f"{common.EMOJI_ZIP} Indexed {n_reads} reads of [green]{os.path.basename(clean_reads)}[/green]")
+
+    console.rule(f"[dim i]{common.EMOJI_CHECK} Removed host reads from [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/dim i]", characters="-", style='dim')
+    status_sub.update(f"[i][dim]Removing host reads completed:[/dim] [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta][/i] \n", spinner='point', spinner_style='magenta')
+
+# Threads per tool and the QC and host-removal queue splits: the defaults (FastQC runs once per study, so it gets
+# the whole split), or tuned for this node and the median sample and study sizes (bytes) when tune is set
+def tune_threads(metrics_file, threads, split_size, sample_size, study_size, tune=False, overrides=None):
+    tool_threads = {'BBDuk': threads, 'fastp': threads, 'Hostile': threads, 'FastQC': threads*split_size}
+    if not tune:
+        return tool_threads, split_size, split_size
+    cores = autotune.available_cores()
+    tuned = autotune.plan(metrics_file, {tool: tool_threads[tool] for tool in ['BBDuk', 'fastp', 'Hostile']}, dict.fromkeys(['BBDuk', 'fastp', 'Hostile'], sample_size), cores, split_size, overrides)
+    tuned.update(autotune.plan(metrics_file, {'FastQC': tool_threads['FastQC']}, {'FastQC': study_size}, cores, 1, overrides))
+    autotune.show_plan(tuned)
+    return {tool: setting['threads'] for tool, setting in tuned.items()}, autotune.queue_split(tuned, ['BBDuk', 'fastp']), tuned['Hostile']['split_size']
 
 
 if __name__ == "__main__":
@@ -125,7 +199,19 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--projects", help="List of project names as text file. (Default: studies_list.txt)", default="studies_list.txt")
     parser.add_argument("-u", "--utility_paths", help="Envs or Paths for tools and DBs as a CSV file. (Default: utility_paths.csv)", default="utility_paths.csv")
     parser.add_argument("-t", "--threads", type=int, default=1, help="Number of threads (Default: 1)")
-    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3], nargs="?", default=1, help="Number of sub_lists to make, and run concurrently (Default: no splitting, everything as one list).")
+    parser.add_argument("--stage_dir", help="Node-local directory (NVMe/tmpfs) to run BBDuk and fastp in (Default: off)", default=None)
+    parser.add_argument("--stage_gb", type=float, default=100, help="Maximum GB of staged reads at once (Default: 100)")
+    parser.add_argument("--autotune", action="store_true", help="Choose per-tool threads and concurrency from recorded run metrics (see autotune.py); split_size becomes the maximum")
+    parser.add_argument("--tool_threads", help="Per-tool overrides as a tool,threads CSV; threads may be '8x2' for 8 threads x 2 concurrent (Default: none)", default=None)
+    parser.add_argument("--pin", action="store_true", help="Pin each concurrent worker to its own cores and NUMA node, and report per-slot utilisation")
+    parser.add_argument("--retention", help="Apply the intermediate-artifact retention policy (see retention.py) as samples finish, optionally from a stage,action CSV; 'default' for the built-in policy (Default: off)", default=None)
+    parser.add_argument("-z", "--bgzf", action="store_true", help="Rewrite Hostile outputs as BGZF with a sidecar read index ({file}.ridx.npy)")
+    parser.add_argument("-l", "--split_size", type=int, choices=[1,2,3], nargs="?", default=1, help="Number of samples to run concurrently, fed from one queue across all studies (Default: 1)")
+    parser.add_argument("--executor", choices=['local', 'shared', 'slurm', 'slurm_local'], default='local', help="Run sample queues on local threads; 'shared' with other processes started the same way on any nodes, through a queue beside the base dir; or as Slurm job arrays ('slurm_local': on the local sbatch/squeue stand-in, slurm_standin.py) (Default: local)")
+    parser.add_argument("--sbatch_opts", help="Extra sbatch options for the job arrays, e.g. \"--partition=long --account=lab\" (Default: none)", default="")
+    parser.add_argument("--array_limit", type=int, default=0, help="Maximum running tasks per job array (Default: no limit)")
+    parser.add_argument("--job_resources", help="Per-tool memory and time of array tasks as a tool,mem_gb:hours CSV (Default: built-in)", default=None)
+    parser.add_argument("--plan", action="store_true", help="Only print the pending samples with estimated CPU-hours, disk use and makespan (see planner.py)")
     args=parser.parse_args()
 
     console.print(  
@@ -141,6 +227,19 @@ if __name__ == "__main__":
     utility_paths_in = args.utility_paths
     threads = args.threads
     split_size = args.split_size
+    bgzf = args.bgzf
+    # Threads per tool and concurrency per queue, until tuned for the inputs
+    tool_threads, qc_split, host_split = tune_threads(None, threads, split_size, 0, 0)
+    tune = bool(args.autotune or args.tool_threads)
+    overrides = make_dict(args.tool_threads) if args.tool_threads else {}
+
+    if args.stage_dir:
+        common.configure_staging(args.stage_dir, args.stage_gb)
+
+    # Reclaim space in the background as each sample's consumers finish
+    collector = None
+    if args.retention:
+        collector = retention.start_collector(retention.load_policy(args.retention), threads)
 
     utility_paths = make_dict(utility_paths_in)
     console.print(
@@ -157,31 +256,46 @@ if __name__ == "__main__":
     else:
         base_dir = os.path.join(os.getcwd(), args.base_dir)
 
-    if args.projects in os.listdir(base_dir):
-        logger.info(f"{common.EMOJI_SPARKLE} Found project file [bold blue]{args.projects}[/] in [bold blue]{args.base_dir}[/]")
-        base_dirs = [base_dir]
-    else:
-        logger.info(f"{common.EMOJI_PROCESS} [bold blue]{args.projects}[/] not in [bold blue]{args.base_dir}[/], searching subdirectories.")
-        # It may work only for one sub-level
-        base_dirs = [os.path.join(base_dir, d) for d in os.listdir(base_dir) if args.projects in os.listdir(os.path.join(base_dir, d))]
+    # Types, studies and samples from the cached project index
+    index = project_index.load_index(base_dir, args.projects, args.samples, write=not args.plan)
+    base_dirs = project_index.base_dirs(index)
+
+    # Tool runs are recorded for the autotuner
+    metrics_file = os.path.join(base_dir, autotune.METRICS_FILE)
+
+    if args.plan:
+        # Planned with the threads and splits the run would use: tuned for the median sample and study sizes
+        if tune:
+            sizes = planner.raw_sizes(index)
+            study_sizes = {}
+            for (base, study, sample), gb in sizes.items():
+                study_sizes[(base, study)] = study_sizes.get((base, study), 0) + gb
+            sample_size = statistics.median(sizes.values()) * 1024**3 if sizes else 0
+            study_size = statistics.median(study_sizes.values()) * 1024**3 if study_sizes else 0
+            tool_threads, qc_split, host_split = tune_threads(metrics_file, threads, split_size, sample_size, study_size, tune, overrides)
+        planner.plan_runner(index, base_dir, ['qc', 'hostile'], threads, split_size, bool(args.retention), tool_threads, {'qc': qc_split, 'hostile': host_split})
+        sys.exit(0)
+
+    # Sample queues are shared with other workers, or run as job arrays, when another executor is selected
+    if args.executor != 'local':
+        common.configure_executor(args.executor, f"{base_dir}_executor_work", args.sbatch_opts, args.array_limit, make_dict(args.job_resources) if args.job_resources else None)
+
+    common.configure_metrics(metrics_file)
 
     # Main status
     status = console.status(f"[i][dim]Initiating QC on[/dim] {len(base_dirs)} [dim] study {p.plural('type', len(base_dirs))}[/dim][/i]")
     
-    # Per-study statuses
-    status_subs = []
-    for i in range(split_size):
-        status_subs.append(console.status(f"[i][dim]Running QC on thread {i+1}...[/dim][/i]"))
+    # Per-worker statuses, rendered together as one table
+    board = common.StatusBoard(split_size, "[i][dim]Waiting for a sample...[/dim][/i]")
+    status_subs = board.slots
 
-    with Live(Group(status, progress, *status_subs), console=console, transient=True):
+    with common.live(Group(status, progress, board), refresh_per_second=common.BOARD_REFRESH):
         if base_dirs:
+            # Study contexts and one queue of samples across all studies and data types
+            contexts = []
+            jobs = []
             for base in base_dirs:
-                status.update(f"[i][dim]Performing QC on[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]datasets ({base_dirs.index(base)+1}/{len(base_dirs)})[/dim][/i]")
-
-                console.rule(f"Performing QC on all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
-
-                studies_in = os.path.join(base, args.projects)
-                studies = names_list(studies_in)
+                studies = project_index.studies(index, base)
                 console.print(
                     panel.fit(
                         f"[dim]{common.EMOJI_SPARKLE} Found[/] [bold]{len(studies)}[/] [dim]studies in[/] {os.path.basename(base)} [dim]dir[/]", 
@@ -190,66 +304,76 @@ if __name__ == "__main__":
                     ),
                     style='italic'
                 )
-                
-                task = progress.add_task(f"{common.EMOJI_PROCESS} [i][dim]Performing QC on[/dim] [cyan]{os.path.basename(base)}[/cyan] [dim]studies[/dim][/i]", total=len(studies))
                 for study in studies:
-                    
-                    console.rule(f"[dim][i]Running QC on[/dim] {study}[/i]", characters="-", style='dim')
-                    
-                    raw_reads = f"{base}/{study}/raw_reads"
-                    raw_qc = f"{base}/{study}/raw_qc"
-                    raw_mqc = f"{base}/{study}/raw_mqc"
-                    bb_out = f"{base}/{study}/bb_out"
-                    bb_qc = f"{base}/{study}/bb_qc"
-                    bb_mqc = f"{base}/{study}/bb_mqc"
-                    fp_out = f"{base}/{study}/fp_out"
-                    fp_qc = f"{base}/{study}/fp_qc"
-                    fp_mqc = f"{base}/{study}/fp_mqc"
-                    hostile_out = f"{base}/{study}/hostile_out"
-
-                    os.makedirs(raw_qc, exist_ok=True)
-                    os.makedirs(raw_mqc, exist_ok=True)
-                    os.makedirs(bb_out, exist_ok=True)
-                    os.makedirs(bb_qc, exist_ok=True)
-                    os.makedirs(bb_mqc, exist_ok=True)
-                    os.makedirs(fp_out, exist_ok=True)
-                    os.makedirs(fp_qc, exist_ok=True)
-                    os.makedirs(fp_mqc, exist_ok=True)
-                    os.makedirs(hostile_out, exist_ok=True)
-
-                    samples = names_list(f"{base}/{study}/{samples_in}")
+                    context = common.study_context(
+                        base, study,
+                        raw_reads="raw_reads", raw_qc="raw_qc", raw_mqc="raw_mqc",
+                        bb_out="bb_out", bb_qc="bb_qc", bb_mqc="bb_mqc",
+                        fp_out="fp_out", fp_qc="fp_qc", fp_mqc="fp_mqc",
+                        hostile_out="hostile_out"
+                    )
+                    for stage_dir in ['raw_qc', 'raw_mqc', 'bb_out', 'bb_qc', 'bb_mqc', 'fp_out', 'fp_qc', 'fp_mqc', 'hostile_out']:
+                        os.makedirs(context[stage_dir], exist_ok=True)
+
+                    samples = project_index.samples(index, base, study)
                     samples_count = len(samples)
                     logger.info(f"{common.EMOJI_SPARKLE} Project [bold blue]{study}[/] has {samples_count} {p.plural('sample', samples_count)}...")
-
-                    for status_sub in status_subs:
-                        status_sub.update("[dim]Waiting for the single thread process to finish[/]")
-                    # Generate QC reports for raw_reads
-                    generate_qc_reports(raw_reads, raw_qc, raw_mqc, status_subs[0])
-
-                    sample_lists = common.get_split_size(split_size, samples)
-
-                    # Run BBDuk and fastp
-                    common.run_concurrently(run_qc, split_size, sample_lists, status_subs=status_subs)
-
-                    # Generate QC reports for filtered_reads
-                    for status_sub in status_subs:
-                        status_sub.update("[dim]Waiting for the single thread process to finish[/]")
-                    generate_qc_reports(bb_out, bb_qc, bb_mqc, status_subs[0])
-                    
-                    for status_sub in status_subs:
-                        status_sub.update("[dim]Waiting for the single thread process to finish[/]")
-                    generate_qc_reports(fp_out, fp_qc, fp_mqc, status_subs[0])
-
-                    # Run Hostile
-                    common.run_concurrently(remove_host, split_size, sample_lists, status_subs=status_subs)
-
-                    console.rule(f"[dim][i]Completed Quality Trimming for[/dim] {study}[/i]", characters="-", style='dim')
-                    progress.update(task, advance=1)
-
-                console.rule(f"Completed Quality Trimming for all studies in [b cyan]{os.path.basename(base)}[/]", characters="=", style='dim')
-                console.print('\n')
-                status.update(f"[i green dim]Processed [cyan b]{os.path.basename(base)}[/cyan b] studies[/i green dim]")
-                
+                    context['manifest'] = fq_manifest.load_manifest(f"{base}/{study}", threads)
+                    # Pairing validation: only paired samples go through BBDuk, fastp and Hostile
+                    for sample in samples:
+                        entry = context['manifest'].get(sample)
+                        if entry is None and os.path.exists(f"{context['hostile_out']}/{sample}_R2.clean_2.fastq.gz"):
+                            # Raw reads reclaimed by the retention policy once host removal finished
+                            logger.info(f"{common.EMOJI_CHECK} [green]{sample}[/green] already host-filtered. Skipping...")
+                        elif entry is None or entry['layout'] != 'paired':
+                            logger.warning(f"{common.EMOJI_WARNING} [blue]{study}[/blue] {common.EMOJI_PLAY} [magenta]{sample}[/magenta] is {entry['layout'] if entry else 'missing'} in the FASTQ manifest. Skipping...")
+                        else:
+                            jobs.append((context, sample))
+                    contexts.append(context)
+
+            # Largest inputs first, so the queue drains evenly across workers
+            jobs.sort(key=lambda job: fq_manifest.input_size(job[0]['manifest'], job[1]), reverse=True)
+            task = progress.add_task(f"{common.EMOJI_PROCESS} [i][dim]Performing QC on all studies[/dim][/i]", total=len(contexts))
+
+            # Per-tool threads and concurrency for this node and these input sizes
+            if tune:
+                sample_size = statistics.median(fq_manifest.input_size(context['manifest'], sample) for context, sample in jobs) if jobs else 0
+                study_size = statistics.median(sum(fq_manifest.input_size(context['manifest'], sample) for sample in context['manifest']) for context in contexts) if contexts else 0
+                tool_threads, qc_split, host_split = tune_threads(metrics_file, threads, split_size, sample_size, study_size, tune, overrides)
+
+            # Generate QC reports for raw_reads, one study at a time, in one slot sized for FastQC
+            for status_sub in status_subs:
+                status_sub.update("[dim]Waiting for the single thread process to finish[/]")
+            if args.pin:
+                common.configure_placement(1, tool_threads['FastQC'])
+            common.run_queue(run_qc_reports, 1, [(context, 'raw_reads') for context in contexts], status_subs, resources=common.job_resources(['FastQC'], tool_threads['FastQC']))
+
+            # Run BBDuk and fastp
+            status.update(f"[i][dim]Filtering[/dim] {len(jobs)} [dim]samples from[/dim] {len(contexts)} [dim]studies[/dim][/i]")
+            if args.pin:
+                common.configure_placement(qc_split, max(tool_threads['BBDuk'], tool_threads['fastp']))
+            common.run_queue(run_qc, qc_split, jobs, status_subs, prefetch=prefetch_qc if common.staging_enabled() else None, resources=common.job_resources(['BBDuk', 'fastp'], max(tool_threads['BBDuk'], tool_threads['fastp'])))
+
+            # Generate QC reports for filtered_reads, back in one slot sized for FastQC (not the first BBDuk/fastp slot)
+            for status_sub in status_subs:
+                status_sub.update("[dim]Waiting for the single thread process to finish[/]")
+            if args.pin:
+                common.configure_placement(1, tool_threads['FastQC'])
+            common.run_queue(run_qc_reports, 1, [(context, stage) for context in contexts for stage in ['bb_out', 'fp_out']], status_subs, resources=common.job_resources(['FastQC'], tool_threads['FastQC']))
+
+            # Run Hostile
+            status.update(f"[i][dim]Removing host reads from[/dim] {len(jobs)} [dim]samples[/dim][/i]")
+            if args.pin:
+                common.configure_placement(host_split, tool_threads['Hostile'])
+            common.run_queue(remove_host, host_split, jobs, status_subs, on_done=(lambda context, sample: retention.submit(collector, context, sample)) if collector else None, resources=common.job_resources(['Hostile'], tool_threads['Hostile']))
+            if collector:
+                status.update("[i][dim]Waiting for the retention policy to finish[/dim][/i]", spinner='toggle9', spinner_style='gold1')
+                retention.stop_collector(collector)
+            progress.update(task, completed=len(contexts))
+
+            console.rule("Completed Quality Trimming for all studies", characters="=", style='dim')
+            console.print('\n')
+            status.update(f"[i green dim]Processed {len(contexts)} studies[/i green dim]")
             
             console.print(
                 panel.fit(
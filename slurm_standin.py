@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+# Local stand-in for Slurm's sbatch and squeue, to run the 'slurm' executor (common.run_queue) on one machine
+# sbatch records the array's tasks and starts a detached dispatcher that runs them as local processes, at most
+# the array's %limit (or the CPU count / cpus-per-task) at a time; squeue lists the tasks that have not finished.
+# Job state lives in MGA_STANDIN_DIR (Default: {tmp}/slurm_standin_{uid}).
+
+import argparse
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+STATE_DIR = os.environ.get('MGA_STANDIN_DIR') or os.path.join(tempfile.gettempdir(), f"slurm_standin_{os.getuid()}")
+FINAL_STATES = ['COMPLETED', 'FAILED']
+
+# Task ids of an --array spec ("0-9", "0,2,5-7") and its running-task limit ("%2")
+def parse_array(spec):
+    spec, _, limit = spec.partition('%')
+    ids = []
+    for part in spec.split(','):
+        start, _, end = part.partition('-')
+        ids.extend(range(int(start), int(end or start) + 1))
+    return ids, int(limit) if limit else 0
+
+# Next job id, from a counter file shared by all submissions
+def next_job_id():
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, "next_id"), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = int(f.read() or 1000)
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_id + 1))
+    return str(job_id)
+
+def job_dir(job_id):
+    return os.path.join(STATE_DIR, job_id)
+
+def set_state(job_id, task_id, state):
+    with open(f"{job_dir(job_id)}/{task_id}.state.tmp", 'w') as f:
+        f.write(state)
+    os.replace(f"{job_dir(job_id)}/{task_id}.state.tmp", f"{job_dir(job_id)}/{task_id}.state")
+
+def get_state(job_id, task_id):
+    with open(f"{job_dir(job_id)}/{task_id}.state") as f:
+        return f.read().strip()
+
+def load_job(job_id):
+    with open(f"{job_dir(job_id)}/job.json") as f:
+        return json.load(f)
+
+# Whether a process is alive
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Record the job, start its dispatcher and print its id
+def sbatch(argv):
+    parser = argparse.ArgumentParser(prog="sbatch")
+    parser.add_argument("--parsable", action="store_true")
+    parser.add_argument("--array", default="0")
+    parser.add_argument("--output", default="slurm-%A_%a.out")
+    parser.add_argument("--cpus-per-task", type=int, default=1)
+    parser.add_argument("--job-name", default="standin")
+    parser.add_argument("script")
+    # Resource and placement options (--mem, --time, --partition, ...) are accepted and ignored
+    args, _ = parser.parse_known_args(argv)
+
+    task_ids, limit = parse_array(args.array)
+    job_id = next_job_id()
+    os.makedirs(job_dir(job_id))
+    job = {
+        'name': args.job_name, 'script': os.path.abspath(args.script), 'output': os.path.abspath(args.output),
+        'tasks': task_ids, 'limit': limit or max(1, os.cpu_count() // args.cpus_per_task), 'cpus': args.cpus_per_task, 'cwd': os.getcwd(),
+    }
+    for task_id in task_ids:
+        set_state(job_id, task_id, 'PENDING')
+    dispatcher = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "dispatch", job_id],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+    job['dispatcher'] = dispatcher.pid
+    with open(f"{job_dir(job_id)}/job.json", 'w') as f:
+        json.dump(job, f)
+    print(job_id if args.parsable else f"Submitted batch job {job_id}")
+
+# Run the array's tasks as local processes, at most job['limit'] at a time
+def dispatch(job_id):
+    while not os.path.exists(f"{job_dir(job_id)}/job.json"):
+        time.sleep(0.05)
+    job = load_job(job_id)
+    pending, running = list(job['tasks']), {}
+    while pending or running:
+        while pending and len(running) < job['limit']:
+            task_id = pending.pop(0)
+            env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(task_id), SLURM_CPUS_PER_TASK=str(job['cpus']), SLURM_JOB_NAME=job['name'])
+            output = job['output'].replace('%A', job_id).replace('%a', str(task_id)).replace('%j', job_id)
+            with open(output, 'w') as log:
+                running[task_id] = subprocess.Popen(["bash", job['script']], cwd=job['cwd'], env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+            set_state(job_id, task_id, 'RUNNING')
+        for task_id, process in list(running.items()):
+            if process.poll() is not None:
+                set_state(job_id, task_id, 'COMPLETED' if process.returncode == 0 else 'FAILED')
+                del running[task_id]
+        time.sleep(0.2)
+
+# Print the unfinished tasks of the given jobs; tasks of a dead dispatcher are dropped, as Slurm drops lost jobs
+def squeue(argv):
+    parser = argparse.ArgumentParser(prog="squeue", add_help=False)
+    parser.add_argument("-h", "--noheader", action="store_true")
+    parser.add_argument("-r", "--array", action="store_true")
+    parser.add_argument("-j", "--jobs", default=None)
+    parser.add_argument("-o", "--format", default="%i %j %T")
+    args, _ = parser.parse_known_args(argv)
+
+    if args.jobs:
+        job_ids = args.jobs.split(',')
+    else:
+        job_ids = sorted(name for name in os.listdir(STATE_DIR) if name.isdigit()) if os.path.isdir(STATE_DIR) else []
+    lines = []
+    for job_id in job_ids:
+        if not os.path.exists(f"{job_dir(job_id)}/job.json"):
+            print("slurm_load_jobs error: Invalid job id specified", file=sys.stderr)
+            sys.exit(1)
+        job = load_job(job_id)
+        dispatcher_alive = alive(job['dispatcher'])
+        for task_id in job['tasks']:
+            state = get_state(job_id, task_id)
+            if state in FINAL_STATES or not dispatcher_alive:
+                continue
+            fields = {'%i': f"{job_id}_{task_id}", '%A': job_id, '%a': str(task_id), '%j': job['name'], '%T': state}
+            line = args.format
+            for field, value in fields.items():
+                line = line.replace(field, value)
+            lines.append(line)
+    if not args.noheader:
+        print(args.format.replace('%i', "JOBID").replace('%A', "ARRAY_JOB_ID").replace('%a', "ARRAY_TASK_ID").replace('%j', "NAME").replace('%T', "STATE"))
+    for line in lines:
+        print(line)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ['sbatch', 'squeue', 'dispatch']:
+        print("Usage: slurm_standin.py {sbatch|squeue} [options]", file=sys.stderr)
+        sys.exit(2)
+    if sys.argv[1] == 'sbatch':
+        sbatch(sys.argv[2:])
+    elif sys.argv[1] == 'squeue':
+        squeue(sys.argv[2:])
+    else:
+        dispatch(sys.argv[2])